@@ -189,8 +189,75 @@ export const useNovelStore = defineStore('novel', () => {
     chapters.value = newChapters
   }
 
+  // 服务器上最近一次确认的 extra_data / 滚动摘要，保存时只上传变化的部分
+  let savedNovelData = null
+
+  const escapePointer = (key) => String(key).replace(/~/g, '~0').replace(/\//g, '~1')
+
+  // 生成把 base 变成 next 的 RFC 6902 操作：对象逐键比较，数组比较公共部分再增删尾部
+  const diffJson = (base, next, path = '', ops = []) => {
+    if (base === next) return ops
+    const isObject = (v) => v !== null && typeof v === 'object' && !Array.isArray(v)
+    if (Array.isArray(base) && Array.isArray(next)) {
+      const common = Math.min(base.length, next.length)
+      for (let i = 0; i < common; i++) diffJson(base[i], next[i], `${path}/${i}`, ops)
+      for (let i = base.length - 1; i >= common; i--) ops.push({ op: 'remove', path: `${path}/${i}` })
+      for (let i = common; i < next.length; i++) ops.push({ op: 'add', path: `${path}/-`, value: next[i] })
+    } else if (isObject(base) && isObject(next)) {
+      for (const key of Object.keys(base)) {
+        if (!(key in next)) ops.push({ op: 'remove', path: `${path}/${escapePointer(key)}` })
+      }
+      for (const [key, value] of Object.entries(next)) {
+        const child = `${path}/${escapePointer(key)}`
+        if (key in base) diffJson(base[key], value, child, ops)
+        else ops.push({ op: 'add', path: child, value })
+      }
+    } else if (JSON.stringify(base) !== JSON.stringify(next)) {
+      ops.push({ op: 'replace', path, value: next })
+    }
+    return ops
+  }
+
+  const parseExtraData = (value) => {
+    if (!value) return {}
+    if (typeof value !== 'string') return value
+    try {
+      return JSON.parse(value)
+    } catch {
+      return null
+    }
+  }
+
+  // 服务器上各章节最近一次确认的正文，用于增量保存（不放进响应式状态）
+  const savedChapterText = new Map()
+
+  // 公共前缀/后缀比较，生成 PATCH 用的 [[偏移, 删除数, 插入文本]]（按码点计，与服务器一致）
+  const diffText = (base, text) => {
+    const a = Array.from(base)
+    const b = Array.from(text)
+    let start = 0
+    while (start < a.length && start < b.length && a[start] === b[start]) start++
+    let endA = a.length
+    let endB = b.length
+    while (endA > start && endB > start && a[endA - 1] === b[endB - 1]) {
+      endA--
+      endB--
+    }
+    if (start === endA && start === endB) return []
+    return [[start, endA - start, b.slice(start, endB).join('')]]
+  }
+
+  const rememberSavedChapter = (chapterId, content, version) => {
+    if (!chapterId || typeof content !== 'string') return
+    savedChapterText.set(chapterId, { content, version })
+  }
+
   const setSelectedChapter = (chapter) => {
     selectedChapter.value = chapter
+    // 章节列表只含目录信息，选中时再按需加载正文
+    if (chapter?.id && chapter.content === undefined) {
+      loadChapterContent(chapter.id)
+    }
   }
 
   const updateChapterContent = (chapterId, content) => {
@@ -784,9 +851,11 @@ export const useNovelStore = defineStore('novel', () => {
       if (response.ok) {
         const novel = await response.json()
         currentNovel.value = novel
+        const extraData = parseExtraData(novel.extra_data)
+        savedNovelData = extraData && { id: novel.id, extraData, rollingSummary: novel.rolling_summary ?? null }
 
-        // Load chapters for this novel
-        const chaptersRes = await fetch(`/api/novels/${novelId}/chapters`)
+        // Load the chapter outline only; bodies are fetched per chapter on selection
+        const chaptersRes = await fetch(`/api/novels/${novelId}/chapters/index`)
         if (chaptersRes.ok) {
           chapters.value = await chaptersRes.json()
         }
@@ -799,11 +868,273 @@ export const useNovelStore = defineStore('novel', () => {
     }
   }
 
+  // Load a chapter body (optionally a character range of a very long chapter)
+  const loadChapterContent = async (chapterId, { offset, length } = {}) => {
+    try {
+      const params = new URLSearchParams()
+      if (offset !== undefined) params.set('offset', offset)
+      if (length !== undefined) params.set('length', length)
+      const query = params.toString()
+      const response = await fetch(`/api/chapters/${chapterId}${query ? `?${query}` : ''}`)
+      if (!response.ok) throw new Error('Failed to load chapter')
+      const data = await response.json()
+      // 只有完整正文才写回章节，分段结果直接返回给调用方
+      if (data.total_length === undefined) {
+        rememberSavedChapter(chapterId, data.content, data.version)
+        const chapter = chapters.value.find(c => c.id === chapterId)
+        if (chapter) Object.assign(chapter, data)
+        if (selectedChapter.value?.id === chapterId && selectedChapter.value !== chapter) {
+          Object.assign(selectedChapter.value, data)
+        }
+      }
+      return data
+    } catch (error) {
+      console.error('Error loading chapter:', error)
+      return null
+    }
+  }
+
+  // Characters, locations, factions... indexed on the server, so lists need not parse extra_data
+  const loadEntities = async (novelId, kind = null) => {
+    try {
+      const query = kind ? `?kind=${encodeURIComponent(kind)}` : ''
+      const response = await fetch(`/api/novels/${novelId}/entities${query}`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to load entities')
+    } catch (error) {
+      console.error('Error loading entities:', error)
+      return []
+    }
+  }
+
+  // Entities with this exact name across all novels (e.g. every novel featuring a character)
+  const findEntities = async (name, kind = null) => {
+    try {
+      const params = new URLSearchParams({ name })
+      if (kind) params.set('kind', kind)
+      const response = await fetch(`/api/entities?${params}`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to find entities')
+    } catch (error) {
+      console.error('Error finding entities:', error)
+      return []
+    }
+  }
+
+  // Where entity names appear: per name (with the last chapter) or, given a name, per chapter with offsets
+  const loadMentions = async (novelId, name = null) => {
+    try {
+      const query = name ? `?name=${encodeURIComponent(name)}` : ''
+      const response = await fetch(`/api/novels/${novelId}/mentions${query}`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to load mentions')
+    } catch (error) {
+      console.error('Error loading mentions:', error)
+      return []
+    }
+  }
+
+  // Earlier passages most relevant to a query (BM25), for building generation prompts
+  const retrievePassages = async (novelId, query, k = 5) => {
+    try {
+      const params = new URLSearchParams({ q: query, k })
+      const response = await fetch(`/api/novels/${novelId}/retrieve?${params}`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to retrieve passages')
+    } catch (error) {
+      console.error('Error retrieving passages:', error)
+      return []
+    }
+  }
+
+  // Prompt context for writing a chapter, assembled on the server within a token budget
+  // options: { systemPrompt, chapterId, query, paragraphs, k }
+  const buildGenerationContext = async (novelId, budget, options = {}) => {
+    try {
+      const response = await fetch(`/api/novels/${novelId}/context`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          budget,
+          system_prompt: options.systemPrompt,
+          chapter_id: options.chapterId,
+          query: options.query,
+          paragraphs: options.paragraphs,
+          k: options.k
+        })
+      })
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to build context')
+    } catch (error) {
+      console.error('Error building context:', error)
+      return null
+    }
+  }
+
+  // Hierarchical summary from the last refresh: root summary plus every chapter-range node
+  const loadSummaryTree = async (novelId) => {
+    try {
+      const response = await fetch(`/api/novels/${novelId}/summary`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to load summary tree')
+    } catch (error) {
+      console.error('Error loading summary tree:', error)
+      return null
+    }
+  }
+
+  // Refresh the rolling summary now; only chapters changed since the last refresh are re-summarized
+  const refreshRollingSummary = async (novelId) => {
+    try {
+      const response = await fetch(`/api/novels/${novelId}/summary`, { method: 'POST' })
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to refresh summary')
+    } catch (error) {
+      console.error('Error refreshing summary:', error)
+      return null
+    }
+  }
+
+  // Queue server-side generation of chapters firstIndex..lastIndex (order_index, inclusive); runs without the tab open
+  // options: { systemPrompt, model, contextBudget, overwrite }
+  const queueChapterGeneration = async (novelId, firstIndex, lastIndex, promptTemplate, options = {}) => {
+    try {
+      const response = await fetch('/api/generation/jobs', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          novel_id: novelId,
+          first_index: firstIndex,
+          last_index: lastIndex,
+          prompt_template: promptTemplate,
+          system_prompt: options.systemPrompt,
+          model: options.model,
+          context_budget: options.contextBudget,
+          overwrite: options.overwrite
+        })
+      })
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to queue generation')
+    } catch (error) {
+      console.error('Error queueing generation:', error)
+      return null
+    }
+  }
+
+  // Generation jobs of a novel with their progress (done / total), newest first
+  const loadGenerationJobs = async (novelId) => {
+    try {
+      const response = await fetch(`/api/generation/jobs?novel_id=${novelId}`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to load generation jobs')
+    } catch (error) {
+      console.error('Error loading generation jobs:', error)
+      return []
+    }
+  }
+
+  // action: 'pause' | 'resume' | 'cancel'
+  const controlGenerationJob = async (jobId, action) => {
+    try {
+      const response = await fetch(`/api/generation/jobs/${jobId}/${action}`, { method: 'POST' })
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error(`Failed to ${action} generation job`)
+    } catch (error) {
+      console.error('Error controlling generation job:', error)
+      return null
+    }
+  }
+
+  // Chapter revision history (newest first, without text)
+  const loadChapterRevisions = async (chapterId) => {
+    try {
+      const response = await fetch(`/api/chapters/${chapterId}/revisions`)
+      if (response.ok) {
+        return await response.json()
+      }
+      throw new Error('Failed to load revisions')
+    } catch (error) {
+      console.error('Error loading revisions:', error)
+      return []
+    }
+  }
+
+  // Restore a revision; the restore itself becomes a new revision, so it can be undone
+  const restoreChapterRevision = async (revisionId) => {
+    try {
+      const response = await fetch('/api/revisions/restore', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ id: revisionId })
+      })
+      if (!response.ok) throw new Error('Failed to restore revision')
+      const { chapter_id: chapterId } = await response.json()
+      await loadChapterContent(chapterId)
+      return chapterId
+    } catch (error) {
+      console.error('Error restoring revision:', error)
+      return null
+    }
+  }
+
   // Save Novel Metadata
-  const saveNovelData = async (extraData = null, rollingSummary = null) => {
+  // 已有服务器副本时用 PATCH 只上传 extra_data 的变化；失败或冲突时退回整本保存
+  const patchNovelData = async (extraData, rollingSummary) => {
+    const novel = currentNovel.value
+    if (!savedNovelData || savedNovelData.id !== novel.id) return false
+    const fields = {
+      title: novel.title,
+      description: novel.description,
+      genre: novel.genre,
+      cover_image: novel.cover_image,
+      status: novel.status
+    }
+    if (rollingSummary !== savedNovelData.rollingSummary) fields.rolling_summary = rollingSummary
+    const response = await fetch(`/api/novels/${novel.id}`, {
+      method: 'PATCH',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ extra_data: diffJson(savedNovelData.extraData, extraData), fields })
+    })
+    if (!response.ok) {
+      console.warn('Novel patch rejected, saving in full')
+      return false
+    }
+    savedNovelData = { id: novel.id, extraData, rollingSummary }
+    return true
+  }
+
+  // 自动保存交给服务器合并写入；离开页面等明确的保存传 { flush: true } 立即落盘
+  const saveNovelData = async (extraData = null, rollingSummary = null, { flush = false } = {}) => {
     if (!currentNovel.value) return
 
     try {
+      // 去掉响应式代理和 undefined 字段，与服务器保存的 JSON 保持一致
+      const snapshot = extraData === null ? null : JSON.parse(JSON.stringify(extraData))
+      if (currentNovel.value.id && snapshot !== null && await patchNovelData(snapshot, rollingSummary)) {
+        console.log('Novel saved successfully')
+        return
+      }
+
       const payload = {
         id: currentNovel.value.id,
         title: currentNovel.value.title,
@@ -812,11 +1143,12 @@ export const useNovelStore = defineStore('novel', () => {
         cover_image: currentNovel.value.cover_image,
         status: currentNovel.value.status,
         updated_at: new Date(),
-        extra_data: extraData,
+        extra_data: snapshot,
         rolling_summary: rollingSummary
       }
 
-      const response = await fetch('/api/novels/save', {
+      // 之后的 PATCH 以这次的内容为基准（服务器打补丁前会先写入这本小说排队中的保存）
+      const response = await fetch(`/api/novels/save${flush ? '?flush=true' : ''}`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
@@ -827,6 +1159,7 @@ export const useNovelStore = defineStore('novel', () => {
         if (!currentNovel.value.id) {
           currentNovel.value.id = data.id
         }
+        savedNovelData = snapshot === null ? null : { id: data.id, extraData: snapshot, rollingSummary }
         console.log('Novel saved successfully')
       } else {
         throw new Error('Failed to save novel')
@@ -837,10 +1170,47 @@ export const useNovelStore = defineStore('novel', () => {
   }
 
   // Save Chapter Content
-  const saveCurrentChapter = async () => {
+  // 已知服务器版本时只上传差异；版本冲突则退回整章保存（被覆盖的内容仍在修订历史中）
+  const patchChapter = async (chapter) => {
+    const saved = savedChapterText.get(chapter.id)
+    if (!saved || saved.version === undefined) return false
+    const response = await fetch(`/api/chapters/${chapter.id}`, {
+      method: 'PATCH',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        base_version: saved.version,
+        ops: diffText(saved.content, chapter.content),
+        fields: {
+          title: chapter.title,
+          description: chapter.description,
+          word_count: chapter.content.length,
+          status: chapter.status,
+          order_index: chapter.order_index || 0
+        }
+      })
+    })
+    if (response.status === 409) {
+      console.warn('Chapter changed on the server, saving full content')
+      return false
+    }
+    if (!response.ok) throw new Error('Failed to patch chapter')
+    const data = await response.json()
+    chapter.version = data.version
+    rememberSavedChapter(chapter.id, chapter.content, data.version)
+    return true
+  }
+
+  const saveCurrentChapter = async ({ flush = false } = {}) => {
     if (!selectedChapter.value || !currentNovel.value?.id) return
+    // 正文尚未加载时保存会把内容清空
+    if (selectedChapter.value.id && selectedChapter.value.content === undefined) return
 
     try {
+      if (selectedChapter.value.id && await patchChapter(selectedChapter.value)) {
+        console.log('Chapter saved successfully')
+        return
+      }
+
       const payload = {
         id: selectedChapter.value.id,
         novel_id: currentNovel.value.id,
@@ -852,7 +1222,8 @@ export const useNovelStore = defineStore('novel', () => {
         order_index: selectedChapter.value.order_index || 0
       }
 
-      const response = await fetch('/api/chapters/save', {
+      // 返回的版本号已计入排队中的保存，之后的保存就可以走增量
+      const response = await fetch(`/api/chapters/save${flush ? '?flush=true' : ''}`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
@@ -863,6 +1234,8 @@ export const useNovelStore = defineStore('novel', () => {
         if (!selectedChapter.value.id) {
           selectedChapter.value.id = data.id
         }
+        selectedChapter.value.version = data.version
+        rememberSavedChapter(data.id, payload.content, data.version)
         console.log('Chapter saved successfully')
       } else {
         throw new Error('Failed to save chapter')
@@ -941,6 +1314,19 @@ export const useNovelStore = defineStore('novel', () => {
     // Persistence Methods
     loadNovels,
     loadNovel,
+    loadChapterContent,
+    loadEntities,
+    findEntities,
+    loadMentions,
+    retrievePassages,
+    buildGenerationContext,
+    loadSummaryTree,
+    refreshRollingSummary,
+    queueChapterGeneration,
+    loadGenerationJobs,
+    controlGenerationJob,
+    loadChapterRevisions,
+    restoreChapterRevision,
     saveNovelData,
     saveCurrentChapter,
     deleteNovel,
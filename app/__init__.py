@@ -5,7 +5,7 @@ AI Director Assistant - 主应用初始化模块
 from flask import Flask, jsonify
 from flask_cors import CORS
 from app.config import Config
-from app.models.database import DatabaseManager
+from app.models.database import DatabaseManager, get_database
 from app.routes.api import api_bp
 from app.routes.export import export_bp
 from app.utils.helpers import Utils, ValidationError
@@ -43,7 +43,9 @@ def create_app(db_file=None):
     
     # 初始化数据库
     with app.app_context():
-        db = DatabaseManager(db_file=db_file) if db_file else DatabaseManager()
+        # 每个数据库文件只创建一次（建表与迁移只执行一次），路由通过 app.extensions 复用
+        db = get_database(db_file) if db_file else get_database()
+        app.extensions['database'] = db
         print("✅ 数据库初始化完成")
     
     # 错误处理
@@ -73,7 +75,7 @@ def create_app(db_file=None):
     # 健康检查
     @app.route('/health')
     def health_check():
-        health_status = Utils.check_backend_health()
+        health_status = Utils.check_backend_health(app.extensions['database'])
         
         if health_status['status'] == 'healthy':
             return Utils.create_success_response(health_status)
@@ -6,20 +6,87 @@ import sqlite3
 import json
 from datetime import datetime
 import os
+import threading
+from sqlite_pool import ConnectionPool
+from settings_cache import get_settings_cache
+from text_codec import decode, encode, recompress_table
 
 DB_FILE = 'scripts.db'
 
+# 统计计数器：由触发器随 scripts 的增删改同步维护，/api/stats 直接读取
+# dimension: total / favorite / type / platform，value 为类型或平台名（total、favorite 为空串）
+STATS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS script_stats (
+        dimension TEXT NOT NULL,
+        value TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (dimension, value)
+    )
+'''
+
+# 用 GROUP BY 重新计算全部计数器
+STATS_REBUILD_SQL = '''
+    DELETE FROM script_stats;
+    INSERT INTO script_stats (dimension, value, count)
+        SELECT 'total', '', COUNT(*) FROM scripts
+        UNION ALL
+        SELECT 'favorite', '', COUNT(*) FROM scripts WHERE COALESCE(is_favorite, 0) != 0;
+    INSERT INTO script_stats (dimension, value, count)
+        SELECT 'type', COALESCE(script_type, 'unknown'), COUNT(*) FROM scripts
+        GROUP BY COALESCE(script_type, 'unknown');
+    INSERT INTO script_stats (dimension, value, count)
+        SELECT 'platform', COALESCE(platform, 'unknown'), COUNT(*) FROM scripts
+        GROUP BY COALESCE(platform, 'unknown');
+'''
+
+def _bump(dimension, value_expr, delta, condition='1'):
+    """生成计数器增减语句（先补行再更新，不依赖UPSERT）"""
+    return f'''
+        INSERT OR IGNORE INTO script_stats (dimension, value, count)
+            SELECT '{dimension}', {value_expr}, 0 WHERE {condition};
+        UPDATE script_stats SET count = count + ({delta})
+            WHERE dimension = '{dimension}' AND value = {value_expr} AND {condition};'''
+
+def _bump_row(row, delta):
+    """某一行对全部计数器的贡献"""
+    return ''.join([
+        _bump('total', "''", delta),
+        _bump('favorite', "''", delta, f"COALESCE({row}.is_favorite, 0) != 0"),
+        _bump('type', f"COALESCE({row}.script_type, 'unknown')", delta),
+        _bump('platform', f"COALESCE({row}.platform, 'unknown')", delta),
+    ])
+
+STATS_TRIGGERS_SQL = f'''
+    CREATE TRIGGER IF NOT EXISTS trg_script_stats_insert AFTER INSERT ON scripts BEGIN
+        {_bump_row('NEW', 1)}
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_script_stats_delete AFTER DELETE ON scripts BEGIN
+        {_bump_row('OLD', -1)}
+        DELETE FROM script_stats WHERE count <= 0 AND dimension IN ('type', 'platform');
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_script_stats_update AFTER UPDATE OF script_type, platform, is_favorite ON scripts BEGIN
+        {_bump_row('OLD', -1)}
+        {_bump_row('NEW', 1)}
+        DELETE FROM script_stats WHERE count <= 0 AND dimension IN ('type', 'platform');
+    END;
+'''
+
 class DatabaseManager:
     """数据库管理器"""
     
     def __init__(self, db_file=DB_FILE):
         self.db_file = db_file
         self.init_db()
+        self.pool = ConnectionPool(db_file)
+        self.settings = get_settings_cache(db_file)
+        self.settings.load()
     
     def init_db(self):
         """初始化数据库"""
         try:
             conn = sqlite3.connect(self.db_file)
+            # WAL：读不阻塞写，设置持久保存在数据库文件中
+            conn.execute('PRAGMA journal_mode=WAL')
             cursor = conn.cursor()
             
             # 设置表
@@ -43,6 +110,22 @@ class DatabaseManager:
                 )
             ''')
             
+            # 历史列表按 (created_at, id) 倒序分页
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_scripts_created_at ON scripts(created_at)')
+            
+            # 统计计数器：首次创建时按现有数据回填，此后由触发器维护
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'script_stats'")
+            stats_exists = cursor.fetchone() is not None
+            conn.commit()
+            # 建表、回填与建触发器在同一事务内完成，避免期间写入的脚本漏计
+            cursor.executescript(f"""
+                BEGIN IMMEDIATE;
+                {STATS_TABLE_SQL};
+                {'' if stats_exists else STATS_REBUILD_SQL}
+                {STATS_TRIGGERS_SQL}
+                COMMIT;
+            """)
+            
             conn.commit()
             conn.close()
             print("✅ 数据库初始化成功")
@@ -50,15 +133,56 @@ class DatabaseManager:
             print(f"❌ 数据库初始化失败: {e}")
             raise
     
+    def ping(self):
+        """健康探测：连接池上的只读 SELECT 1，不产生写入"""
+        return self.pool.ping()
+    
+    def close(self):
+        """关闭连接池"""
+        self.pool.close()
+    
+    def rebuild_stats(self):
+        """重建统计计数器（计数与数据不一致时使用）"""
+        try:
+            with self.pool.connection() as conn:
+                conn.executescript(f"BEGIN IMMEDIATE; {STATS_REBUILD_SQL} COMMIT;")
+            return True
+        except Exception as e:
+            print(f"❌ 重建统计失败: {e}")
+            return False
+    
+    def get_stats(self):
+        """获取脚本统计（读取触发器维护的计数器，与脚本数量无关）"""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT dimension, value, count FROM script_stats')
+                rows = cursor.fetchall()
+            
+            stats = {
+                'total_scripts': 0,
+                'favorite_scripts': 0,
+                'type_distribution': {},
+                'platform_distribution': {}
+            }
+            for dimension, value, count in rows:
+                if dimension == 'total':
+                    stats['total_scripts'] = count
+                elif dimension == 'favorite':
+                    stats['favorite_scripts'] = count
+                elif dimension == 'type':
+                    stats['type_distribution'][value] = count
+                elif dimension == 'platform':
+                    stats['platform_distribution'][value] = count
+            return stats
+        except Exception as e:
+            print(f"❌ 获取统计失败: {e}")
+            return None
+    
     def get_setting(self, key, default=None):
-        """获取设置"""
+        """获取设置（读内存缓存，数据库有变更时才重新加载）"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            result = cursor.fetchone()
-            conn.close()
-            return result[0] if result else default
+            return self.settings.get(key, default)
         except Exception as e:
             print(f"❌ 获取设置失败: {e}")
             return default
@@ -66,11 +190,11 @@ class DatabaseManager:
     def set_setting(self, key, value):
         """设置配置"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-            conn.commit()
-            conn.close()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+                conn.commit()
+            self.settings.invalidate()
             return True
         except Exception as e:
             print(f"❌ 设置配置失败: {e}")
@@ -79,16 +203,15 @@ class DatabaseManager:
     def get_all_scripts(self, limit=50):
         """获取所有脚本"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, theme, script_type, platform, content, is_favorite, created_at, metadata 
-                FROM scripts 
-                ORDER BY created_at DESC 
-                LIMIT ?
-            ''', (limit,))
-            results = cursor.fetchall()
-            conn.close()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, theme, script_type, platform, content, is_favorite, created_at, metadata 
+                    FROM scripts 
+                    ORDER BY created_at DESC 
+                    LIMIT ?
+                ''', (limit,))
+                results = cursor.fetchall()
             
             scripts = []
             for row in results:
@@ -97,7 +220,7 @@ class DatabaseManager:
                     'theme': row[1],
                     'script_type': row[2],
                     'platform': row[3],
-                    'content': row[4],
+                    'content': decode(row[4]),
                     'is_favorite': bool(row[5]),
                     'created_at': row[6],
                     'metadata': json.loads(row[7]) if row[7] else {}
@@ -107,19 +230,113 @@ class DatabaseManager:
             print(f"❌ 获取脚本失败: {e}")
             return []
     
+    def get_script_summaries(self, limit=50, before_created_at=None, before_id=None, favorites_only=False):
+        """获取脚本摘要列表（不含正文与元数据），按游标分页
+        
+        传入上一页最后一项的 created_at 与 id 获取下一页
+        """
+        try:
+            conditions = []
+            params = []
+            if favorites_only:
+                conditions.append('is_favorite = 1')
+            if before_created_at is not None and before_id is not None:
+                conditions.append('(created_at, id) < (?, ?)')
+                params.extend([before_created_at, before_id])
+            query = 'SELECT id, theme, script_type, platform, is_favorite, created_at FROM scripts'
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+            query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+            params.append(limit)
+            
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                results = cursor.fetchall()
+            
+            return [{
+                'id': row[0],
+                'theme': row[1],
+                'script_type': row[2],
+                'platform': row[3],
+                'is_favorite': bool(row[4]),
+                'created_at': row[5]
+            } for row in results]
+        except Exception as e:
+            print(f"❌ 获取脚本摘要失败: {e}")
+            return []
+    
+    def get_script(self, script_id):
+        """获取单个脚本（含正文与元数据）"""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, theme, script_type, platform, content, is_favorite, created_at, metadata 
+                    FROM scripts 
+                    WHERE id = ?
+                ''', (script_id,))
+                row = cursor.fetchone()
+            
+            if not row:
+                return None
+            return {
+                'id': row[0],
+                'theme': row[1],
+                'script_type': row[2],
+                'platform': row[3],
+                'content': decode(row[4]),
+                'is_favorite': bool(row[5]),
+                'created_at': row[6],
+                'metadata': json.loads(row[7]) if row[7] else {}
+            }
+        except Exception as e:
+            print(f"❌ 获取脚本失败: {e}")
+            return None
+    
+    def iter_scripts(self, script_ids, batch_size=50):
+        """按给定ID顺序逐个产出完整脚本（不存在的ID跳过）
+
+        每批 batch_size 条单独借用连接，查询完即归还，消费方再慢也不会长期占用连接池。
+        """
+        for start in range(0, len(script_ids), batch_size):
+            batch = script_ids[start:start + batch_size]
+            placeholders = ', '.join('?' * len(batch))
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT id, theme, script_type, platform, content, is_favorite, created_at, metadata 
+                    FROM scripts 
+                    WHERE id IN ({placeholders})
+                ''', batch)
+                rows = {row[0]: row for row in cursor.fetchall()}
+            for script_id in batch:
+                row = rows.pop(script_id, None)
+                if row is None:
+                    continue
+                yield {
+                    'id': row[0],
+                    'theme': row[1],
+                    'script_type': row[2],
+                    'platform': row[3],
+                    'content': decode(row[4]),
+                    'is_favorite': bool(row[5]),
+                    'created_at': row[6],
+                    'metadata': json.loads(row[7]) if row[7] else {}
+                }
+    
     def create_script(self, theme, script_type, platform, content, metadata=None):
         """创建脚本"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            metadata_json = json.dumps(metadata) if metadata else None
-            cursor.execute('''
-                INSERT INTO scripts (theme, script_type, platform, content, metadata)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (theme, script_type, platform, content, metadata_json))
-            script_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                metadata_json = json.dumps(metadata) if metadata else None
+                cursor.execute('''
+                    INSERT INTO scripts (theme, script_type, platform, content, metadata)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (theme, script_type, platform, encode(content), metadata_json))
+                script_id = cursor.lastrowid
+                conn.commit()
             return script_id
         except Exception as e:
             print(f"❌ 创建脚本失败: {e}")
@@ -128,29 +345,30 @@ class DatabaseManager:
     def update_script(self, script_id, **kwargs):
         """更新脚本"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
             
-            # 构建更新查询
-            update_fields = []
-            values = []
-            for key, value in kwargs.items():
-                if key in ['theme', 'script_type', 'platform', 'content', 'is_favorite', 'metadata']:
-                    if key == 'metadata' and isinstance(value, dict):
-                        value = json.dumps(value)
-                    update_fields.append(f"{key} = ?")
-                    values.append(value)
+                # 构建更新查询
+                update_fields = []
+                values = []
+                for key, value in kwargs.items():
+                    if key in ['theme', 'script_type', 'platform', 'content', 'is_favorite', 'metadata']:
+                        if key == 'metadata' and isinstance(value, dict):
+                            value = json.dumps(value)
+                        elif key == 'content':
+                            value = encode(value)
+                        update_fields.append(f"{key} = ?")
+                        values.append(value)
             
-            if not update_fields:
-                return False
+                if not update_fields:
+                    return False
             
-            values.append(script_id)
-            query = f"UPDATE scripts SET {', '.join(update_fields)} WHERE id = ?"
-            cursor.execute(query, values)
+                values.append(script_id)
+                query = f"UPDATE scripts SET {', '.join(update_fields)} WHERE id = ?"
+                cursor.execute(query, values)
             
-            conn.commit()
-            success = cursor.rowcount > 0
-            conn.close()
+                conn.commit()
+                success = cursor.rowcount > 0
             return success
         except Exception as e:
             print(f"❌ 更新脚本失败: {e}")
@@ -159,27 +377,44 @@ class DatabaseManager:
     def delete_script(self, script_id):
         """删除脚本"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM scripts WHERE id = ?', (script_id,))
-            success = cursor.rowcount > 0
-            conn.commit()
-            conn.close()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM scripts WHERE id = ?', (script_id,))
+                success = cursor.rowcount > 0
+                conn.commit()
             return success
         except Exception as e:
             print(f"❌ 删除脚本失败: {e}")
             return False
     
+    def compress_content(self, codec=None, batch_size=200):
+        """按批重写已有脚本正文的存储格式（codec 默认取 DB_COMPRESSION，False 为解压回文本）"""
+        return recompress_table(self.pool.connection, 'scripts', 'content', codec, batch_size)
+    
     def toggle_favorite(self, script_id):
         """切换收藏状态"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE scripts SET is_favorite = NOT is_favorite WHERE id = ?', (script_id,))
-            conn.commit()
-            success = cursor.rowcount > 0
-            conn.close()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('UPDATE scripts SET is_favorite = NOT is_favorite WHERE id = ?', (script_id,))
+                conn.commit()
+                success = cursor.rowcount > 0
             return success
         except Exception as e:
             print(f"❌ 切换收藏失败: {e}")
-            return False
\ No newline at end of file
+            return False
+
+
+# 每个数据库文件一个共享实例（建表/迁移只执行一次）
+_instances = {}
+_instances_lock = threading.Lock()
+
+def get_database(db_file=DB_FILE):
+    """获取指定数据库文件的共享 DatabaseManager"""
+    key = os.path.abspath(db_file)
+    with _instances_lock:
+        db = _instances.get(key)
+        if db is None:
+            db = DatabaseManager(db_file)
+            _instances[key] = db
+        return db
@@ -4,8 +4,8 @@ AI Director Assistant - API路由模块
 
 from flask import Blueprint, request, jsonify, current_app
 from app.utils.helpers import Utils, ValidationError, APIError
-from app.models.database import DatabaseManager
-import requests
+from app.models.database import DatabaseManager, get_database
+from upstream_client import upstream_client, UpstreamError, UpstreamTimeout
 import json
 
 api_bp = Blueprint('api', __name__)
@@ -15,7 +15,7 @@ def get_db():
     """获取数据库实例"""
     if 'database' in current_app.extensions:
         return current_app.extensions['database']
-    return DatabaseManager()
+    return get_database()
 
 @api_bp.route('/proxy', methods=['POST'])
 def proxy_to_dashscope():
@@ -48,29 +48,35 @@ def proxy_to_dashscope():
             'X-DashScope-Sync': 'enable'
         }
         
-        # 转发到DashScope API
-        response = requests.post(
+        # 转发到DashScope API（复用上游连接池）
+        response = upstream_client.request(
+            'POST',
             current_app.config['DASHSCOPE_API_URL'],
             headers=headers,
-            json=data,
-            timeout=30
+            body=data,
+            timeout=30,
+            raise_for_status=False
         )
         
         # 返回响应
-        return response.content, response.status_code, dict(response.headers)
+        content_type = response.headers.get('Content-Type', 'application/json')
+        return response.read(), response.status, {'Content-Type': content_type}
         
     except ValidationError as e:
         return Utils.create_error_response(str(e))
-    except requests.exceptions.Timeout:
+    except UpstreamTimeout:
         return Utils.create_error_response("请求超时")
-    except requests.exceptions.ConnectionError:
+    except UpstreamError:
         return Utils.create_error_response("网络连接失败")
-    except requests.exceptions.RequestException as e:
-        return Utils.create_error_response(f"API请求失败: {str(e)}")
     except Exception as e:
         Utils.log_error(e, "代理API请求")
         return Utils.create_error_response("服务器内部错误")
 
+@api_bp.route('/upstream/stats', methods=['GET'])
+def upstream_stats():
+    """上游连接池统计"""
+    return jsonify(Utils.create_success_response(upstream_client.stats()))
+
 @api_bp.route('/settings/apikey/check', methods=['GET'])
 def check_api_key():
     """检查API密钥状态"""
@@ -130,6 +136,22 @@ def get_scripts():
         Utils.log_error(e, "获取脚本列表")
         return Utils.create_error_response("获取失败")
 
+@api_bp.route('/scripts/<int:script_id>', methods=['GET'])
+def get_script(script_id):
+    """获取单个脚本（历史列表只返回摘要，打开时再加载正文）"""
+    try:
+        script = get_db().get_script(script_id)
+        if not script:
+            error_response = Utils.create_error_response("脚本不存在", 404)
+            return jsonify(error_response[0]), error_response[1]
+        
+        response = Utils.create_success_response(script)
+        return jsonify(response)
+        
+    except Exception as e:
+        Utils.log_error(e, "获取脚本")
+        return Utils.create_error_response("获取失败")
+
 @api_bp.route('/scripts', methods=['POST'])
 def create_script():
     """创建新脚本"""
@@ -263,7 +285,7 @@ def toggle_favorite(script_id):
 def health_check():
     """健康检查"""
     try:
-        health_status = Utils.check_backend_health()
+        health_status = Utils.check_backend_health(get_db())
         
         if health_status['status'] == 'healthy':
             response = Utils.create_success_response(health_status)
@@ -280,31 +302,12 @@ def health_check():
 def get_stats():
     """获取统计信息"""
     try:
-        # 获取所有脚本进行统计
-        scripts = get_db().get_all_scripts(10000)
-        
-        # 基础统计
-        total_scripts = len(scripts)
-        favorite_scripts = sum(1 for s in scripts if s.get('is_favorite', False))
-        
-        # 按类型统计
-        type_stats = {}
-        for script in scripts:
-            script_type = script.get('script_type', 'unknown')
-            type_stats[script_type] = type_stats.get(script_type, 0) + 1
-        
-        # 按平台统计
-        platform_stats = {}
-        for script in scripts:
-            platform = script.get('platform', 'unknown')
-            platform_stats[platform] = platform_stats.get(platform, 0) + 1
+        # 计数器由数据库触发器维护，无需加载脚本
+        stats = get_db().get_stats()
+        if stats is None:
+            return Utils.create_error_response("统计信息获取失败")
         
-        response = Utils.create_success_response({
-            'total_scripts': total_scripts,
-            'favorite_scripts': favorite_scripts,
-            'type_distribution': type_stats,
-            'platform_distribution': platform_stats
-        })
+        response = Utils.create_success_response(stats)
         return jsonify(response)
         
     except Exception as e:
@@ -314,17 +317,30 @@ def get_stats():
 # ===== 前端兼容路由 =====
 @api_bp.route('/history', methods=['GET'])
 def get_history():
-    """获取历史记录（前端兼容）"""
+    """获取历史记录（前端兼容）
+    
+    只返回摘要；用 before_created_at + before_id（上一页最后一项）翻页，
+    正文通过 GET /scripts/<id> 按需加载
+    """
     try:
-        scripts = get_db().get_all_scripts(limit=100)
+        limit = request.args.get('limit', 50, type=int)
+        if limit < 1 or limit > 200:
+            return Utils.create_error_response("limit参数必须在1-200之间")
+        
+        scripts = get_db().get_script_summaries(
+            limit=limit,
+            before_created_at=request.args.get('before_created_at'),
+            before_id=request.args.get('before_id', type=int),
+            favorites_only=request.args.get('favorites') in ('1', 'true')
+        )
         # 转换为前端期望的格式
         history = []
         for s in scripts:
             history.append({
                 'id': s.get('id'),
                 'theme': s.get('theme', ''),
-                'content': s.get('content', ''),
                 'created_at': s.get('created_at', ''),
+                'date': s.get('created_at', ''),
                 'is_favorite': s.get('is_favorite', False),
                 'script_type': s.get('script_type', ''),
                 'platform': s.get('platform', '')
@@ -8,15 +8,15 @@ from app.utils.validators import (
     handle_errors, validate_json_input, sanitize_input_data,
     validate_length, create_validation_error, require_api_key
 )
-from app.models.database import DatabaseManager
-import requests
+from app.models.database import DatabaseManager, get_database
+from upstream_client import upstream_client, UpstreamError, UpstreamTimeout
 import json
 import time
 
 api_bp = Blueprint('api', __name__)
 
 # 初始化数据库
-db = DatabaseManager()
+db = get_database()
 
 @api_bp.route('/proxy', methods=['POST'])
 @handle_errors
@@ -56,11 +56,13 @@ def proxy_to_dashscope():
     
     # 转发到DashScope API
     try:
-        response = requests.post(
+        response = upstream_client.request(
+            'POST',
             current_app.config['DASHSCOPE_API_URL'],
             headers=headers,
-            json=data,
-            timeout=30
+            body=data,
+            timeout=30,
+            raise_for_status=False
         )
         
         # 记录响应时间
@@ -68,8 +70,8 @@ def proxy_to_dashscope():
         current_app.logger.info(f"API调用完成，耗时: {response_time:.2f}s")
         
         # 检查响应状态
-        if response.status_code != 200:
-            error_msg = f"DashScope API返回错误: {response.status_code}"
+        if response.status != 200:
+            error_msg = f"DashScope API返回错误: {response.status}"
             try:
                 error_data = response.json()
                 if 'message' in error_data:
@@ -79,14 +81,13 @@ def proxy_to_dashscope():
             raise APIError(error_msg)
         
         # 返回响应
-        return response.content, response.status_code, dict(response.headers)
+        content_type = response.headers.get('Content-Type', 'application/json')
+        return response.read(), response.status, {'Content-Type': content_type}
         
-    except requests.exceptions.Timeout:
+    except UpstreamTimeout:
         raise APIError("请求超时，请稍后重试")
-    except requests.exceptions.ConnectionError:
-        raise APIError("网络连接失败，请检查网络连接")
-    except requests.exceptions.RequestException as e:
-        raise APIError(f"API请求失败: {str(e)}")
+    except UpstreamError as e:
+        raise APIError(f"网络连接失败，请检查网络连接: {str(e)}")
 
 @api_bp.route('/settings/apikey/check', methods=['GET'])
 @handle_errors
@@ -251,31 +252,12 @@ def health_check():
 def get_stats():
     """获取统计信息"""
     try:
-        # 获取所有脚本进行统计
-        scripts = db.get_all_scripts(10000)
+        # 计数器由数据库触发器维护，无需加载脚本
+        stats = db.get_stats()
+        if stats is None:
+            raise APIError("统计信息获取失败")
         
-        # 基础统计
-        total_scripts = len(scripts)
-        favorite_scripts = sum(1 for s in scripts if s.get('is_favorite', False))
-        
-        # 按类型统计
-        type_stats = {}
-        for script in scripts:
-            script_type = script.get('script_type', 'unknown')
-            type_stats[script_type] = type_stats.get(script_type, 0) + 1
-        
-        # 按平台统计
-        platform_stats = {}
-        for script in scripts:
-            platform = script.get('platform', 'unknown')
-            platform_stats[platform] = platform_stats.get(platform, 0) + 1
-        
-        response = Utils.create_success_response({
-            'total_scripts': total_scripts,
-            'favorite_scripts': favorite_scripts,
-            'type_distribution': type_stats,
-            'platform_distribution': platform_stats
-        })
+        response = Utils.create_success_response(stats)
         return jsonify(response)
         
     except Exception as e:
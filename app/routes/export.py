@@ -2,18 +2,64 @@
 AI Director Assistant - 导出功能模块
 """
 
-from flask import Blueprint, request, jsonify, current_app, send_file
+from flask import Blueprint, request, jsonify, current_app, send_file, Response, stream_with_context
 from app.utils.helpers import Utils, ValidationError
-from app.models.database import DatabaseManager
+from app.models.database import DatabaseManager, get_database
 from datetime import datetime
 import io
+import zipfile
 from docx import Document
 import json
 
 export_bp = Blueprint('export', __name__)
 
-# 初始化数据库
-db = DatabaseManager()
+# 单次批量导出的脚本数量上限
+MAX_BULK_EXPORT = 5000
+
+def get_db():
+    """获取数据库实例"""
+    if 'database' in current_app.extensions:
+        return current_app.extensions['database']
+    return get_database()
+
+def format_script_txt(script):
+    """脚本的纯文本导出格式"""
+    return f"""
+脚本ID: {script['id']}
+主题: {script['theme']}
+类型: {script['script_type']}
+平台: {script['platform']}
+创建时间: {script['created_at']}
+收藏: {'是' if script['is_favorite'] else '否'}
+
+内容:
+{script['content']}
+
+元数据:
+{json.dumps(script.get('metadata', {}), ensure_ascii=False, indent=2)}
+"""
+
+def format_script_json(script):
+    """脚本的JSON导出格式"""
+    return json.dumps(script, ensure_ascii=False, indent=2)
+
+class _ChunkBuffer:
+    """只写缓冲区：ZipFile 写入后由生成器取走已完成的字节"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
 
 @export_bp.route('/pdf', methods=['POST'])
 def export_pdf():
@@ -208,25 +254,18 @@ def export_json():
 def export_script(script_id):
     """导出指定脚本"""
     try:
-        # 获取脚本数据
-        scripts = db.get_all_scripts(100)  # 获取所有脚本
-        script = None
-        
-        for s in scripts:
-            if s['id'] == script_id:
-                script = s
-                break
+        # 按主键直接获取脚本
+        script = get_db().get_script(script_id)
         
         if not script:
-            return Utils.create_error_response("脚本不存在")
+            return Utils.create_error_response("脚本不存在", 404)
         
         # 构建导出格式
         format_type = request.args.get('format', 'json').lower()
         
         if format_type == 'json':
             buffer = io.BytesIO()
-            json_data = json.dumps(script, ensure_ascii=False, indent=2)
-            buffer.write(json_data.encode('utf-8'))
+            buffer.write(format_script_json(script).encode('utf-8'))
             buffer.seek(0)
             
             return send_file(
@@ -237,20 +276,7 @@ def export_script(script_id):
             )
         
         elif format_type == 'txt':
-            content = f"""
-脚本ID: {script['id']}
-主题: {script['theme']}
-类型: {script['script_type']}
-平台: {script['platform']}
-创建时间: {script['created_at']}
-收藏: {'是' if script['is_favorite'] else '否'}
-
-内容:
-{script['content']}
-
-元数据:
-{json.dumps(script.get('metadata', {}), ensure_ascii=False, indent=2)}
-"""
+            content = format_script_txt(script)
             
             buffer = io.BytesIO()
             buffer.write(content.encode('utf-8'))
@@ -270,4 +296,50 @@ def export_script(script_id):
         return Utils.create_error_response(str(e))
     except Exception as e:
         Utils.log_error(e, "导出脚本")
-        return Utils.create_error_response("导出失败")
\ No newline at end of file
+        return Utils.create_error_response("导出失败")
+
+@export_bp.route('/scripts', methods=['GET'])
+def export_scripts_bulk():
+    """批量导出脚本为ZIP（边查询边压缩边发送，不在内存中拼装整个压缩包）
+    
+    参数: ids=1,2,3  format=json|txt
+    """
+    try:
+        format_type = request.args.get('format', 'json').lower()
+        if format_type not in ('json', 'txt'):
+            return Utils.create_error_response("不支持的导出格式")
+        
+        try:
+            script_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+        except ValueError:
+            return Utils.create_error_response("ids参数格式错误")
+        if not script_ids:
+            return Utils.create_error_response("缺少ids参数")
+        if len(script_ids) > MAX_BULK_EXPORT:
+            return Utils.create_error_response(f"单次最多导出{MAX_BULK_EXPORT}个脚本")
+        script_ids = list(dict.fromkeys(script_ids))
+        
+        formatter = format_script_json if format_type == 'json' else format_script_txt
+        db = get_db()
+        
+        def generate():
+            buffer = _ChunkBuffer()
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for script in db.iter_scripts(script_ids):
+                    archive.writestr(f"script_{script['id']}.{format_type}",
+                                     formatter(script).encode('utf-8'))
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            yield buffer.drain()
+        
+        filename = f"scripts_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+        
+    except Exception as e:
+        Utils.log_error(e, "批量导出脚本")
+        return Utils.create_error_response("导出失败")
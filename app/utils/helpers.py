@@ -99,17 +99,23 @@ class Utils:
         return response
     
     @staticmethod
-    def check_backend_health():
-        """检查后端健康状态"""
+    def check_backend_health(db=None):
+        """检查后端健康状态
+        
+        Args:
+            db: 应用级 DatabaseManager（缺省时取共享实例），只做只读探测
+        """
         try:
-            # 检查数据库连接
-            from app.models.database import DatabaseManager
-            db = DatabaseManager()
-            db.get_setting('test')
+            # 检查数据库连接：连接池上执行 SELECT 1，不建表、不写库
+            if db is None:
+                from app.models.database import get_database
+                db = get_database()
+            pool_stats = db.ping()
             
             return {
                 'status': 'healthy',
                 'database': 'connected',
+                'pool': pool_stats,
                 'timestamp': datetime.now().isoformat()
             }
         except Exception as e:
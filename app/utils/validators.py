@@ -116,9 +116,11 @@ def require_api_key(f):
     """API密钥验证装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        from app.models.database import DatabaseManager
+        from flask import current_app
+        from app.models.database import get_database
         
-        db = DatabaseManager()
+        # 复用应用级数据库实例，设置从内存缓存读取
+        db = current_app.extensions.get('database') or get_database()
         api_key = db.get_setting('apikey')
         
         if not api_key:
@@ -0,0 +1,170 @@
+"""
+Content-addressed store for covers and other binary assets.
+
+Each blob is written once under ``<root>/<hash[:2]>/<hash>``, where hash is the
+SHA-256 of its bytes, so identical uploads share one file and a blob never
+changes after it is written. Rows refer to a blob by its hash only; the bytes
+are served by ``GET /api/blobs/<hash>`` with immutable caching headers.
+
+Thumbnails are optional: they need Pillow, and without it the original is
+served for every requested width.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Widths a client may ask for; anything else would let callers fill the disk with variants
+THUMBNAIL_WIDTHS = (128, 256, 512)
+BLOB_URL_PREFIX = '/api/blobs/'
+
+_HASH = re.compile(r'^[0-9a-f]{64}$')
+_DATA_URL = re.compile(r'^data:([\w.+-]+/[\w.+-]+)?(?:;[\w-]+=[^;,]*)*;base64,(.*)$', re.DOTALL)
+_BLOB_URL = re.compile(re.escape(BLOB_URL_PREFIX) + r'([0-9a-f]{64})(?:\?.*)?$')
+
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+
+def is_blob_hash(value):
+    return isinstance(value, str) and bool(_HASH.match(value))
+
+
+def sniff_content_type(data):
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.lstrip()[:5] in (b'<svg ', b'<?xml'):
+        return 'image/svg+xml'
+    return 'application/octet-stream'
+
+
+def decode_data_url(value):
+    """Bytes of a base64 ``data:`` URL, or None if ``value`` is not one"""
+    if not isinstance(value, str):
+        return None
+    match = _DATA_URL.match(value)
+    if not match:
+        return None
+    try:
+        return base64.b64decode(match.group(2), validate=False)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def blob_url(blob_hash, width=None):
+    url = BLOB_URL_PREFIX + blob_hash
+    return f"{url}?w={width}" if width else url
+
+
+def hash_from_url(value):
+    """The hash inside a ``/api/blobs/<hash>`` URL (as sent back by the frontend)"""
+    if not isinstance(value, str):
+        return None
+    match = _BLOB_URL.search(value)
+    return match.group(1) if match else None
+
+
+class BlobStore:
+    """Write-once blobs on disk, keyed by SHA-256"""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def path(self, blob_hash, width=None):
+        if not is_blob_hash(blob_hash):
+            raise ValueError(f"invalid blob hash: {blob_hash!r}")
+        if width:
+            return os.path.join(self.root, 'thumbs', blob_hash[:2], f"{blob_hash}-{int(width)}")
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def exists(self, blob_hash):
+        return is_blob_hash(blob_hash) and os.path.isfile(self.path(blob_hash))
+
+    def _write(self, path, data):
+        # Write to a temp file and rename, so a reader never sees a partial blob
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def put(self, data):
+        """Store ``data`` (a no-op if it is already there) and return its hash"""
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+        with self._lock:
+            if not os.path.isfile(path):
+                self._write(path, data)
+        return blob_hash
+
+    def put_data_url(self, value):
+        """Store a base64 data URL; None if ``value`` is not one"""
+        data = decode_data_url(value)
+        return None if data is None else self.put(data)
+
+    def read(self, blob_hash):
+        """(bytes, content_type), or None if the blob does not exist"""
+        if not self.exists(blob_hash):
+            return None
+        with open(self.path(blob_hash), 'rb') as f:
+            data = f.read()
+        return data, sniff_content_type(data)
+
+    def read_thumbnail(self, blob_hash, width):
+        """Like ``read``, scaled down to ``width`` pixels (cached next to the blobs)
+
+        Falls back to the original when Pillow is missing, the blob is not a
+        raster image, or it is already narrower than ``width``.
+        """
+        original = self.read(blob_hash)
+        if original is None or width not in THUMBNAIL_WIDTHS or Image is None:
+            return original
+        path = self.path(blob_hash, width)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            return data, sniff_content_type(data)
+
+        data, content_type = original
+        if content_type not in ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/bmp'):
+            return original
+        try:
+            with Image.open(BytesIO(data)) as image:
+                if image.width <= width:
+                    return original
+                image.thumbnail((width, width * 4))
+                out = BytesIO()
+                if content_type == 'image/jpeg' or image.mode not in ('RGBA', 'LA', 'P'):
+                    image.convert('RGB').save(out, 'JPEG', quality=85)
+                else:
+                    image.save(out, 'PNG', optimize=True)
+        except (OSError, ValueError):
+            return original
+        thumbnail = out.getvalue()
+        with self._lock:
+            self._write(path, thumbnail)
+        return thumbnail, sniff_content_type(thumbnail)
@@ -0,0 +1,51 @@
+"""
+压缩（或解压）已有数据库中的脚本与章节正文
+
+新写入的正文按 DB_COMPRESSION 编码；本工具把历史数据分批转换为同一格式，
+每批一个短事务，应用运行时也可以执行。转换完成后加 --vacuum 回收空间。
+
+    python compress_db.py scripts.db --codec zlib --vacuum
+"""
+
+import argparse
+import sqlite3
+import sys
+
+import db_manager
+from text_codec import active_codec
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分批压缩数据库中的正文字段")
+    parser.add_argument("db_file", nargs="?", default=db_manager.DB_FILE, help="数据库文件")
+    parser.add_argument("--codec", choices=["zlib", "zstd", "off"], default="zlib",
+                        help="目标编码，off 为全部解压回文本")
+    parser.add_argument("--batch-size", type=int, default=200, help="每个事务处理的行数")
+    parser.add_argument("--min-bytes", type=int, default=None, help="小于该字节数的正文不压缩")
+    parser.add_argument("--vacuum", action="store_true", help="完成后执行 VACUUM 回收空间")
+    args = parser.parse_args()
+
+    db_manager.DB_FILE = args.db_file
+    # 先执行迁移，保证全文索引已改为读取解压后的正文
+    db_manager.init_db()
+    codec = False if args.codec == "off" else active_codec(args.codec)
+    try:
+        summary = db_manager.db_compress_content(codec, args.batch_size, args.min_bytes)
+    finally:
+        db_manager.close_db()
+
+    for table, counts in summary.items():
+        ratio = counts['bytes_after'] / counts['bytes_before'] if counts['bytes_before'] else 1
+        print(f"{table}: {counts['rows']} 行，改写 {counts['rewritten']} 行，"
+              f"{counts['bytes_before']} → {counts['bytes_after']} 字节 ({ratio:.0%})")
+
+    if args.vacuum:
+        conn = sqlite3.connect(args.db_file)
+        conn.execute("VACUUM")
+        conn.close()
+        print("VACUUM 完成")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
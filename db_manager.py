@@ -2,6 +2,26 @@ import sqlite3
 import json
 import os
 import sys
+import re
+import html
+import logging
+import threading
+import hashlib
+import difflib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sqlite_pool import ConnectionPool, DB_POOL_SIZE
+from settings_cache import get_settings_cache, close_settings_caches
+from blob_store import BlobStore, blob_url, hash_from_url, is_blob_hash
+from json_patch import JsonPatchError, apply_patch
+from aho_corasick import AhoCorasick
+from retrieval import index_text, match_query, split_passages
+from prompt_context import estimate_tokens, pack_sections, truncate_to_tokens
+from text_codec import decode, encode, recompress_table, register_functions
+from write_buffer import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
 
 # Determine DB file path
 if getattr(sys, 'frozen', False):
@@ -11,8 +31,295 @@ else:
     # If running from source, store DB in current directory
     DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts.db")
 
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Pool for the current DB_FILE (rebuilt if DB_FILE is repointed)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_file != DB_FILE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_FILE)
+        return _pool
+
+def get_connection():
+    return get_pool().connection()
+
+_blob_store = None
+
+def get_blob_store():
+    """Blob directory for covers and other binary assets: BLOB_DIR, or blobs/ next to DB_FILE"""
+    global _blob_store
+    root = os.environ.get('BLOB_DIR') or os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), 'blobs')
+    with _pool_lock:
+        if _blob_store is None or _blob_store.root != root:
+            _blob_store = BlobStore(root)
+        return _blob_store
+
+def close_db():
+    global _pool, _save_buffer
+    # Buffered autosaves must reach the database before the pool goes away
+    if _save_buffer is not None:
+        _save_buffer.close()
+        _save_buffer = None
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    close_settings_caches()
+
+# --- Schema Migrations ---
+
+def _plain(column):
+    """SQL for the text of a body column; only compressed (BLOB) values go through dz_decompress()"""
+    return f"CASE WHEN typeof({column}) = 'blob' THEN dz_decompress({column}) ELSE {column} END"
+
+# Versioned schema steps, applied in order and recorded in PRAGMA user_version.
+# Append new steps; never edit one that has shipped.
+MIGRATIONS = [
+    (1, 'secondary indexes for history, novel and chapter listings', (
+        # History: ORDER BY created_at DESC, id DESC, optionally WHERE is_favorite = 1. Ascending, so a
+        # backward scan yields ties in descending rowid order (a DESC column would pair with ascending rowids)
+        'CREATE INDEX IF NOT EXISTS idx_scripts_created_at ON scripts(created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_scripts_favorite_created_at ON scripts(is_favorite, created_at)',
+        # Novel list: ORDER BY updated_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_novels_updated_at ON novels(updated_at DESC)',
+        # Chapter list: WHERE novel_id = ? ORDER BY order_index, id
+        'CREATE INDEX IF NOT EXISTS idx_chapters_novel_order ON chapters(novel_id, order_index, id)',
+    )),
+    (2, 'trigram full-text indexes over scripts and chapters, reading bodies through dz_decompress()', (
+        # External-content FTS5 tables: the text lives only in scripts/chapters, the triggers keep the
+        # index in step with every write. snippet() and 'rebuild' read the content table, which must yield
+        # plain text even for compressed bodies, so the indexes point at views that decompress
+        f"CREATE VIEW scripts_text AS SELECT id, theme, {_plain('content')} AS content, created_at FROM scripts",
+        "CREATE VIRTUAL TABLE scripts_fts USING fts5("
+        "theme, content, content='scripts_text', content_rowid='id', tokenize='trigram')",
+        f"""CREATE TRIGGER scripts_fts_insert AFTER INSERT ON scripts BEGIN
+            INSERT INTO scripts_fts(rowid, theme, content) VALUES (new.id, new.theme, {_plain('new.content')});
+        END""",
+        f"""CREATE TRIGGER scripts_fts_delete AFTER DELETE ON scripts BEGIN
+            INSERT INTO scripts_fts(scripts_fts, rowid, theme, content)
+            VALUES ('delete', old.id, old.theme, {_plain('old.content')});
+        END""",
+        # Re-encoding a body (compressing it) leaves the text, and so the index, unchanged
+        f"""CREATE TRIGGER scripts_fts_update AFTER UPDATE OF theme, content ON scripts
+        WHEN old.theme IS NOT new.theme OR {_plain('old.content')} IS NOT {_plain('new.content')} BEGIN
+            INSERT INTO scripts_fts(scripts_fts, rowid, theme, content)
+            VALUES ('delete', old.id, old.theme, {_plain('old.content')});
+            INSERT INTO scripts_fts(rowid, theme, content) VALUES (new.id, new.theme, {_plain('new.content')});
+        END""",
+        "INSERT INTO scripts_fts(scripts_fts) VALUES ('rebuild')",
+        f"CREATE VIEW chapters_text AS SELECT id, novel_id, title, {_plain('content')} AS content, "
+        "description, created_at FROM chapters",
+        "CREATE VIRTUAL TABLE chapters_fts USING fts5("
+        "title, content, description, content='chapters_text', content_rowid='id', tokenize='trigram')",
+        f"""CREATE TRIGGER chapters_fts_insert AFTER INSERT ON chapters BEGIN
+            INSERT INTO chapters_fts(rowid, title, content, description)
+            VALUES (new.id, new.title, {_plain('new.content')}, new.description);
+        END""",
+        f"""CREATE TRIGGER chapters_fts_delete AFTER DELETE ON chapters BEGIN
+            INSERT INTO chapters_fts(chapters_fts, rowid, title, content, description)
+            VALUES ('delete', old.id, old.title, {_plain('old.content')}, old.description);
+        END""",
+        f"""CREATE TRIGGER chapters_fts_update AFTER UPDATE OF title, content, description ON chapters
+        WHEN old.title IS NOT new.title OR old.description IS NOT new.description
+          OR {_plain('old.content')} IS NOT {_plain('new.content')} BEGIN
+            INSERT INTO chapters_fts(chapters_fts, rowid, title, content, description)
+            VALUES ('delete', old.id, old.title, {_plain('old.content')}, old.description);
+            INSERT INTO chapters_fts(rowid, title, content, description)
+            VALUES (new.id, new.title, {_plain('new.content')}, new.description);
+        END""",
+        "INSERT INTO chapters_fts(chapters_fts) VALUES ('rebuild')",
+    )),
+    (3, 'chapter revision history: periodic snapshots plus line deltas against them', (
+        # kind 'snapshot': data is the full text; kind 'delta': data is a JSON
+        # op list applied to the base_id snapshot (never to another delta)
+        """CREATE TABLE chapter_revisions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chapter_id INTEGER NOT NULL REFERENCES chapters(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL CHECK (kind IN ('snapshot', 'delta')),
+            base_id INTEGER REFERENCES chapter_revisions(id),
+            data BLOB,
+            content_hash TEXT NOT NULL,
+            content_length INTEGER NOT NULL,
+            word_count INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )""",
+        'CREATE INDEX idx_chapter_revisions_chapter ON chapter_revisions(chapter_id, id)',
+        'CREATE INDEX idx_chapter_revisions_base ON chapter_revisions(base_id)',
+    )),
+    (4, 'optimistic concurrency version on chapters for patch saves', (
+        'ALTER TABLE chapters ADD COLUMN version INTEGER NOT NULL DEFAULT 1',
+    )),
+    (5, 'characters, locations and factions from novels.extra_data as indexed rows', (
+        '''CREATE TABLE entities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER NOT NULL REFERENCES novels(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            source_id TEXT,
+            position INTEGER NOT NULL,
+            summary TEXT,
+            data TEXT NOT NULL
+        )''',
+        'CREATE INDEX idx_entities_novel ON entities(novel_id, kind, position)',
+        'CREATE INDEX idx_entities_name ON entities(name, kind)',
+    )),
+    (6, 'inverted index of entity names mentioned in chapters', (
+        'ALTER TABLE chapters ADD COLUMN mentions_key TEXT',
+        '''CREATE TABLE chapter_mentions (
+            chapter_id INTEGER NOT NULL REFERENCES chapters(id) ON DELETE CASCADE,
+            novel_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            positions TEXT NOT NULL,
+            PRIMARY KEY (chapter_id, name)
+        )''',
+        'CREATE INDEX idx_chapter_mentions_name ON chapter_mentions(novel_id, name)',
+    )),
+    (7, 'BM25 passage index over chapters for retrieval', (
+        'ALTER TABLE chapters ADD COLUMN passages_version INTEGER',
+        '''CREATE TABLE passages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER NOT NULL,
+            chapter_id INTEGER NOT NULL REFERENCES chapters(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            start_offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        )''',
+        'CREATE INDEX idx_passages_chapter ON passages(chapter_id, position)',
+        # passages only point into chapters.content, but FTS5 keeps its own copy of ``terms`` (the spaced-out
+        # text, ~1.7x the passage in UTF-8) next to the index. A contentless table (content='') would save
+        # that, but its rows can only be deleted given their original values, which are gone once a chapter
+        # is rewritten; contentless_delete=1 lifts that from SQLite 3.43, newer than many bundled sqlite3s.
+        "CREATE VIRTUAL TABLE passages_fts USING fts5(novel, terms)",
+        """CREATE TRIGGER passages_fts_delete AFTER DELETE ON passages BEGIN
+            DELETE FROM passages_fts WHERE rowid = old.id;
+        END""",
+    )),
+    (8, 'content-addressed chapter and merge summaries for the rolling summary tree', (
+        'ALTER TABLE chapters ADD COLUMN content_hash TEXT',
+        'ALTER TABLE novels ADD COLUMN summary_key TEXT',
+        '''CREATE TABLE summary_cache (
+            key TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE summary_nodes (
+            novel_id INTEGER NOT NULL REFERENCES novels(id) ON DELETE CASCADE,
+            level INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            first_chapter_id INTEGER NOT NULL,
+            last_chapter_id INTEGER NOT NULL,
+            chapters INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (novel_id, level, position)
+        )''',
+        'CREATE INDEX idx_summary_nodes_key ON summary_nodes(key)',
+    )),
+    (9, 'durable queue of batch chapter-generation jobs', (
+        '''CREATE TABLE generation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            novel_id INTEGER NOT NULL REFERENCES novels(id) ON DELETE CASCADE,
+            status TEXT NOT NULL DEFAULT 'queued',
+            first_index INTEGER NOT NULL,
+            last_index INTEGER NOT NULL,
+            next_index INTEGER NOT NULL,
+            prompt_template TEXT NOT NULL,
+            system_prompt TEXT,
+            model TEXT,
+            context_budget INTEGER NOT NULL,
+            overwrite BOOLEAN NOT NULL DEFAULT 0,
+            key_id TEXT NOT NULL,
+            auth_header TEXT,
+            generated INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_chapter_id INTEGER,
+            placeholder_chapter_id INTEGER,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )''',
+        'CREATE INDEX idx_generation_jobs_status ON generation_jobs(status, id)',
+        'CREATE INDEX idx_generation_jobs_novel ON generation_jobs(novel_id, id)',
+    )),
+]
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def apply_migrations(conn):
+    """Run every migration newer than the database's user_version, one transaction each"""
+    current = get_schema_version(conn)
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            conn.execute('BEGIN')
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.exception("Schema migration %d (%s) failed", version, description)
+            raise
+        logger.info("Applied schema migration %d: %s", version, description)
+        current = version
+    return current
+
+# History list columns: everything the sidebar shows, nothing it doesn't (no content/metadata)
+HISTORY_SUMMARY_COLUMNS = 'id, theme, script_type, platform, created_at, is_favorite'
+
+def _history_query(only_favorites=False, keyset=False):
+    """Newest-first history page; with keyset, rows strictly older than (created_at, id)"""
+    conditions = []
+    if only_favorites:
+        conditions.append('is_favorite = 1')
+    if keyset:
+        conditions.append('(created_at, id) < (?, ?)')
+    query = f'SELECT {HISTORY_SUMMARY_COLUMNS} FROM scripts'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query + ' ORDER BY created_at DESC, id DESC LIMIT ?'
+
+# Hot queries checked at startup: (name, sql, sample params)
+HOT_QUERIES = (
+    ('history', _history_query(), (50,)),
+    ('history_page', _history_query(keyset=True), ('2000-01-01 00:00:00', 1, 50)),
+    ('history_favorites', _history_query(only_favorites=True), (50,)),
+    ('history_favorites_page', _history_query(only_favorites=True, keyset=True), ('2000-01-01 00:00:00', 1, 50)),
+    ('novels', 'SELECT * FROM novels ORDER BY updated_at DESC', ()),
+    ('chapters', 'SELECT * FROM chapters WHERE novel_id = ? ORDER BY order_index ASC, id ASC', (1,)),
+    ('chapter_index', 'SELECT id FROM chapters WHERE novel_id = ? ORDER BY order_index ASC, id ASC', (1,)),
+    ('chapter_revisions', 'SELECT id FROM chapter_revisions WHERE chapter_id = ? ORDER BY id DESC', (1,)),
+    ('entities', 'SELECT id FROM entities WHERE novel_id = ? ORDER BY kind, position', (1,)),
+    ('entities_by_name', 'SELECT id FROM entities WHERE name = ? AND kind = ?', ('林默', 'character')),
+    ('chapter_mentions', 'SELECT chapter_id FROM chapter_mentions WHERE novel_id = ? AND name = ?', (1, '林默')),
+    ('passages', 'SELECT id FROM passages WHERE chapter_id = ?', (1,)),
+)
+
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)')
+
+def check_query_plans(conn):
+    """EXPLAIN QUERY PLAN each hot query; log and return the ones that scan or sort a whole table"""
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[-1]
+            if _FULL_SCAN.match(detail) or 'TEMP B-TREE' in detail:
+                problems.append((name, detail))
+                logger.warning("Query plan for %s uses a full scan or sort: %s", name, detail)
+    return problems
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = register_functions(sqlite3.connect(DB_FILE))
+    # WAL is persistent in the database file: readers no longer block the writer
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
     # Settings Table
     cursor.execute('''
@@ -86,240 +393,1645 @@ def init_db():
     ''')
 
     conn.commit()
+    schema_version = get_schema_version(conn)
+    apply_migrations(conn)
+    if schema_version < 5:
+        backfill_entities(conn)
+    migrate_cover_blobs(conn)
+    check_query_plans(conn)
     conn.close()
 
+    get_settings_cache(DB_FILE).load()
+
 def db_save_setting(key, value):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+        conn.commit()
+    get_settings_cache(DB_FILE).invalidate()
 
 def db_get_setting(key):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
+    # Served from memory; reloaded only when the database has changed
+    return get_settings_cache(DB_FILE).get(key)
 
 def db_save_script(theme, script_type, platform, content, script_id=None, metadata=None):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    if script_id:
-        cursor.execute('''
-        UPDATE scripts 
-        SET theme=?, script_type=?, platform=?, content=?, metadata=?, created_at=CURRENT_TIMESTAMP
-        WHERE id=?
-        ''', (theme, script_type, platform, content, metadata, script_id))
-        new_id = script_id
-    else:
-        cursor.execute('''
-        INSERT INTO scripts (theme, script_type, platform, content, metadata)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (theme, script_type, platform, content, metadata))
-        new_id = cursor.lastrowid
-        
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        if script_id:
+            cursor.execute('''
+            UPDATE scripts 
+            SET theme=?, script_type=?, platform=?, content=?, metadata=?, created_at=CURRENT_TIMESTAMP
+            WHERE id=?
+            ''', (theme, script_type, platform, encode(content), metadata, script_id))
+            new_id = script_id
+        else:
+            cursor.execute('''
+            INSERT INTO scripts (theme, script_type, platform, content, metadata)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (theme, script_type, platform, encode(content), metadata))
+            new_id = cursor.lastrowid
+
+        conn.commit()
     return new_id
 
-def db_get_history(limit=50, only_favorites=False):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    try:
-        query = 'SELECT id, theme, script_type, platform, created_at, is_favorite, content, metadata FROM scripts'
-        if only_favorites:
-            query += ' WHERE is_favorite = 1'
-        query += ' ORDER BY created_at DESC LIMIT ?'
-        cursor.execute(query, (limit,))
-        rows = cursor.fetchall()
-        has_metadata = True
-    except sqlite3.OperationalError:
-        query = 'SELECT id, theme, script_type, platform, created_at, is_favorite, content FROM scripts'
-        if only_favorites:
-            query += ' WHERE is_favorite = 1'
-        query += ' ORDER BY created_at DESC LIMIT ?'
-        cursor.execute(query, (limit,))
+def db_get_history(limit=50, only_favorites=False, before_created_at=None, before_id=None):
+    """One page of history summaries, newest first
+
+    Pass the date/id of the last item of a page as before_created_at/before_id
+    to get the next one. Full scripts are loaded per id with db_get_script.
+    """
+    keyset = before_created_at is not None and before_id is not None
+    params = (before_created_at, before_id, limit) if keyset else (limit,)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_history_query(only_favorites, keyset), params)
         rows = cursor.fetchall()
-        has_metadata = False
 
-    result = []
-    for r in rows:
+    return [{
+        'id': r[0], 'theme': r[1], 'type': r[2], 'platform': r[3],
+        'date': r[4], 'is_favorite': bool(r[5])
+    } for r in rows]
+
+def db_get_script(script_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, theme, script_type, platform, created_at, is_favorite, content, metadata '
+                       'FROM scripts WHERE id = ?', (script_id,))
+        r = cursor.fetchone()
+    if not r:
+        return None
+
+    item = {
+        'id': r[0], 'theme': r[1], 'type': r[2], 'platform': r[3],
+        'date': r[4], 'is_favorite': bool(r[5]), 'content': decode(r[6])
+    }
+    if r[7]:
+        try:
+            item['metadata'] = json.loads(r[7])
+        except ValueError:
+            item['metadata'] = {}
+    return item
+
+# --- Full-text Search ---
+
+# The trigram tokenizer only indexes runs of 3+ characters; shorter terms
+# (most two-character Chinese words) are matched with LIKE instead
+MIN_FTS_TERM = 3
+SNIPPET_TOKENS = 24
+_HL_START, _HL_END = '\x02', '\x03'
+
+# (kind, fts table, plain-text view, title column, searched columns, bm25 weights, extra select)
+SEARCH_SOURCES = {
+    'scripts': ('script', 'scripts_fts', 'scripts_text', 'theme', ('theme', 'content'), (5.0, 1.0),
+                'NULL AS novel_id'),
+    'chapters': ('chapter', 'chapters_fts', 'chapters_text', 'title', ('title', 'content', 'description'),
+                 (5.0, 1.0, 2.0), 'b.novel_id AS novel_id'),
+}
+
+def _fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+def _search_select(source, fts_terms, like_terms):
+    """SELECT for one source: ranked FTS hits, or a LIKE scan when no term is long enough"""
+    kind, fts, base, title_col, columns, weights, extra = SEARCH_SOURCES[source]
+    params = []
+    conditions = []
+    for term in like_terms:
+        conditions.append('(' + ' OR '.join(f"b.{col} LIKE ? ESCAPE '\\'" for col in columns) + ')')
+        params.extend([_like_pattern(term)] * len(columns))
+
+    if fts_terms:
+        conditions.insert(0, f'{fts} MATCH ?')
+        params.insert(0, ' '.join(_fts_phrase(t) for t in fts_terms))
+        snippet = f"snippet({fts}, -1, '{_HL_START}', '{_HL_END}', '…', {SNIPPET_TOKENS})"
+        rank = f"bm25({fts}, {', '.join(str(w) for w in weights)})"
+        source_sql = f'{fts} JOIN {base} b ON b.id = {fts}.rowid'
+        content = 'NULL'
+    else:
+        snippet = 'NULL'
+        rank = '0.0'
+        source_sql = f'{base} b'
+        content = 'b.content'
+
+    sql = (f"SELECT '{kind}' AS kind, b.id AS id, b.{title_col} AS title, b.created_at AS date, "
+           f"{extra}, {snippet} AS snippet, {content} AS content, {rank} AS rank "
+           f"FROM {source_sql} WHERE {' AND '.join(conditions)}")
+    return sql, params
+
+def _highlight(text):
+    return html.escape(text).replace(_HL_START, '<mark>').replace(_HL_END, '</mark>')
+
+def _like_snippet(content, terms, width=40):
+    """Excerpt around the first matching term, for hits that did not come from FTS"""
+    content = content or ''
+    lowered = content.lower()
+    positions = [(lowered.find(t.lower()), t) for t in terms]
+    positions = [(pos, t) for pos, t in positions if pos >= 0]
+    if not positions:
+        return html.escape(content[:width * 2])
+    pos, term = min(positions)
+    start = max(0, pos - width)
+    end = min(len(content), pos + len(term) + width)
+    excerpt = (content[start:pos] + _HL_START + content[pos:pos + len(term)] + _HL_END
+               + content[pos + len(term):end])
+    return ('…' if start > 0 else '') + _highlight(excerpt) + ('…' if end < len(content) else '')
+
+def db_search(query, kind='all', limit=20, offset=0):
+    """Ranked search over script themes/bodies and chapter titles/bodies/descriptions
+
+    Returns {'results': [...], 'has_more': bool}; each hit carries an HTML
+    snippet with the matched text wrapped in <mark>.
+    """
+    terms = query.split()
+    if not terms:
+        return {'results': [], 'has_more': False}
+    fts_terms = [t for t in terms if len(t) >= MIN_FTS_TERM]
+    like_terms = [t for t in terms if len(t) < MIN_FTS_TERM]
+    sources = list(SEARCH_SOURCES) if kind == 'all' else [kind]
+
+    selects = []
+    params = []
+    for source in sources:
+        sql, source_params = _search_select(source, fts_terms, like_terms)
+        selects.append(sql)
+        params.extend(source_params)
+    sql = ' UNION ALL '.join(selects) + ' ORDER BY rank, date DESC, id DESC LIMIT ? OFFSET ?'
+    params.extend([limit + 1, offset])
+
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(sql, params).fetchall()
+
+    results = []
+    for row in rows[:limit]:
         item = {
-            'id': r[0], 'theme': r[1], 'type': r[2], 'platform': r[3], 
-            'date': r[4], 'is_favorite': bool(r[5]), 'content': r[6]
+            'kind': row['kind'], 'id': row['id'], 'title': row['title'], 'date': row['date'],
+            'snippet': _highlight(row['snippet']) if row['snippet'] is not None
+                       else _like_snippet(row['content'], terms),
+            'rank': row['rank'],
         }
-        if has_metadata and r[7]:
-             try:
-                 item['metadata'] = json.loads(r[7])
-             except:
-                 item['metadata'] = {}
-        result.append(item)
-
-    conn.close()
-    return result
+        if row['kind'] == 'chapter':
+            item['novel_id'] = row['novel_id']
+        results.append(item)
+    return {'results': results, 'has_more': len(rows) > limit}
 
 def db_toggle_favorite(script_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # Get current
-    cursor.execute('SELECT is_favorite FROM scripts WHERE id = ?', (script_id,))
-    row = cursor.fetchone()
-    if row:
-        new_status = 0 if row[0] else 1
-        cursor.execute('UPDATE scripts SET is_favorite = ? WHERE id = ?', (new_status, script_id))
-        conn.commit()
-        conn.close()
-        return new_status
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Get current
+        cursor.execute('SELECT is_favorite FROM scripts WHERE id = ?', (script_id,))
+        row = cursor.fetchone()
+        if row:
+            new_status = 0 if row[0] else 1
+            cursor.execute('UPDATE scripts SET is_favorite = ? WHERE id = ?', (new_status, script_id))
+            conn.commit()
+            return new_status
     return 0
 
 def db_delete_script(script_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM scripts WHERE id = ?', (script_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM scripts WHERE id = ?', (script_id,))
+        conn.commit()
 
 # --- Novel Management Functions ---
 
+# Width of the cover served with the novel list (full size is one click away)
+COVER_LIST_WIDTH = 256
+
+def _store_cover(value):
+    """What novels.cover_image keeps: a blob hash for uploaded images, else the value as sent
+
+    Data URLs are moved into the blob store; /api/blobs/<hash> URLs coming back
+    from the frontend are reduced to their hash; external URLs stay as they are.
+    """
+    if not value or is_blob_hash(value):
+        return value
+    blob_hash = hash_from_url(value) or get_blob_store().put_data_url(value)
+    return blob_hash or value
+
+def _cover_url(novel, width=None):
+    if is_blob_hash(novel.get('cover_image')):
+        novel['cover_image'] = blob_url(novel['cover_image'], width)
+    return novel
+
+def migrate_cover_blobs(conn):
+    """Move covers still stored inline as data URLs into the blob store (one-off, idempotent)"""
+    rows = conn.execute("SELECT id, cover_image FROM novels WHERE cover_image LIKE 'data:%'").fetchall()
+    moved = 0
+    for novel_id, cover in rows:
+        blob_hash = get_blob_store().put_data_url(cover)
+        if blob_hash:
+            conn.execute('UPDATE novels SET cover_image = ? WHERE id = ?', (blob_hash, novel_id))
+            moved += 1
+    conn.commit()
+    if moved:
+        logger.info("Moved %d inline novel covers to the blob store", moved)
+    return moved
+
 def db_get_novels():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM novels ORDER BY updated_at DESC')
-    rows = cursor.fetchall()
-    novels = [dict(row) for row in rows]
-    conn.close()
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM novels ORDER BY updated_at DESC')
+        rows = cursor.fetchall()
+        novels = [_cover_url(_overlay_pending('novel', dict(row)), COVER_LIST_WIDTH) for row in rows]
     return novels
 
 def db_get_novel(novel_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM novels WHERE id = ?', (novel_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM novels WHERE id = ?', (novel_id,))
+        row = cursor.fetchone()
+    return _cover_url(_overlay_pending('novel', dict(row))) if row else None
 
-def db_save_novel(data):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    import json
-    extra_data = data.get('extra_data')
-    if isinstance(extra_data, (dict, list)):
-        extra_data = json.dumps(extra_data)
+def _novel_fields(data):
+    """Column values a save writes (the cover already reduced to a blob hash by _prepare_novel)"""
+    return {
+        'title': data.get('title'),
+        'description': data.get('description'),
+        'genre': data.get('genre'),
+        'cover_image': data.get('cover_image'),
+        'extra_data': data.get('extra_data'),
+        'rolling_summary': data.get('rolling_summary'),
+        'status': data.get('status', 'ongoing'),
+    }
+
+def _prepare_novel(data):
+    data = dict(data)
+    if isinstance(data.get('extra_data'), (dict, list)):
+        data['extra_data'] = json.dumps(data['extra_data'])
+    # Written before the transaction: an orphaned blob is harmless, a held write lock is not
+    data['cover_image'] = _store_cover(data.get('cover_image'))
+    return data
 
+def _write_novel(conn, data):
+    fields = _novel_fields(data)
+    cursor = conn.cursor()
     if 'id' in data and data['id']:
         cursor.execute('''
-        UPDATE novels 
+        UPDATE novels
         SET title=?, description=?, genre=?, cover_image=?, extra_data=?, rolling_summary=?, status=?, updated_at=CURRENT_TIMESTAMP
         WHERE id=?
-        ''', (
-            data.get('title'), 
-            data.get('description'), 
-            data.get('genre'), 
-            data.get('cover_image'), 
-            extra_data,
-            data.get('rolling_summary'),
-            data.get('status', 'ongoing'), 
-            data['id']
-        ))
+        ''', (*fields.values(), data['id']))
         novel_id = data['id']
     else:
         cursor.execute('''
         INSERT INTO novels (title, description, genre, cover_image, extra_data, rolling_summary, status)
         VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data.get('title'), 
-            data.get('description'), 
-            data.get('genre'), 
-            data.get('cover_image'), 
-            extra_data,
-            data.get('rolling_summary'),
-            data.get('status', 'ongoing')
-        ))
+        ''', tuple(fields.values()))
         novel_id = cursor.lastrowid
-        
-    conn.commit()
-    conn.close()
+    if cursor.rowcount > 0:
+        _sync_entities(conn, novel_id, fields['extra_data'])
+    return novel_id
+
+def db_save_novel(data):
+    data = _prepare_novel(data)
+    with get_connection() as conn:
+        novel_id = _write_novel(conn, data)
+        conn.commit()
     return novel_id
 
+# Novel columns a patch may set alongside the extra_data operations
+NOVEL_PATCH_FIELDS = ('title', 'description', 'genre', 'cover_image', 'rolling_summary', 'status')
+
+def db_patch_novel(novel_id, ops=None, fields=None):
+    """Apply RFC 6902 ``ops`` to a novel's extra_data and set ``fields``, without re-sending the rest
+
+    Returns {'id', 'extra_data_length'}, or None if the novel does not exist.
+    Raises JsonPatchTestFailed when a ``test`` operation fails (the document
+    moved on) and JsonPatchError (a ValueError) for a malformed patch.
+    """
+    fields = {key: value for key, value in (fields or {}).items() if key in NOVEL_PATCH_FIELDS}
+    if 'cover_image' in fields:
+        fields['cover_image'] = _store_cover(fields['cover_image'])
+    # A buffered full save is part of the document the client patched
+    _flush_pending('novel', novel_id)
+    with get_connection() as conn:
+        # Read-modify-write: hold the write lock from the read on
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT extra_data FROM novels WHERE id = ?', (novel_id,)).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        extra_data = row[0]
+        if ops:
+            try:
+                doc = json.loads(extra_data) if extra_data else {}
+            except ValueError:
+                raise JsonPatchError("stored extra_data is not JSON; save the novel in full")
+            doc = apply_patch(doc, ops)
+            extra_data = json.dumps(doc)
+            fields['extra_data'] = extra_data
+        if fields:
+            assignments = ', '.join(f'{key} = ?' for key in fields)
+            conn.execute(f'UPDATE novels SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                         (*fields.values(), novel_id))
+        if ops:
+            _sync_entities(conn, novel_id, doc)
+        conn.commit()
+    return {'id': novel_id, 'extra_data_length': len(extra_data or '')}
+
 def db_delete_novel(novel_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # Cascade delete chapters handled by FOREIGN KEY if enabled, but let's be safe
-    cursor.execute('DELETE FROM chapters WHERE novel_id = ?', (novel_id,))
-    cursor.execute('DELETE FROM novels WHERE id = ?', (novel_id,))
+    _discard_pending_save('novel', novel_id)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Chapters cascade through the foreign key; delete explicitly for databases created without it
+        cursor.execute('DELETE FROM chapters WHERE novel_id = ?', (novel_id,))
+        cursor.execute('DELETE FROM entities WHERE novel_id = ?', (novel_id,))
+        cursor.execute('DELETE FROM summary_nodes WHERE novel_id = ?', (novel_id,))
+        cursor.execute('DELETE FROM generation_jobs WHERE novel_id = ?', (novel_id,))
+        cursor.execute('DELETE FROM novels WHERE id = ?', (novel_id,))
+        conn.commit()
+
+# --- Novel Entities ---
+
+# extra_data lists mirrored into the entities table: list key -> (name field, summary field)
+ENTITY_SOURCES = {
+    'characters': ('name', 'role'),
+    'worldSettings': ('title', 'description'),
+    'events': ('title', 'description'),
+}
+# worldSettings categories that get their own kind; the rest keep their category name
+WORLD_SETTING_KINDS = {'geography': 'location', 'politics': 'faction'}
+ENTITY_SUMMARY_CHARS = 200
+ENTITY_SUMMARY_COLUMNS = ('id', 'novel_id', 'kind', 'name', 'source_id', 'position', 'summary')
+
+def _parse_extra_data(value):
+    if isinstance(value, (dict, list)) or value is None:
+        return value
+    try:
+        return json.loads(value) if value else None
+    except ValueError:
+        return None
+
+def _entity_kind(source, item):
+    if source == 'characters':
+        return 'character'
+    if source == 'events':
+        return 'event'
+    category = item.get('category') or 'setting'
+    return WORLD_SETTING_KINDS.get(category, str(category))
+
+def _entity_rows(extra_data):
+    """(kind, name, source_id, position, summary, data) for every named item in extra_data"""
+    doc = _parse_extra_data(extra_data)
+    if not isinstance(doc, dict):
+        return []
+    rows = []
+    for source, (name_field, summary_field) in ENTITY_SOURCES.items():
+        items = doc.get(source)
+        if not isinstance(items, list):
+            continue
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            name = str(item.get(name_field) or '').strip()
+            if not name:
+                continue
+            summary = item.get(summary_field)
+            rows.append((
+                _entity_kind(source, item), name,
+                None if item.get('id') is None else str(item['id']), position,
+                None if summary is None else str(summary)[:ENTITY_SUMMARY_CHARS],
+                json.dumps(item, ensure_ascii=False, sort_keys=True),
+            ))
+    return rows
+
+def _sync_entities(conn, novel_id, extra_data):
+    """Bring a novel's entity rows in line with its extra_data, touching only rows that changed"""
+    wanted = _entity_rows(extra_data)
+    existing = {}
+    for row in conn.execute('SELECT id, kind, name, source_id, position, summary, data FROM entities '
+                            'WHERE novel_id = ?', (novel_id,)):
+        existing.setdefault(tuple(row[1:]), []).append(row[0])
+    inserts = []
+    for row in wanted:
+        ids = existing.get(row)
+        if ids:
+            ids.pop()
+        else:
+            inserts.append(row)
+    stale = [(entity_id,) for ids in existing.values() for entity_id in ids]
+    if stale:
+        conn.executemany('DELETE FROM entities WHERE id = ?', stale)
+    if inserts:
+        conn.executemany('INSERT INTO entities (novel_id, kind, name, source_id, position, summary, data) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)', [(novel_id, *row) for row in inserts])
+    return len(stale) + len(inserts)
+
+def backfill_entities(conn):
+    """Index the entities of every existing novel (run once, when the entities table is created)"""
+    synced = 0
+    for novel_id, extra_data in conn.execute('SELECT id, extra_data FROM novels WHERE extra_data IS NOT NULL').fetchall():
+        _sync_entities(conn, novel_id, extra_data)
+        synced += 1
     conn.commit()
-    conn.close()
+    return synced
+
+def _entity(row, with_data=False):
+    entity = dict(row)
+    if with_data:
+        entity['data'] = _parse_extra_data(entity['data'])
+    return entity
+
+def db_list_entities(novel_id, kind=None):
+    """A novel's entities in extra_data order (without the full item), optionally of one kind"""
+    query = f'SELECT {", ".join(ENTITY_SUMMARY_COLUMNS)} FROM entities WHERE novel_id = ?'
+    params = [novel_id]
+    if kind:
+        query += ' AND kind = ?'
+        params.append(kind)
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(query + ' ORDER BY kind, position', params).fetchall()
+    return [_entity(row) for row in rows]
+
+def db_find_entities(name, kind=None, novel_id=None):
+    """Entities called ``name`` across all novels (or one), with the novel title"""
+    query = (f'SELECT {", ".join("e." + column for column in ENTITY_SUMMARY_COLUMNS)}, '
+             'n.title AS novel_title FROM entities e JOIN novels n ON n.id = e.novel_id WHERE e.name = ?')
+    params = [name]
+    if kind:
+        query += ' AND e.kind = ?'
+        params.append(kind)
+    if novel_id is not None:
+        query += ' AND e.novel_id = ?'
+        params.append(novel_id)
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(query + ' ORDER BY e.novel_id, e.kind, e.position', params).fetchall()
+    return [_entity(row) for row in rows]
+
+def db_get_entity(entity_id):
+    """One entity including its full extra_data item"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(f'SELECT {", ".join(ENTITY_SUMMARY_COLUMNS)}, data FROM entities WHERE id = ?',
+                           (entity_id,)).fetchone()
+    return _entity(row, with_data=True) if row else None
 
 # --- Chapter Management Functions ---
 
+# Everything the chapter sidebar needs; bodies are fetched per chapter
+CHAPTER_INDEX_COLUMNS = ('id', 'novel_id', 'title', 'order_index', 'word_count', 'status', 'version', 'updated_at')
+CHAPTER_BATCH_SIZE = 20
+
+def db_get_chapter_index(novel_id):
+    """Chapter outline (no content/description) in reading order"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(CHAPTER_INDEX_COLUMNS)} FROM chapters "
+                       'WHERE novel_id = ? ORDER BY order_index ASC, id ASC', (novel_id,))
+        return [_overlay_pending('chapter', dict(row)) for row in cursor.fetchall()]
+
+def _chapter(row):
+    chapter = dict(row)
+    chapter['content'] = decode(chapter['content'])
+    return _overlay_pending('chapter', chapter)
+
+def db_iter_chapters(novel_id, batch_size=CHAPTER_BATCH_SIZE):
+    """Yield full chapters in reading order, a few bodies at a time
+
+    Only the id list is read up front; bodies are loaded ``batch_size`` rows
+    per pooled connection, so a slow consumer never pins a connection nor
+    holds every body in memory at once.
+    """
+    with get_connection() as conn:
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM chapters WHERE novel_id = ? ORDER BY order_index ASC, id ASC', (novel_id,))]
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                f"SELECT * FROM chapters WHERE id IN ({', '.join('?' * len(batch))})", batch).fetchall()
+        by_id = {row['id']: _chapter(row) for row in rows}
+        for chapter_id in batch:
+            # Deleted between the two reads
+            if chapter_id in by_id:
+                yield by_id[chapter_id]
+
 def db_get_chapters(novel_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM chapters WHERE novel_id = ? ORDER BY order_index ASC, id ASC', (novel_id,))
-    rows = cursor.fetchall()
-    chapters = [dict(row) for row in rows]
-    conn.close()
-    return chapters
+    return list(db_iter_chapters(novel_id))
 
 def db_get_chapter(chapter_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM chapters WHERE id = ?', (chapter_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM chapters WHERE id = ?', (chapter_id,))
+        row = cursor.fetchone()
+    return _chapter(row) if row else None
 
-def db_save_chapter(data):
-    conn = sqlite3.connect(DB_FILE)
+def db_get_chapter_version(chapter_id):
+    """Current ``version`` of a chapter (counting a buffered save), or None"""
+    with get_connection() as conn:
+        row = conn.execute('SELECT version FROM chapters WHERE id = ?', (chapter_id,)).fetchone()
+    if row is None:
+        return None
+    return row[0] + (1 if _pending_save('chapter', chapter_id) is not None else 0)
+
+def db_get_chapter_novel_id(chapter_id):
+    with get_connection() as conn:
+        row = conn.execute('SELECT novel_id FROM chapters WHERE id = ?', (chapter_id,)).fetchone()
+    return row[0] if row else None
+
+def db_get_chapter_range(chapter_id, offset=0, length=None):
+    """Chapter with ``content`` cut to ``length`` characters from ``offset``, plus ``total_length``; None if missing
+
+    substr() slices the decompressed body in SQLite, so only that part of a long chapter leaves the database.
+    """
+    offset = max(int(offset), 0)
+    # substr() with a negative length counts backwards, so "to the end" is -1 => length(content)
+    length = -1 if length is None else max(int(length), 0)
+    columns = ', '.join(CHAPTER_INDEX_COLUMNS)
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        # MATERIALIZED: inflate a compressed body once, not once per reference to it
+        row = conn.execute(
+            f"WITH c AS MATERIALIZED (SELECT {columns}, description, {_plain('content')} AS body "
+            'FROM chapters WHERE id = ?) '
+            f"SELECT {columns}, description, "
+            'substr(body, ? + 1, CASE WHEN ? < 0 THEN length(body) ELSE ? END) AS content, '
+            'length(body) AS total_length FROM c',
+            (chapter_id, offset, length, length)).fetchone()
+    if row is None:
+        return None
+    chapter = dict(row)
+    pending = _pending_save('chapter', chapter_id)
+    if pending is not None:
+        # Buffered autosave: slice the pending text instead
+        _overlay_pending('chapter', chapter)
+        body = pending.get('content') or ''
+        chapter['content'] = body[offset:] if length < 0 else body[offset:offset + length]
+        chapter['total_length'] = len(body)
+    chapter['total_length'] = chapter['total_length'] or 0
+    chapter['offset'] = min(offset, chapter['total_length'])
+    return chapter
+
+def _chapter_fields(data):
+    """Column values a save writes (content as plain text)"""
+    return {
+        'title': data.get('title'),
+        'content': data.get('content'),
+        'description': data.get('description'),
+        'word_count': data.get('word_count'),
+        'status': data.get('status', 'draft'),
+        'order_index': data.get('order_index', 0),
+    }
+
+def _chapter_written(conn, chapter_id, content, word_count=None, novel_id=None):
+    """Bookkeeping after a chapter's text changed, in the same transaction as the write"""
+    _record_revision(conn, chapter_id, content, word_count)
+    conn.execute('UPDATE chapters SET content_hash = ? WHERE id = ?', (_content_hash(content), chapter_id))
+    if novel_id is None:
+        row = conn.execute('SELECT novel_id FROM chapters WHERE id = ?', (chapter_id,)).fetchone()
+        novel_id = row[0] if row else None
+    if novel_id is not None:
+        _index_mentions(conn, chapter_id, content, novel_id)
+        _index_passages(conn, chapter_id, content, novel_id)
+
+def _write_chapter(conn, data):
+    fields = _chapter_fields(data)
+    values = tuple(encode(value) if key == 'content' else value for key, value in fields.items())
     cursor = conn.cursor()
-    
     if 'id' in data and data['id']:
         cursor.execute('''
-        UPDATE chapters 
-        SET title=?, content=?, description=?, word_count=?, status=?, order_index=?, updated_at=CURRENT_TIMESTAMP
+        UPDATE chapters
+        SET title=?, content=?, description=?, word_count=?, status=?, order_index=?,
+            version=version + 1, updated_at=CURRENT_TIMESTAMP
         WHERE id=?
-        ''', (
-            data.get('title'), 
-            data.get('content'), 
-            data.get('description'), 
-            data.get('word_count'), 
-            data.get('status', 'draft'),
-            data.get('order_index', 0),
-            data['id']
-        ))
-        chapter_id = data['id']
+        ''', (*values, data['id']))
+        chapter_id, novel_id = data['id'], None
     else:
         cursor.execute('''
         INSERT INTO chapters (novel_id, title, content, description, word_count, status, order_index)
         VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data.get('novel_id'), 
-            data.get('title'), 
-            data.get('content'), 
-            data.get('description'), 
-            data.get('word_count'), 
-            data.get('status', 'draft'),
-            data.get('order_index', 0)
-        ))
-        chapter_id = cursor.lastrowid
-        
-    conn.commit()
-    conn.close()
+        ''', (data.get('novel_id'), *values))
+        chapter_id, novel_id = cursor.lastrowid, data.get('novel_id')
+
+    if cursor.rowcount > 0 and fields['content'] is not None:
+        _chapter_written(conn, chapter_id, fields['content'], fields['word_count'], novel_id)
+    return chapter_id
+
+def db_save_chapter(data):
+    with get_connection() as conn:
+        chapter_id = _write_chapter(conn, data)
+        conn.commit()
     return chapter_id
 
 def db_delete_chapter(chapter_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM chapters WHERE id = ?', (chapter_id,))
-    conn.commit()
-    conn.close()
+    _discard_pending_save('chapter', chapter_id)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM chapters WHERE id = ?', (chapter_id,))
+        conn.commit()
+
+# --- Write-behind Autosave ---
+
+# Autosaves of the same chapter/novel within this many seconds become one write (0 = write through)
+SAVE_COALESCE_WINDOW = float(os.getenv('SAVE_COALESCE_WINDOW', '2'))
+
+_save_buffer = None
+
+def get_save_buffer():
+    global _save_buffer
+    with _pool_lock:
+        if _save_buffer is None:
+            _save_buffer = WriteBehindBuffer(_flush_saves, SAVE_COALESCE_WINDOW)
+        return _save_buffer
+
+def _flush_saves(items):
+    """Write a batch of coalesced saves in one transaction"""
+    with get_connection() as conn:
+        for (kind, _), data in items:
+            if kind == 'novel':
+                _write_novel(conn, data)
+            else:
+                _write_chapter(conn, data)
+        conn.commit()
+
+def _pending_save(kind, record_id):
+    buffer = _save_buffer
+    return buffer.get((kind, int(record_id))) if buffer is not None else None
+
+def _discard_pending_save(kind, record_id):
+    if _save_buffer is not None:
+        _save_buffer.discard((kind, int(record_id)))
+
+def _flush_pending(kind, record_id):
+    """Write the buffered save of one record, if any, so the database has its latest text"""
+    if _save_buffer is not None:
+        _save_buffer.flush([(kind, int(record_id))])
+
+def _flush_novel_saves(novel_id):
+    """Write the buffered saves of a novel and its chapters; other novels' saves stay queued"""
+    buffer = _save_buffer
+    if buffer is None:
+        return
+    keys = [('novel', int(novel_id))]
+    pending = {}
+    for kind, record_id in buffer.keys():
+        data = buffer.get((kind, record_id)) if kind == 'chapter' else None
+        if data is not None:
+            pending[record_id] = data
+    if pending:
+        with get_connection() as conn:
+            ids = list(pending)
+            rows = conn.execute(f'SELECT id FROM chapters WHERE novel_id = ? AND id IN ({",".join("?" * len(ids))})',
+                                [novel_id] + ids).fetchall()
+        ours = {row[0] for row in rows}
+        keys += [('chapter', record_id) for record_id, data in pending.items()
+                 if record_id in ours or str(data.get('novel_id')) == str(novel_id)]
+    buffer.flush(keys)
+
+def _overlay_pending(kind, record):
+    """Read-your-writes: apply a save that is still buffered to a row read from the database"""
+    data = _pending_save(kind, record['id'])
+    if data is not None:
+        fields = _novel_fields(data) if kind == 'novel' else _chapter_fields(data)
+        record.update((key, value) for key, value in fields.items() if key in record)
+        if 'version' in record:
+            # The buffered save bumps the version once when it is written
+            record['version'] += 1
+    return record
+
+def _check_save(kind, data):
+    """Reject what the database would refuse now, so a bad save fails its own request instead of a later batch"""
+    fields = _novel_fields(data) if kind == 'novel' else _chapter_fields(data)
+    for name, value in fields.items():
+        if value is not None and not isinstance(value, (str, int, float)):
+            raise ValueError(f"{kind} {name} must be a string or a number")
+    if kind == 'chapter' and not isinstance(fields['content'], (str, type(None))):
+        raise ValueError("chapter content must be a string")
+
+def _queue_save(kind, data, write, flush):
+    if not data.get('id') or SAVE_COALESCE_WINDOW <= 0:
+        # New rows need their id now
+        record_id = write(data)
+    else:
+        record_id = data['id']
+        _check_save(kind, data)
+        get_save_buffer().put((kind, int(record_id)), data)
+    if flush:
+        _flush_pending(kind, record_id)
+    return record_id
+
+def db_queue_save_novel(data, flush=False):
+    """Buffered db_save_novel; ``flush`` writes it before returning. ValueError for a malformed save"""
+    return _queue_save('novel', _prepare_novel(data), db_save_novel, flush)
+
+def db_queue_save_chapter(data, flush=False):
+    """Buffered db_save_chapter; ``flush`` writes it before returning. ValueError for a malformed save"""
+    return _queue_save('chapter', dict(data), db_save_chapter, flush)
+
+def db_flush_saves():
+    return _save_buffer.flush() if _save_buffer is not None else 0
+
+# --- Chapter Patches ---
+
+class ChapterConflict(Exception):
+    """The chapter changed since the version/hash a patch was made against"""
+
+    def __init__(self, version, content_hash):
+        super().__init__(f"chapter is at version {version}")
+        self.version = version
+        self.content_hash = content_hash
+
+def _content_hash(text):
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+def apply_text_patch(text, ops):
+    """Apply ``[[offset, delete_count, insert], ...]`` (code point offsets into ``text``, ascending)"""
+    parts = []
+    cursor = 0
+    for op in ops:
+        if not (isinstance(op, (list, tuple)) and len(op) == 3):
+            raise ValueError("each op must be [offset, delete_count, insert]")
+        offset, delete_count, insert = op
+        if not (isinstance(offset, int) and isinstance(delete_count, int) and isinstance(insert, str)):
+            raise ValueError("each op must be [offset, delete_count, insert]")
+        if offset < cursor or delete_count < 0 or offset + delete_count > len(text):
+            raise ValueError("ops must be ascending, non-overlapping and inside the base text")
+        parts.append(text[cursor:offset])
+        parts.append(insert)
+        cursor = offset + delete_count
+    parts.append(text[cursor:])
+    return ''.join(parts)
+
+# Chapter columns a patch may set alongside the text edit
+PATCH_FIELDS = ('title', 'description', 'word_count', 'status', 'order_index')
+
+def db_patch_chapter(chapter_id, ops, base_version=None, base_hash=None, fields=None, result_hash=None):
+    """Apply a text patch to a chapter if it is still at ``base_version`` / ``base_hash``
+
+    Returns {'id', 'novel_id', 'version', 'hash'}, or None if the chapter does not exist.
+    Raises ChapterConflict when the base does not match and ValueError for a
+    malformed patch or one that does not produce ``result_hash``.
+    """
+    if base_version is None and base_hash is None:
+        raise ValueError("base_version or base_hash is required")
+    fields = {key: value for key, value in (fields or {}).items() if key in PATCH_FIELDS}
+    # A buffered full save of this chapter is part of the base the client saw
+    _flush_pending('chapter', chapter_id)
+    with get_connection() as conn:
+        row = conn.execute('SELECT content, version, novel_id FROM chapters WHERE id = ?', (chapter_id,)).fetchone()
+        if row is None:
+            return None
+        text, version, novel_id = decode(row[0]) or '', row[1], row[2]
+        current_hash = _content_hash(text)
+        if (base_version is not None and base_version != version) or \
+                (base_hash is not None and base_hash != current_hash):
+            raise ChapterConflict(version, current_hash)
+
+        text = apply_text_patch(text, ops)
+        new_hash = _content_hash(text)
+        if result_hash is not None and result_hash != new_hash:
+            raise ValueError("patch does not produce the expected text")
+        assignments = ''.join(f', {key} = ?' for key in fields)
+        cursor = conn.execute(
+            f'UPDATE chapters SET content = ?{assignments}, version = version + 1, '
+            'updated_at = CURRENT_TIMESTAMP WHERE id = ? AND version = ?',
+            (encode(text), *fields.values(), chapter_id, version))
+        if cursor.rowcount == 0:
+            # Another writer committed between our read and write
+            conn.rollback()
+            raise ChapterConflict(version + 1, None)
+        _chapter_written(conn, chapter_id, text, fields.get('word_count'), novel_id)
+        conn.commit()
+    return {'id': chapter_id, 'novel_id': novel_id, 'version': version + 1, 'hash': new_hash}
+
+# --- Chapter Revisions ---
+
+# A full snapshot every N revisions bounds a restore to one snapshot + one delta
+REVISION_SNAPSHOT_EVERY = 20
+# Thinning: keep the newest N outright, then one per hour for HOURLY_DAYS, then one per day
+REVISION_KEEP_RECENT = 50
+REVISION_HOURLY_DAYS = 7
+
+REVISION_SUMMARY_COLUMNS = 'id, chapter_id, kind, content_length, word_count, created_at'
+
+def _line_delta(base, text):
+    """Ops rebuilding ``text`` from ``base``: [start, end] copies base lines, a string is inserted"""
+    a = base.splitlines(keepends=True)
+    b = text.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return ops
+
+def _apply_delta(base, ops):
+    lines = base.splitlines(keepends=True)
+    return ''.join(''.join(lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+def _revision_content(conn, revision_id):
+    row = conn.execute('SELECT kind, base_id, data FROM chapter_revisions WHERE id = ?', (revision_id,)).fetchone()
+    if row is None:
+        return None
+    kind, base_id, data = row
+    if kind == 'snapshot':
+        return decode(data)
+    base = conn.execute('SELECT data FROM chapter_revisions WHERE id = ?', (base_id,)).fetchone()[0]
+    return _apply_delta(decode(base), json.loads(decode(data)))
+
+def _record_revision(conn, chapter_id, content, word_count=None):
+    """Append a revision unless the text is unchanged; thins the history when a snapshot is taken"""
+    content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    last = conn.execute('SELECT content_hash FROM chapter_revisions WHERE chapter_id = ? ORDER BY id DESC LIMIT 1',
+                        (chapter_id,)).fetchone()
+    if last and last[0] == content_hash:
+        return None
+
+    base = conn.execute("SELECT id, data FROM chapter_revisions WHERE chapter_id = ? AND kind = 'snapshot' "
+                        'ORDER BY id DESC LIMIT 1', (chapter_id,)).fetchone()
+    kind, base_id, data = 'snapshot', None, content
+    if base is not None:
+        since = conn.execute('SELECT COUNT(*) FROM chapter_revisions WHERE chapter_id = ? AND id > ?',
+                             (chapter_id, base[0])).fetchone()[0]
+        if since < REVISION_SNAPSHOT_EVERY - 1:
+            delta = json.dumps(_line_delta(decode(base[1]), content), ensure_ascii=False)
+            # A rewrite is cheaper to store (and to restore) as a new snapshot
+            if len(delta) < len(content) / 2:
+                kind, base_id, data = 'delta', base[0], delta
+
+    cursor = conn.execute(
+        'INSERT INTO chapter_revisions (chapter_id, kind, base_id, data, content_hash, content_length, word_count) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (chapter_id, kind, base_id, encode(data), content_hash, len(content), word_count))
+    if kind == 'snapshot' and base is not None:
+        _thin_revisions(conn, chapter_id)
+    return cursor.lastrowid
+
+def _thin_revisions(conn, chapter_id, now=None):
+    """Apply the retention policy to one chapter; snapshots still used by a kept delta survive"""
+    now = now or datetime.now(timezone.utc)
+    rows = conn.execute('SELECT id, base_id, created_at FROM chapter_revisions WHERE chapter_id = ? ORDER BY id DESC',
+                        (chapter_id,)).fetchall()
+    keep = set()
+    buckets = set()
+    hourly_since = now - timedelta(days=REVISION_HOURLY_DAYS)
+    for position, (revision_id, _, created_at) in enumerate(rows):
+        if position < REVISION_KEEP_RECENT:
+            keep.add(revision_id)
+            continue
+        # Newest revision of each hour (recent week) or day (older) survives
+        # CURRENT_TIMESTAMP is UTC
+        created = datetime.strptime(created_at[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        bucket = created_at[:13] if created >= hourly_since else created_at[:10]
+        if bucket not in buckets:
+            buckets.add(bucket)
+            keep.add(revision_id)
+    keep |= {base_id for revision_id, base_id, _ in rows if revision_id in keep and base_id}
+    doomed = [(revision_id,) for revision_id, _, _ in rows if revision_id not in keep]
+    conn.executemany('DELETE FROM chapter_revisions WHERE id = ?', doomed)
+    return len(doomed)
+
+def db_list_revisions(chapter_id, limit=100):
+    """Newest-first revision summaries (no text)"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f'SELECT {REVISION_SUMMARY_COLUMNS} FROM chapter_revisions '
+                            'WHERE chapter_id = ? ORDER BY id DESC LIMIT ?', (chapter_id, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+def db_get_revision(revision_id):
+    """One revision with its reconstructed ``content``, or None"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(f'SELECT {REVISION_SUMMARY_COLUMNS} FROM chapter_revisions WHERE id = ?',
+                           (revision_id,)).fetchone()
+        if row is None:
+            return None
+        conn.row_factory = None
+        revision = dict(row)
+        revision['content'] = _revision_content(conn, revision_id)
+    return revision
+
+def db_restore_revision(revision_id):
+    """Put a revision's text back into its chapter; recorded as a new revision, so it can be undone too"""
+    with get_connection() as conn:
+        row = conn.execute('SELECT chapter_id, word_count FROM chapter_revisions WHERE id = ?',
+                           (revision_id,)).fetchone()
+    if row is None:
+        return None
+    chapter_id, word_count = row
+    # A buffered autosave would otherwise land on top of the restored text
+    _flush_pending('chapter', chapter_id)
+    with get_connection() as conn:
+        content = _revision_content(conn, revision_id)
+        conn.execute('UPDATE chapters SET content = ?, word_count = ?, version = version + 1, '
+                     'updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                     (encode(content), word_count if word_count is not None else len(content), chapter_id))
+        _chapter_written(conn, chapter_id, content, word_count)
+        conn.commit()
+    return chapter_id
+
+def db_thin_revisions(chapter_id=None):
+    """Run the retention policy for one chapter, or all of them; returns how many revisions were removed"""
+    with get_connection() as conn:
+        if chapter_id is None:
+            chapter_ids = [row[0] for row in conn.execute('SELECT DISTINCT chapter_id FROM chapter_revisions')]
+        else:
+            chapter_ids = [chapter_id]
+        removed = sum(_thin_revisions(conn, cid) for cid in chapter_ids)
+        conn.commit()
+    return removed
+
+# --- Entity Mentions ---
+
+# Entity kinds whose names are looked for in chapter text
+MENTION_KINDS = ('character', 'location', 'faction')
+# Offsets kept per chapter and name; the count is always exact
+MENTION_MAX_POSITIONS = 500
+_MATCHER_CACHE_SIZE = 16
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+def _mention_names(conn, novel_id):
+    placeholders = ', '.join('?' for _ in MENTION_KINDS)
+    rows = conn.execute(f'SELECT DISTINCT name FROM entities WHERE novel_id = ? AND kind IN ({placeholders})',
+                        (novel_id, *MENTION_KINDS))
+    return sorted(row[0] for row in rows)
+
+def _mention_matcher(conn, novel_id):
+    """(names key, automaton) for the novel's current entity names; automata are cached by key"""
+    names = _mention_names(conn, novel_id)
+    key = hashlib.sha1('\n'.join(names).encode('utf-8')).hexdigest()[:16]
+    with _matchers_lock:
+        matcher = _matchers.pop(key, None)
+        if matcher is None:
+            matcher = AhoCorasick(names)
+            if len(_matchers) >= _MATCHER_CACHE_SIZE:
+                _matchers.pop(next(iter(_matchers)))
+        _matchers[key] = matcher
+    return key, matcher
+
+def _index_mentions(conn, chapter_id, content, novel_id, matcher=None):
+    """Replace one chapter's mention rows (code point offsets of each entity name in its text)"""
+    key, automaton = matcher or _mention_matcher(conn, novel_id)
+    positions = {}
+    for start, name in automaton.find(content or '') if automaton else ():
+        positions.setdefault(name, []).append(start)
+    conn.execute('DELETE FROM chapter_mentions WHERE chapter_id = ?', (chapter_id,))
+    conn.executemany(
+        'INSERT INTO chapter_mentions (chapter_id, novel_id, name, count, positions) VALUES (?, ?, ?, ?, ?)',
+        [(chapter_id, novel_id, name, len(offsets), json.dumps(offsets[:MENTION_MAX_POSITIONS]))
+         for name, offsets in positions.items()])
+    conn.execute('UPDATE chapters SET mentions_key = ? WHERE id = ?', (key, chapter_id))
+
+def _refresh_mentions(novel_id):
+    """Re-index the chapters indexed against an older set of names (entities were added or renamed)"""
+    _flush_novel_saves(novel_id)
+    with get_connection() as conn:
+        matcher = _mention_matcher(conn, novel_id)
+        stale = [row[0] for row in conn.execute(
+            'SELECT id FROM chapters WHERE novel_id = ? AND mentions_key IS NOT ?', (novel_id, matcher[0]))]
+        for start in range(0, len(stale), CHAPTER_BATCH_SIZE):
+            batch = stale[start:start + CHAPTER_BATCH_SIZE]
+            placeholders = ', '.join('?' for _ in batch)
+            for chapter_id, content in conn.execute(
+                    f'SELECT id, content FROM chapters WHERE id IN ({placeholders})', batch).fetchall():
+                _index_mentions(conn, chapter_id, decode(content), novel_id, matcher)
+            # Short transactions: saves are not held up behind a whole-book re-index
+            conn.commit()
+    return len(stale)
+
+def db_get_mentions(novel_id, name=None):
+    """Where entity names appear in a novel
+
+    Without ``name``: one row per name with its chapter and mention counts and
+    the last chapter (in reading order) it appears in. With ``name``: one row
+    per chapter mentioning it, in reading order, with the offsets.
+    """
+    _refresh_mentions(novel_id)
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        if name is not None:
+            rows = conn.execute('''
+            SELECT m.chapter_id, c.title, c.order_index, m.count, m.positions
+            FROM chapter_mentions m JOIN chapters c ON c.id = m.chapter_id
+            WHERE m.novel_id = ? AND m.name = ?
+            ORDER BY c.order_index, c.id
+            ''', (novel_id, name)).fetchall()
+            return [dict(row, positions=json.loads(row['positions'])) for row in rows]
+        rows = conn.execute('''
+        SELECT m.name, COUNT(*) AS chapters, SUM(m.count) AS mentions,
+               (SELECT m2.chapter_id FROM chapter_mentions m2 JOIN chapters c ON c.id = m2.chapter_id
+                WHERE m2.novel_id = m.novel_id AND m2.name = m.name
+                ORDER BY c.order_index DESC, c.id DESC LIMIT 1) AS last_chapter_id
+        FROM chapter_mentions m
+        WHERE m.novel_id = ?
+        GROUP BY m.name
+        ORDER BY mentions DESC, m.name
+        ''', (novel_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+# --- Passage Retrieval ---
+
+# Bump when passage splitting or tokenization changes: chapters are re-indexed lazily
+PASSAGE_INDEX_VERSION = 1
+RETRIEVE_MAX_K = 50
+
+def _index_passages(conn, chapter_id, content, novel_id):
+    """Replace one chapter's passages and their BM25 index rows"""
+    content = content or ''
+    conn.execute('DELETE FROM passages WHERE chapter_id = ?', (chapter_id,))
+    for position, (start, length) in enumerate(split_passages(content)):
+        cursor = conn.execute(
+            'INSERT INTO passages (novel_id, chapter_id, position, start_offset, length) VALUES (?, ?, ?, ?, ?)',
+            (novel_id, chapter_id, position, start, length))
+        conn.execute('INSERT INTO passages_fts (rowid, novel, terms) VALUES (?, ?, ?)',
+                     (cursor.lastrowid, f'n{novel_id}', index_text(content[start:start + length])))
+    conn.execute('UPDATE chapters SET passages_version = ? WHERE id = ?', (PASSAGE_INDEX_VERSION, chapter_id))
+
+def _refresh_passages(novel_id):
+    """Index chapters saved before retrieval existed (or before the last PASSAGE_INDEX_VERSION)"""
+    _flush_novel_saves(novel_id)
+    with get_connection() as conn:
+        stale = [row[0] for row in conn.execute(
+            'SELECT id FROM chapters WHERE novel_id = ? AND passages_version IS NOT ?',
+            (novel_id, PASSAGE_INDEX_VERSION))]
+        for start in range(0, len(stale), CHAPTER_BATCH_SIZE):
+            batch = stale[start:start + CHAPTER_BATCH_SIZE]
+            placeholders = ', '.join('?' for _ in batch)
+            for chapter_id, content in conn.execute(
+                    f'SELECT id, content FROM chapters WHERE id IN ({placeholders})', batch).fetchall():
+                _index_passages(conn, chapter_id, decode(content), novel_id)
+            conn.commit()
+    return len(stale)
+
+def db_retrieve_passages(novel_id, query, k=5):
+    """The ``k`` passages of a novel that best match ``query`` (BM25), best first
+
+    Each result has chapter_id, chapter title and order_index, the passage's
+    character offset and length in the chapter, its text and its score
+    (higher is better). Term statistics are those of the FTS table, i.e. of
+    the whole library rather than this novel alone.
+    """
+    expression = match_query(query)
+    if expression is None:
+        return []
+    k = max(1, min(int(k), RETRIEVE_MAX_K))
+    _refresh_passages(novel_id)
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute('''
+        SELECT p.chapter_id, c.title, c.order_index, p.start_offset, p.length,
+               -bm25(passages_fts, 0.0, 1.0) AS score
+        FROM passages_fts f
+        JOIN passages p ON p.id = f.rowid
+        JOIN chapters c ON c.id = p.chapter_id
+        WHERE passages_fts MATCH ?
+        ORDER BY bm25(passages_fts, 0.0, 1.0)
+        LIMIT ?
+        ''', (f'novel : "n{int(novel_id)}" AND terms : ({expression})', k)).fetchall()
+        results = [dict(row) for row in rows]
+        # Passages keep offsets only; cut the text out of each chapter once
+        placeholders = ', '.join('?' for _ in results)
+        bodies = dict(conn.execute(f'SELECT id, content FROM chapters WHERE id IN ({placeholders})',
+                                   [row['chapter_id'] for row in results]).fetchall())
+    for result in results:
+        body = decode(bodies.get(result['chapter_id'])) or ''
+        result['text'] = body[result['start_offset']:result['start_offset'] + result['length']]
+    return results
+
+# --- Generation Context ---
+
+CONTEXT_MAX_BUDGET = 200000
+CONTEXT_RECENT_PARAGRAPHS = 8
+CONTEXT_MAX_PARAGRAPHS = 200
+CONTEXT_OUTLINE_AROUND = 3          # outline entries on each side of the chapter being written
+CONTEXT_ENTITY_TOKENS = 300         # per entity description
+# Sections in the order leftover budget is handed out, with their first-pass share of the budget
+CONTEXT_SECTIONS = (
+    ('recent', '前文', 0.35, 'end'),
+    ('summary', '故事梗概', 0.25, 'end'),
+    ('outline', '章节大纲', 0.15, None),
+    ('entities', '相关人物与设定', 0.15, None),
+    ('passages', '相关前文片段', 0.10, 'start'),
+)
+# ...and the order they appear in the prompt: the text being continued comes last
+CONTEXT_LAYOUT = ('summary', 'outline', 'entities', 'passages', 'recent')
+ENTITY_CONTEXT_FIELDS = ('role', 'gender', 'age', 'personality', 'appearance', 'background',
+                         'description', 'details')
+_CONTEXT_CACHE_SIZE = 256
+_paragraph_cache = OrderedDict()
+_paragraph_cache_lock = threading.Lock()
+
+def _chapter_paragraphs(conn, chapter_id, version):
+    """Non-empty paragraphs of a chapter with their token estimates, memoized per chapter version"""
+    key = (DB_FILE, chapter_id, version)
+    with _paragraph_cache_lock:
+        if key in _paragraph_cache:
+            _paragraph_cache.move_to_end(key)
+            return _paragraph_cache[key]
+    row = conn.execute('SELECT content FROM chapters WHERE id = ?', (chapter_id,)).fetchone()
+    content = (decode(row[0]) if row else None) or ''
+    paragraphs = [line.strip() for line in content.split('\n') if line.strip()]
+    value = [(paragraph, estimate_tokens(paragraph)) for paragraph in paragraphs]
+    with _paragraph_cache_lock:
+        _paragraph_cache[key] = value
+        while len(_paragraph_cache) > _CONTEXT_CACHE_SIZE:
+            _paragraph_cache.popitem(last=False)
+    return value
+
+def _entity_context(row):
+    data = _parse_extra_data(row['data']) or {}
+    details = [f"{data[field]}" for field in ENTITY_CONTEXT_FIELDS
+               if isinstance(data.get(field), (str, int, float)) and str(data[field]).strip()]
+    text = f"{row['name']}：{'；'.join(details)}" if details else row['name']
+    return truncate_to_tokens(text, CONTEXT_ENTITY_TOKENS)
+
+def _item(text):
+    return text, estimate_tokens(text)
+
+def db_build_context(novel_id, budget, system_prompt='', chapter_id=None, query=None,
+                     paragraphs=CONTEXT_RECENT_PARAGRAPHS, k=3):
+    """Assemble the context for writing ``chapter_id`` (default: a new chapter after the last) within ``budget`` tokens
+
+    Pieces, each ranked most useful first: the last ``paragraphs`` paragraphs
+    before the writing position, the rolling summary, nearby chapter outlines,
+    entities mentioned in the recent text or ``query``, and the ``k`` earlier
+    passages that best match ``query`` (or the chapter's outline). Returns
+    None if the novel does not exist.
+    """
+    budget = max(0, min(int(budget), CONTEXT_MAX_BUDGET))
+    paragraphs = max(0, min(int(paragraphs), CONTEXT_MAX_PARAGRAPHS))
+    _flush_novel_saves(novel_id)
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        novel = conn.execute('SELECT id, rolling_summary FROM novels WHERE id = ?', (novel_id,)).fetchone()
+        if novel is None:
+            return None
+        chapters = conn.execute('SELECT id, title, description, version FROM chapters WHERE novel_id = ? '
+                                'ORDER BY order_index, id', (novel_id,)).fetchall()
+        position = next((i for i, chapter in enumerate(chapters) if chapter['id'] == chapter_id), len(chapters))
+
+        # The chapter being written (its text so far), then earlier chapters, newest paragraph first
+        recent = []
+        for chapter in reversed(chapters[:position + 1]):
+            if len(recent) >= paragraphs:
+                break
+            recent.extend(reversed(_chapter_paragraphs(conn, chapter['id'], chapter['version'])))
+        recent = recent[:paragraphs]
+
+        # Outline entries nearest the writing position first
+        nearby = sorted(range(max(0, position - CONTEXT_OUTLINE_AROUND),
+                              min(len(chapters), position + CONTEXT_OUTLINE_AROUND + 1)),
+                        key=lambda i: (abs(i - position) + (i < position) * 0.5, i))
+        outline = [(i, f"{chapters[i]['title'] or ''}：{chapters[i]['description']}") for i in nearby
+                   if (chapters[i]['description'] or '').strip()]
+        target_outline = chapters[position]['description'] if position < len(chapters) else None
+
+        # Entities by how often the recent text (or the query) names them
+        automaton = _mention_matcher(conn, novel_id)[1]
+        counts = {}
+        for _, name in automaton.find('\n'.join([query or '', target_outline or ''] + [p for p, _ in recent])):
+            counts[name] = counts.get(name, 0) + 1
+        entities = []
+        placeholders = ', '.join('?' for _ in MENTION_KINDS)
+        for name in sorted(counts, key=lambda name: -counts[name]):
+            entities.extend(_entity_context(row) for row in conn.execute(
+                f'SELECT name, data FROM entities WHERE novel_id = ? AND name = ? AND kind IN ({placeholders}) '
+                'ORDER BY kind, position', (novel_id, name, *MENTION_KINDS)))
+        summary = novel['rolling_summary'] or ''
+
+    recent_text = '\n'.join(p for p, _ in recent)
+    passages = []
+    search = query or target_outline
+    if search and k > 0:
+        passages = [row['text'] for row in db_retrieve_passages(novel_id, search, k + len(recent))
+                    if row['text'] not in recent_text and not any(p in row['text'] for p, _ in recent)][:k]
+
+    system_prompt = system_prompt or ''
+    system_tokens = estimate_tokens(system_prompt)
+    if system_tokens > budget:
+        system_prompt = truncate_to_tokens(system_prompt, budget)
+        system_tokens = estimate_tokens(system_prompt)
+    items = {
+        'recent': recent,
+        'summary': [_item(summary)] if summary.strip() else [],
+        'outline': [_item(text) for _, text in outline],
+        'entities': [_item(text) for text in entities],
+        'passages': [_item(text) for text in passages],
+    }
+    sections = [{'name': name, 'items': items[name], 'share': share, 'truncate': truncate}
+                for name, _, share, truncate in CONTEXT_SECTIONS]
+    picked, used = pack_sections(sections, budget - system_tokens)
+
+    # Back to reading order: recent paragraphs were ranked newest first, outline entries by distance
+    picked['recent'].reverse()
+    order = {rank: i for rank, (i, _) in enumerate(outline)}
+    picked['outline'].sort(key=lambda entry: order[entry[0]])
+    headings = {name: heading for name, heading, _, _ in CONTEXT_SECTIONS}
+    blocks = [f"【{headings[name]}】\n" + '\n'.join(text for _, text, _ in picked[name])
+              for name in CONTEXT_LAYOUT if picked[name]]
+    return {
+        'system': system_prompt,
+        'context': '\n\n'.join(blocks),
+        'tokens': system_tokens + used,
+        'budget': budget,
+        'sections': [{'name': name, 'tokens': sum(tokens for _, _, tokens in picked[name]),
+                      'items': len(picked[name]), 'available': len(items[name])}
+                     for name in CONTEXT_LAYOUT],
+    }
+
+# --- Rolling Summary Tree ---
+
+# Bump when the summary prompts change: every summary is recomputed on the next refresh
+SUMMARY_TREE_VERSION = 1
+SUMMARY_FANOUT = 4
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', '4'))
+SUMMARY_CACHE_GRACE_DAYS = 7        # summaries no tree uses any more are kept this long (undoing an edit is free)
+SUMMARY_NODE_COLUMNS = ('level', 'position', 'first_chapter_id', 'last_chapter_id', 'chapters', 'key')
+
+def _summary_key(kind, *parts):
+    """Cache key of a summary: a hash of everything its prompt is built from"""
+    return hashlib.sha1('\x1f'.join(map(str, (SUMMARY_TREE_VERSION, kind) + parts)).encode('utf-8')).hexdigest()
+
+def _cached_summaries(keys):
+    keys = list(dict.fromkeys(keys))
+    found = {}
+    with get_connection() as conn:
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ', '.join('?' for _ in batch)
+            found.update(conn.execute(f'SELECT key, summary FROM summary_cache WHERE key IN ({placeholders})', batch))
+    return found
+
+def _run_summaries(jobs, summarize, concurrency):
+    """Call ``summarize`` for each ``{key: (kind, title, load_text)}`` job and cache every result as it arrives
+
+    A failed job fails the refresh, but the summaries already computed stay
+    cached, so the next attempt resumes where this one stopped.
+    """
+    def run(key, kind, title, load_text):
+        summary = summarize(kind, title, load_text())
+        if not (summary or '').strip():
+            raise ValueError(f"empty {kind} summary")
+        with get_connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO summary_cache (key, summary) VALUES (?, ?)', (key, summary))
+            conn.commit()
+        return summary
+
+    if concurrency <= 1 or len(jobs) <= 1:
+        return {key: run(key, *job) for key, job in jobs.items()}
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(jobs)), thread_name_prefix='summary') as executor:
+        futures = {key: executor.submit(run, key, *job) for key, job in jobs.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+def _chapter_loader(chapter_id, content_hash):
+    def load():
+        with get_connection() as conn:
+            row = conn.execute('SELECT content FROM chapters WHERE id = ?', (chapter_id,)).fetchone()
+        text = (decode(row[0]) if row else None) or ''
+        if _content_hash(text) != content_hash:
+            # Saved again since the refresh started; that save scheduled another refresh
+            raise RuntimeError(f"chapter {chapter_id} changed during the summary refresh")
+        return text
+    return load
+
+def _fill_content_hashes(conn, novel_id):
+    """content_hash for chapters last written before the summary tree existed"""
+    missing = [row[0] for row in conn.execute(
+        'SELECT id FROM chapters WHERE novel_id = ? AND content_hash IS NULL', (novel_id,))]
+    for start in range(0, len(missing), CHAPTER_BATCH_SIZE):
+        batch = missing[start:start + CHAPTER_BATCH_SIZE]
+        placeholders = ', '.join('?' for _ in batch)
+        for chapter_id, content in conn.execute(
+                f'SELECT id, content FROM chapters WHERE id IN ({placeholders})', batch).fetchall():
+            conn.execute('UPDATE chapters SET content_hash = ? WHERE id = ?', (_content_hash(decode(content)), chapter_id))
+        conn.commit()
+
+def db_refresh_summary(novel_id, summarize, concurrency=None):
+    """Bring a novel's summary tree up to date, calling ``summarize(kind, title, text)`` only for new nodes
+
+    Leaves are the non-empty chapters in reading order; each level merges
+    groups of SUMMARY_FANOUT consecutive nodes (a lone last node is carried
+    up as is). Unchanged nodes are found in the cache by key, so an edit to
+    one chapter costs one chapter summary plus one merge per level. The root
+    becomes the novel's rolling_summary unless the user has edited that since
+    the last refresh. Returns {'summary', 'chapters', 'levels', 'computed',
+    'applied'}, or None if the novel does not exist.
+    """
+    concurrency = SUMMARY_CONCURRENCY if concurrency is None else concurrency
+    _flush_novel_saves(novel_id)
+    with get_connection() as conn:
+        novel = conn.execute('SELECT summary_key FROM novels WHERE id = ?', (novel_id,)).fetchone()
+        if novel is None:
+            return None
+        _fill_content_hashes(conn, novel_id)
+        chapters = conn.execute(
+            'SELECT id, title, content_hash FROM chapters WHERE novel_id = ? AND content_hash != ? '
+            'ORDER BY order_index, id', (novel_id, _content_hash(''))).fetchall()
+        previous = conn.execute('SELECT summary FROM summary_cache WHERE key = ?', (novel[0],)).fetchone()
+
+    # Nodes are (key, first_chapter_id, last_chapter_id, chapters)
+    level = [(_summary_key('chapter', title, content_hash), chapter_id, chapter_id, 1)
+             for chapter_id, title, content_hash in chapters]
+    summaries = _cached_summaries(node[0] for node in level)
+    jobs = {key: ('chapter', title, _chapter_loader(chapter_id, content_hash))
+            for (key, *_), (chapter_id, title, content_hash) in zip(level, chapters) if key not in summaries}
+    computed = len(jobs)
+    summaries.update(_run_summaries(jobs, summarize, concurrency))
+    levels = [level] if level else []
+    while len(level) > 1:
+        groups = [level[start:start + SUMMARY_FANOUT] for start in range(0, len(level), SUMMARY_FANOUT)]
+        level = [group[0] if len(group) == 1 else
+                 (_summary_key('merge', *(node[0] for node in group)), group[0][1], group[-1][2],
+                  sum(node[3] for node in group))
+                 for group in groups]
+        summaries.update(_cached_summaries(node[0] for node in level))
+        jobs = {}
+        for node, group in zip(level, groups):
+            if node[0] not in summaries:
+                text = '\n\n'.join(summaries[child[0]] for child in group)
+                jobs[node[0]] = ('merge', None, lambda text=text: text)
+        computed += len(jobs)
+        summaries.update(_run_summaries(jobs, summarize, concurrency))
+        levels.append(level)
+
+    root = levels[-1][0][0] if levels else None
+    with get_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM summary_nodes WHERE novel_id = ?', (novel_id,))
+        conn.executemany(
+            'INSERT INTO summary_nodes (novel_id, level, position, first_chapter_id, last_chapter_id, chapters, key) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(novel_id, depth, position, *node[1:], node[0])
+             for depth, nodes in enumerate(levels) for position, node in enumerate(nodes)])
+        applied = False
+        if root is not None:
+            # A summary the user typed (or generated client side) is not overwritten
+            cursor = conn.execute(
+                "UPDATE novels SET rolling_summary = ?, summary_key = ? WHERE id = ? "
+                "AND (rolling_summary IS NULL OR rolling_summary = '' OR rolling_summary = ?)",
+                (summaries[root], root, novel_id, previous[0] if previous else None))
+            applied = cursor.rowcount > 0
+        conn.execute('DELETE FROM summary_cache WHERE key NOT IN (SELECT key FROM summary_nodes) '
+                     "AND created_at < datetime('now', ?)", (f'-{SUMMARY_CACHE_GRACE_DAYS} days',))
+        conn.commit()
+    return {'summary': summaries.get(root), 'chapters': len(chapters), 'levels': len(levels),
+            'computed': computed, 'applied': applied}
+
+def db_get_summary_tree(novel_id):
+    """The summary tree from the last refresh: {'summary', 'applied', 'nodes': [...]}, or None if no novel"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        novel = conn.execute('SELECT rolling_summary, summary_key FROM novels WHERE id = ?', (novel_id,)).fetchone()
+        if novel is None:
+            return None
+        nodes = [dict(row) for row in conn.execute(
+            f"SELECT {', '.join('n.' + column for column in SUMMARY_NODE_COLUMNS)}, s.summary "
+            'FROM summary_nodes n LEFT JOIN summary_cache s ON s.key = n.key '
+            'WHERE n.novel_id = ? ORDER BY n.level DESC, n.position', (novel_id,))]
+    root = nodes[0] if nodes else None
+    return {
+        'summary': root['summary'] if root else None,
+        'applied': root is not None and novel['summary_key'] == root['key'] and novel['rolling_summary'] == root['summary'],
+        'nodes': nodes,
+    }
+
+# --- Batch Generation Jobs ---
+
+GENERATION_QUEUED = 'queued'
+GENERATION_RUNNING = 'running'
+GENERATION_PAUSED = 'paused'
+GENERATION_SUCCEEDED = 'succeeded'
+GENERATION_FAILED = 'failed'
+GENERATION_CANCELLED = 'cancelled'
+GENERATION_MAX_CHAPTERS = 500
+GENERATION_CONTEXT_BUDGET = 6000
+# Everything but the prompt template and the credentials
+GENERATION_JOB_COLUMNS = ('id', 'novel_id', 'status', 'first_index', 'last_index', 'next_index', 'model',
+                          'context_budget', 'overwrite', 'key_id', 'generated', 'skipped', 'attempts',
+                          'last_chapter_id', 'error', 'created_at', 'updated_at', 'finished_at')
+
+def _generation_job(row):
+    job = dict(row)
+    job['overwrite'] = bool(job['overwrite'])
+    job['total'] = job['last_index'] - job['first_index'] + 1
+    job['done'] = job['next_index'] - job['first_index']
+    return job
+
+def db_create_generation_job(novel_id, first_index, last_index, prompt_template, key_id, auth_header,
+                             system_prompt='', model=None, context_budget=GENERATION_CONTEXT_BUDGET, overwrite=False):
+    """Queue generation of the chapters at order_index ``first_index``..``last_index`` (inclusive)
+
+    Returns the job, or None if the novel does not exist. Raises ValueError
+    for an empty template or a bad range.
+    """
+    first_index, last_index = int(first_index), int(last_index)
+    if not (prompt_template or '').strip():
+        raise ValueError("prompt_template is required")
+    if first_index < 0 or last_index < first_index or last_index - first_index >= GENERATION_MAX_CHAPTERS:
+        raise ValueError(f"chapter range must be 0 <= first_index <= last_index, at most {GENERATION_MAX_CHAPTERS} chapters")
+    with get_connection() as conn:
+        if conn.execute('SELECT 1 FROM novels WHERE id = ?', (novel_id,)).fetchone() is None:
+            return None
+        cursor = conn.execute(
+            'INSERT INTO generation_jobs (novel_id, first_index, last_index, next_index, prompt_template, system_prompt, '
+            'model, context_budget, overwrite, key_id, auth_header) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (novel_id, first_index, last_index, first_index, prompt_template, system_prompt or '', model,
+             max(0, min(int(context_budget), CONTEXT_MAX_BUDGET)), bool(overwrite), key_id, auth_header))
+        conn.commit()
+    return db_get_generation_job(cursor.lastrowid)
+
+def db_get_generation_job(job_id, with_prompt=False):
+    """A job's progress (plus template, system prompt and credentials if ``with_prompt``), or None"""
+    columns = GENERATION_JOB_COLUMNS + (('prompt_template', 'system_prompt', 'auth_header') if with_prompt else ())
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(f"SELECT {', '.join(columns)} FROM generation_jobs WHERE id = ?", (job_id,)).fetchone()
+    return _generation_job(row) if row else None
+
+def db_list_generation_jobs(novel_id=None, status=None, limit=100):
+    """Jobs newest first, optionally of one novel and/or in one state"""
+    conditions, params = [], []
+    if novel_id is not None:
+        conditions.append('novel_id = ?')
+        params.append(novel_id)
+    if status:
+        conditions.append('status = ?')
+        params.append(status)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"SELECT {', '.join(GENERATION_JOB_COLUMNS)} FROM generation_jobs {where}"
+                            'ORDER BY id DESC LIMIT ?', (*params, int(limit))).fetchall()
+    return [_generation_job(row) for row in rows]
+
+def db_claim_generation_job(per_key_limit):
+    """Move the oldest runnable queued job to running and return it (with its prompt), or None
+
+    A job is runnable while fewer than ``per_key_limit`` jobs with its API
+    key are running and no other job of its novel is (chapters are written
+    in order, each with the previous ones as context).
+    """
+    with get_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('''
+        SELECT j.id FROM generation_jobs j
+        WHERE j.status = ?
+          AND (SELECT COUNT(*) FROM generation_jobs r WHERE r.status = ? AND r.key_id = j.key_id) < ?
+          AND NOT EXISTS (SELECT 1 FROM generation_jobs r WHERE r.status = ? AND r.novel_id = j.novel_id)
+        ORDER BY j.id LIMIT 1
+        ''', (GENERATION_QUEUED, GENERATION_RUNNING, int(per_key_limit), GENERATION_RUNNING)).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        conn.execute('UPDATE generation_jobs SET status = ?, error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                     (GENERATION_RUNNING, row[0]))
+        conn.commit()
+    return db_get_generation_job(row[0], with_prompt=True)
+
+def db_set_generation_job_status(job_id, status, from_states, error=None, auth=None):
+    """Move a job to ``status`` if it is in one of ``from_states``; returns whether it moved
+
+    ``auth`` is an optional ``(key_id, auth_header)`` to run the job with from
+    now on. Credentials are dropped once a job stops (succeeded, failed or
+    cancelled), so queueing a job that has none left needs ``auth``. A
+    cancelled job also removes the empty chapter it created for the chapter
+    it was generating, unless the user has written to it since.
+    """
+    assignments = ['status = ?', 'error = ?', 'updated_at = CURRENT_TIMESTAMP']
+    params = [status, error]
+    conditions = []
+    if status in (GENERATION_SUCCEEDED, GENERATION_FAILED, GENERATION_CANCELLED):
+        assignments += ['auth_header = NULL', 'finished_at = CURRENT_TIMESTAMP']
+    else:
+        assignments.append('finished_at = NULL')
+    if auth is not None:
+        assignments += ['key_id = ?', 'auth_header = ?']
+        params += list(auth)
+    elif status in (GENERATION_QUEUED, GENERATION_RUNNING):
+        conditions.append('auth_header IS NOT NULL')
+    placeholders = ', '.join('?' for _ in from_states)
+    conditions.append(f'status IN ({placeholders})')
+    with get_connection() as conn:
+        cursor = conn.execute(
+            f"UPDATE generation_jobs SET {', '.join(assignments)} WHERE id = ? AND {' AND '.join(conditions)}",
+            (*params, job_id, *from_states))
+        moved = cursor.rowcount > 0
+        if moved and status == GENERATION_CANCELLED:
+            _drop_generation_placeholder(conn, job_id)
+        conn.commit()
+    return moved
+
+def _drop_generation_placeholder(conn, job_id):
+    row = conn.execute('SELECT placeholder_chapter_id FROM generation_jobs WHERE id = ?', (job_id,)).fetchone()
+    chapter_id = row[0] if row else None
+    if chapter_id is None:
+        return
+    # Untouched: never written (version 1, no content) and no autosave of it waiting in the buffer
+    if _pending_save('chapter', chapter_id) is None:
+        conn.execute('DELETE FROM chapters WHERE id = ? AND content IS NULL AND version = 1', (chapter_id,))
+    conn.execute('UPDATE generation_jobs SET placeholder_chapter_id = NULL WHERE id = ?', (job_id,))
+
+def db_requeue_generation_jobs():
+    """Put jobs left running by a previous process back in the queue; returns how many"""
+    with get_connection() as conn:
+        cursor = conn.execute('UPDATE generation_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE status = ?',
+                              (GENERATION_QUEUED, GENERATION_RUNNING))
+        conn.commit()
+    return cursor.rowcount
+
+def db_generation_target(job_id):
+    """The chapter a running job writes next, creating an empty one if the novel has none at that position
+
+    Returns {'index', 'chapter': {...} or None, 'skip'}: ``chapter`` is None
+    when the job has passed its last index; ``skip`` is set for a chapter
+    that already has text and the job does not overwrite. None if the job is
+    not running.
+    """
+    with get_connection() as conn:
+        job = conn.execute('SELECT novel_id FROM generation_jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is not None:
+        _flush_novel_saves(job[0])
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute('BEGIN IMMEDIATE')
+        job = conn.execute('SELECT novel_id, next_index, last_index, overwrite FROM generation_jobs '
+                           'WHERE id = ? AND status = ?', (job_id, GENERATION_RUNNING)).fetchone()
+        if job is None:
+            conn.rollback()
+            return None
+        index = job['next_index']
+        if index > job['last_index']:
+            conn.rollback()
+            return {'index': index, 'chapter': None, 'skip': False}
+        row = conn.execute('SELECT id, title, description, status, content FROM chapters '
+                           'WHERE novel_id = ? AND order_index = ? ORDER BY id LIMIT 1',
+                           (job['novel_id'], index)).fetchone()
+        if row is None:
+            # Created up front so the context builder sees the chapter at its place in the book
+            cursor = conn.execute('INSERT INTO chapters (novel_id, title, order_index) VALUES (?, ?, ?)',
+                                  (job['novel_id'], f'第{index + 1}章', index))
+            chapter = {'id': cursor.lastrowid, 'title': f'第{index + 1}章', 'description': None, 'status': 'draft'}
+            # Removed again if the job is cancelled before writing it
+            conn.execute('UPDATE generation_jobs SET placeholder_chapter_id = ? WHERE id = ?', (chapter['id'], job_id))
+            skip = False
+        else:
+            chapter = {key: row[key] for key in ('id', 'title', 'description', 'status')}
+            skip = bool((decode(row['content']) or '').strip()) and not job['overwrite']
+        conn.commit()
+    return {'index': index, 'chapter': chapter, 'skip': skip}
+
+def db_checkpoint_generation(job_id, chapter, content=None):
+    """Record one chapter of a running job: write ``content`` into it (None: skipped) and advance the job
+
+    Chapter and progress are committed together, so after a crash the job
+    resumes at the first chapter not written. Returns False (and writes
+    nothing) if the job was paused or cancelled meanwhile.
+    """
+    _flush_pending('chapter', chapter['id'])
+    with get_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        progress = 'generated = generated + 1' if content is not None else 'skipped = skipped + 1'
+        cursor = conn.execute(
+            f'UPDATE generation_jobs SET next_index = next_index + 1, {progress}, attempts = 0, error = NULL, '
+            'last_chapter_id = ?, placeholder_chapter_id = NULL, updated_at = CURRENT_TIMESTAMP '
+            'WHERE id = ? AND status = ?',
+            (chapter['id'], job_id, GENERATION_RUNNING))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        if content is not None:
+            row = conn.execute('SELECT order_index FROM chapters WHERE id = ?', (chapter['id'],)).fetchone()
+            _write_chapter(conn, {'id': chapter['id'], 'title': chapter['title'], 'content': content,
+                                  'description': chapter['description'], 'word_count': len(content),
+                                  'status': chapter['status'] or 'draft', 'order_index': row[0] if row else 0})
+        conn.commit()
+    return True
+
+def db_record_generation_attempt(job_id, error):
+    """Count a failed attempt at a running job's current chapter; returns the attempts so far"""
+    with get_connection() as conn:
+        conn.execute('UPDATE generation_jobs SET attempts = attempts + 1, error = ?, updated_at = CURRENT_TIMESTAMP '
+                     'WHERE id = ?', (str(error)[:500], job_id))
+        row = conn.execute('SELECT attempts FROM generation_jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.commit()
+    return row[0] if row else 0
+
+# --- Storage Maintenance ---
+
+COMPRESSED_COLUMNS = (('scripts', 'content'), ('chapters', 'content'), ('chapter_revisions', 'data'))
+
+def db_compress_content(codec=None, batch_size=200, min_bytes=None):
+    """Re-encode existing bodies with ``codec`` (default DB_COMPRESSION; False = decompress)
+
+    Runs in short per-batch transactions; returns a summary per table. Run
+    VACUUM afterwards to hand the freed pages back to the file system.
+    """
+    return {table: recompress_table(get_connection, table, column, codec, batch_size, min_bytes)
+            for table, column in COMPRESSED_COLUMNS}
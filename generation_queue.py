@@ -0,0 +1,251 @@
+"""
+Durable queue for batch chapter generation.
+
+A job asks for the chapters of one novel between two positions (order_index,
+inclusive) to be drafted from a prompt template. Jobs live in the
+``generation_jobs`` table, so they survive a restart: ``start`` puts jobs
+that were running back in the queue and they continue at the first chapter
+not yet written.
+
+A fixed pool of worker threads bounds the number of requests in flight
+upstream, and a worker only claims a job while fewer than ``per_key`` jobs
+with the same API key are running, so a single key's quota is not flooded.
+Chapters of one job are written in order: each is generated with the
+context built from the chapters before it (``db_build_context``) and
+committed together with the job's progress.
+
+Template placeholders (``{context}``, ``{novel_title}``, ``{title}``,
+``{outline}``, ``{chapter_number}``) are replaced the way the editor fills
+its prompt variables; other braces are left alone. If the template has no
+``{context}``, the context is put in front of it.
+"""
+
+import logging
+import os
+import re
+import threading
+import urllib.error
+
+from db_manager import (
+    GENERATION_QUEUED, GENERATION_RUNNING, GENERATION_PAUSED, GENERATION_SUCCEEDED, GENERATION_FAILED,
+    GENERATION_CANCELLED, GENERATION_CONTEXT_BUDGET, db_build_context, db_checkpoint_generation,
+    db_claim_generation_job, db_create_generation_job, db_generation_target, db_get_generation_job,
+    db_get_novel, db_list_generation_jobs, db_record_generation_attempt, db_requeue_generation_jobs,
+    db_set_generation_job_status,
+)
+from upstream_client import UpstreamError, key_id, upstream_client
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['GenerationQueue', 'fill_template', 'key_id', 'generation_queue']
+
+GENERATION_URL = os.getenv('GENERATION_API_URL', "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions")
+GENERATION_MODEL = os.getenv('GENERATION_MODEL', 'qwen-plus')
+# Requests in flight upstream at once (all keys), and running jobs per API key
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '4'))
+GENERATION_PER_KEY = int(os.getenv('GENERATION_PER_KEY', '2'))
+GENERATION_TIMEOUT = 300
+MAX_ATTEMPTS = 5                    # per chapter, for throttling and network errors
+
+TEMPLATE_VARIABLES = ('context', 'novel_title', 'title', 'outline', 'chapter_number')
+_PLACEHOLDER = re.compile(r'\{(' + '|'.join(TEMPLATE_VARIABLES) + r')\}')
+
+
+def fill_template(template, values):
+    return _PLACEHOLDER.sub(lambda match: str(values.get(match.group(1), '')), template)
+
+
+def _retryable(error):
+    """Throttling, upstream 5xx and network errors are retried; other client errors fail the job"""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (UpstreamError, OSError, ValueError))
+
+
+class GenerationQueue:
+    """Worker pool that drains ``generation_jobs`` through the upstream chat completions API"""
+
+    def __init__(self, client=upstream_client, workers=GENERATION_WORKERS, per_key=GENERATION_PER_KEY,
+                 url=None, model=None, retry_delay=2.0, max_retry_delay=60.0, max_attempts=MAX_ATTEMPTS,
+                 poll_interval=5.0, on_chapter=None):
+        self.client = client
+        self.workers = max(1, workers)
+        self.per_key = max(1, per_key)
+        self.url = url or GENERATION_URL
+        self.model = model or GENERATION_MODEL
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        # Called with (novel_id, chapter_id) after each generated chapter is committed
+        self.on_chapter = on_chapter
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._active = {}           # job id -> worker name
+        self.chapters = 0
+        self.retries = 0
+
+    # --- Public API ---
+
+    def start(self):
+        """Requeue jobs interrupted by the last shutdown and start the workers"""
+        with self._wakeup:
+            if self._threads:
+                return
+            self._stop.clear()
+            requeued = db_requeue_generation_jobs()
+            if requeued:
+                logger.info("Resuming %d interrupted generation job(s)", requeued)
+            self._threads = [threading.Thread(target=self._run, name=f'generation-{i}', daemon=True)
+                             for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, novel_id, first_index, last_index, prompt_template, auth_header, system_prompt='',
+               model=None, context_budget=GENERATION_CONTEXT_BUDGET, overwrite=False):
+        """Queue a job; returns its progress record, or None if the novel does not exist"""
+        job = db_create_generation_job(novel_id, first_index, last_index, prompt_template, key_id(auth_header),
+                                       auth_header, system_prompt, model, context_budget, overwrite)
+        self._notify()
+        return job
+
+    def get(self, job_id):
+        return db_get_generation_job(job_id)
+
+    def list(self, novel_id=None, status=None, limit=100):
+        return db_list_generation_jobs(novel_id, status, limit)
+
+    def pause(self, job_id):
+        """Stop the job until resumed (a chapter being generated is redone then); None if it cannot be paused"""
+        return self._transition(job_id, GENERATION_PAUSED, (GENERATION_QUEUED, GENERATION_RUNNING))
+
+    def cancel(self, job_id):
+        """Stop for good; a chapter being generated is discarded, with the empty chapter made for it"""
+        return self._transition(job_id, GENERATION_CANCELLED, (GENERATION_QUEUED, GENERATION_RUNNING,
+                                                               GENERATION_PAUSED, GENERATION_FAILED))
+
+    def resume(self, job_id, auth_header=None):
+        """Queue a paused or failed job again, optionally with a new API key (required for a failed job)"""
+        auth = (key_id(auth_header), auth_header) if auth_header else None
+        job = self._transition(job_id, GENERATION_QUEUED, (GENERATION_PAUSED, GENERATION_FAILED), auth)
+        self._notify()
+        return job
+
+    def stats(self):
+        with self._wakeup:
+            return {'workers': self.workers, 'per_key': self.per_key, 'busy': len(self._active),
+                    'running_jobs': sorted(self._active), 'chapters': self.chapters, 'retries': self.retries}
+
+    def shutdown(self, wait=True):
+        """Stop claiming jobs; running ones go back to the queue after their current chapter"""
+        self._stop.set()
+        self._notify()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    # --- Workers ---
+
+    def _transition(self, job_id, status, from_states, auth=None):
+        if not db_set_generation_job_status(job_id, status, from_states, auth=auth):
+            return None
+        return db_get_generation_job(job_id)
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = db_claim_generation_job(self.per_key)
+            if job is None:
+                with self._wakeup:
+                    if not self._stop.is_set():
+                        self._wakeup.wait(self.poll_interval)
+                continue
+            with self._wakeup:
+                self._active[job['id']] = threading.current_thread().name
+            try:
+                self._run_job(job)
+            except Exception as e:
+                logger.exception("Generation job %s failed", job['id'])
+                db_set_generation_job_status(job['id'], GENERATION_FAILED, (GENERATION_RUNNING,), error=str(e)[:500])
+            finally:
+                with self._wakeup:
+                    self._active.pop(job['id'], None)
+                # A finished job may unblock another one with the same key or novel
+                self._notify()
+
+    def _run_job(self, job):
+        novel = db_get_novel(job['novel_id']) or {}
+        while True:
+            if self._stop.is_set():
+                db_set_generation_job_status(job['id'], GENERATION_QUEUED, (GENERATION_RUNNING,))
+                return
+            target = db_generation_target(job['id'])
+            if target is None:
+                return                  # paused, cancelled or deleted
+            chapter = target['chapter']
+            if chapter is None:
+                db_set_generation_job_status(job['id'], GENERATION_SUCCEEDED, (GENERATION_RUNNING,))
+                return
+            if target['skip']:
+                db_checkpoint_generation(job['id'], chapter)
+                continue
+            content = self._generate(job, novel, chapter, target['index'])
+            if content is None:
+                return
+            if db_checkpoint_generation(job['id'], chapter, content):
+                with self._wakeup:
+                    self.chapters += 1
+                if self.on_chapter is not None:
+                    try:
+                        self.on_chapter(job['novel_id'], chapter['id'])
+                    except Exception:
+                        logger.exception("on_chapter hook failed for chapter %s", chapter['id'])
+
+    def _generate(self, job, novel, chapter, index):
+        """Text of one chapter, retrying transient errors; None if the job stopped or failed"""
+        context = db_build_context(job['novel_id'], job['context_budget'], job['system_prompt'], chapter['id'])
+        values = {'context': context['context'], 'novel_title': novel.get('title') or '', 'title': chapter['title'] or '',
+                  'outline': chapter['description'] or '', 'chapter_number': index + 1}
+        prompt = fill_template(job['prompt_template'], values)
+        if '{context}' not in job['prompt_template'] and context['context']:
+            prompt = context['context'] + '\n\n' + prompt
+        messages = [{'role': 'system', 'content': context['system']}] if context['system'] else []
+        messages.append({'role': 'user', 'content': prompt})
+        payload = {'model': job['model'] or self.model, 'messages': messages}
+
+        while True:
+            try:
+                response = self.client.request('POST', self.url, body=payload, headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': job['auth_header'],
+                }, timeout=GENERATION_TIMEOUT)
+                content = (response.json()['choices'][0]['message']['content'] or '').strip()
+                if not content:
+                    raise ValueError("empty completion")
+                return content
+            except Exception as e:
+                if isinstance(e, (KeyError, IndexError, TypeError)):
+                    e = ValueError(f"unexpected chat completion response: {e}")
+                attempts = db_record_generation_attempt(job['id'], e)
+                if not _retryable(e) or attempts >= self.max_attempts:
+                    db_set_generation_job_status(job['id'], GENERATION_FAILED, (GENERATION_RUNNING,),
+                                                 error=f"chapter {index + 1}: {e}"[:500])
+                    return None
+                with self._wakeup:
+                    self.retries += 1
+                delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+                logger.warning("Generation job %s, chapter %d: %s; retrying in %.1fs", job['id'], index + 1, e, delay)
+                if self._stop.wait(delay):
+                    db_set_generation_job_status(job['id'], GENERATION_QUEUED, (GENERATION_RUNNING,))
+                    return None
+                current = db_get_generation_job(job['id'])
+                if current is None or current['status'] != GENERATION_RUNNING:
+                    return None
+
+
+generation_queue = GenerationQueue()
@@ -0,0 +1,432 @@
+"""
+Asynchronous image-generation job engine.
+
+Jobs are submitted to DashScope by a small thread pool and every outstanding
+task is polled from a single scheduler thread with adaptive backoff, so no
+request thread sleeps while an image renders.
+"""
+
+import os
+import threading
+import time
+import urllib.error
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from upstream_client import key_id, upstream_client
+
+IMAGE_GEN_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis"
+TASK_URL = "https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}"
+
+PRIMARY_MODEL = "flux-merge"
+FALLBACK_MODEL = "wanx-v1"
+
+# Max jobs of one batch in flight upstream at the same time
+BATCH_CONCURRENCY = int(os.getenv('IMAGE_BATCH_CONCURRENCY', '4'))
+MAX_BATCH_CONCURRENCY = 16
+
+# Job states
+QUEUED = 'QUEUED'          # accepted, not yet submitted upstream
+PENDING = 'PENDING'        # upstream task created, waiting in DashScope's queue
+RUNNING = 'RUNNING'        # upstream task rendering
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+TERMINAL_STATES = (SUCCEEDED, FAILED)
+
+
+class ImageJob:
+    """One image generation request and its upstream task"""
+
+    def __init__(self, prompt, auth_header, size, batch=None, index=None):
+        self.id = uuid.uuid4().hex
+        self.batch = batch
+        self.index = index
+        self.prompt = prompt
+        self.size = size
+        self.auth_header = auth_header
+        self.status = QUEUED
+        self.model = None
+        self.task_id = None
+        self.url = None
+        self.error = None
+        self.error_code = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.version = 0
+        # Scheduling state
+        self.interval = 0.0
+        self.next_poll = 0.0
+        self.deadline = 0.0
+        self.polling = False
+        self.poll_errors = 0
+
+    @property
+    def done(self):
+        return self.status in TERMINAL_STATES
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'prompt': self.prompt,
+            'model': self.model,
+            'task_id': self.task_id,
+            'url': self.url,
+            'error': self.error,
+            'error_code': self.error_code,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'version': self.version,
+            'batch_id': self.batch.id if self.batch else None,
+            'index': self.index,
+        }
+
+
+class ImageBatch:
+    """A group of jobs released to the upstream at most ``concurrency`` at a time"""
+
+    def __init__(self, concurrency):
+        self.id = uuid.uuid4().hex
+        self.concurrency = concurrency
+        self.jobs = []
+        self.waiting = deque()
+        self.created_at = time.time()
+
+    def to_dict(self):
+        jobs = [job.to_dict() for job in self.jobs]
+        return {
+            'id': self.id,
+            'concurrency': self.concurrency,
+            'total': len(jobs),
+            'finished': sum(1 for job in jobs if job['status'] in TERMINAL_STATES),
+            'jobs': jobs,
+        }
+
+
+class ImageJobManager:
+    """Submits image jobs and multiplexes polling of every outstanding task"""
+
+    def __init__(self, client=upstream_client, submit_workers=4, min_interval=1.0,
+                 max_interval=8.0, backoff=1.5, job_timeout=180, retention=3600,
+                 max_poll_errors=5, image_url=IMAGE_GEN_URL, task_url=TASK_URL):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.job_timeout = job_timeout
+        self.retention = retention
+        self.max_poll_errors = max_poll_errors
+        self.image_url = image_url
+        self.task_url = task_url
+        self._jobs = OrderedDict()
+        self._batches = OrderedDict()
+        # Model that works for each API key (keyed by hash), learned once per key
+        self._preferred_models = {}
+        self._probe_locks = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=submit_workers,
+                                            thread_name_prefix='image-job')
+        self._scheduler = None
+        self._running = True
+        self.polls = 0
+
+    # --- Public API ---
+
+    def submit(self, prompt, auth_header, size='1024*1024'):
+        """Queue a job and return its snapshot immediately"""
+        job = ImageJob(prompt, auth_header, size)
+        with self._cond:
+            self._jobs[job.id] = job
+            self._ensure_scheduler()
+            snapshot = job.to_dict()
+        self._executor.submit(self._submit_task, job)
+        return snapshot
+
+    def submit_batch(self, prompts, auth_header, size='1024*1024', concurrency=None):
+        """Queue many jobs; only ``concurrency`` of them run upstream at once"""
+        concurrency = max(1, min(int(concurrency or BATCH_CONCURRENCY), MAX_BATCH_CONCURRENCY))
+        batch = ImageBatch(concurrency)
+        with self._cond:
+            for index, prompt in enumerate(prompts):
+                job = ImageJob(prompt, auth_header, size, batch=batch, index=index)
+                batch.jobs.append(job)
+                batch.waiting.append(job)
+                self._jobs[job.id] = job
+            self._batches[batch.id] = batch
+            self._ensure_scheduler()
+            started = [batch.waiting.popleft() for _ in range(min(concurrency, len(batch.waiting)))]
+            snapshot = batch.to_dict()
+        for job in started:
+            self._executor.submit(self._submit_task, job)
+        return snapshot
+
+    def get_batch(self, batch_id):
+        with self._cond:
+            batch = self._batches.get(batch_id)
+            return batch.to_dict() if batch else None
+
+    def iter_batch_results(self, batch_id, timeout=None):
+        """Yield each job snapshot of a batch as soon as it finishes (completion order)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        reported = set()
+        with self._cond:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return
+            total = len(batch.jobs)
+        while len(reported) < total:
+            with self._cond:
+                finished = [job.to_dict() for job in batch.jobs
+                            if job.done and job.id not in reported]
+                if not finished:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    self._cond.wait(remaining)
+                    continue
+            for snapshot in finished:
+                reported.add(snapshot['id'])
+                yield snapshot
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def wait(self, job_id, since_version=-1, timeout=None):
+        """Block until the job changes past ``since_version`` or finishes
+
+        Returns the latest snapshot (unchanged on timeout), or None for an
+        unknown job id.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return None
+                if job.version > since_version or job.done:
+                    return job.to_dict()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return job.to_dict()
+                self._cond.wait(remaining)
+
+    def wait_for_result(self, job_id, timeout=None):
+        """Block until the job reaches a terminal state (or timeout)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job.done:
+                    return job.to_dict() if job else None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return job.to_dict()
+                self._cond.wait(remaining)
+
+    def stats(self):
+        with self._cond:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {
+                'jobs': len(self._jobs),
+                'batches': len(self._batches),
+                'by_status': counts,
+                'polls': self.polls,
+                'learned_models': len(self._preferred_models),
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
+
+    # --- Internals ---
+
+    def _ensure_scheduler(self):
+        if self._scheduler is None or not self._scheduler.is_alive():
+            self._scheduler = threading.Thread(target=self._schedule_loop,
+                                               name='image-job-scheduler', daemon=True)
+            self._scheduler.start()
+
+    def _update(self, job, **fields):
+        """Apply state changes and wake waiters (caller must not hold the lock)"""
+        next_job = None
+        with self._cond:
+            for key, value in fields.items():
+                setattr(job, key, value)
+            job.updated_at = time.time()
+            job.version += 1
+            # A finished batch job frees a slot for the next waiting one
+            if job.done and job.batch and job.batch.waiting:
+                next_job = job.batch.waiting.popleft()
+            self._cond.notify_all()
+        if next_job is not None:
+            self._executor.submit(self._submit_task, next_job)
+
+    def _create_task(self, job, model_name):
+        print(f"Trying image generation with model: {model_name}")
+        payload = {
+            "model": model_name,
+            "input": {
+                "prompt": job.prompt
+            },
+            "parameters": {
+                "size": job.size,
+                "n": 1
+            }
+        }
+        response = self.client.request('POST', self.image_url, body=payload, headers={
+            'Content-Type': 'application/json',
+            'Authorization': job.auth_header,
+            'X-DashScope-Async': 'enable'
+        })
+        return response.json().get('output', {}).get('task_id')
+
+    def _create_task_with_fallback(self, job):
+        """Create the upstream task with the model known to work for this key
+
+        The Flux -> Wanx fallback is probed once per API key (other jobs for the
+        same key wait on the probe) and remembered, instead of re-trying Flux for
+        every prompt. Returns (model, task_id).
+        """
+        key = key_id(job.auth_header)
+        model = self._preferred_models.get(key)
+        if model:
+            try:
+                return model, self._create_task(job, model)
+            except urllib.error.HTTPError as e:
+                if e.code not in (400, 403) or model == FALLBACK_MODEL:
+                    raise
+                # Key lost access to the learned model: forget it and probe again
+                print(f"Learned model {model} rejected ({e.code}), probing again")
+                self._preferred_models.pop(key, None)
+
+        with self._cond:
+            probe_lock = self._probe_locks.setdefault(key, threading.Lock())
+        with probe_lock:
+            model = self._preferred_models.get(key)
+            if model:
+                return model, self._create_task(job, model)
+            try:
+                task_id = self._create_task(job, PRIMARY_MODEL)
+                self._preferred_models[key] = PRIMARY_MODEL
+                return PRIMARY_MODEL, task_id
+            except urllib.error.HTTPError as e:
+                print(f"Flux generation failed: {e}")
+                if e.code not in (400, 403):  # Forbidden or Bad Request (model not found)
+                    raise
+                learn = True
+            except Exception as e:
+                # Transient failure: fall back for this job but do not remember it
+                print(f"Flux error: {e}")
+                learn = False
+            print(f"Falling back to {FALLBACK_MODEL}...")
+            task_id = self._create_task(job, FALLBACK_MODEL)
+            if learn:
+                self._preferred_models[key] = FALLBACK_MODEL
+            return FALLBACK_MODEL, task_id
+
+    def _submit_task(self, job):
+        try:
+            model, task_id = self._create_task_with_fallback(job)
+            if not task_id:
+                raise Exception("Failed to get task_id")
+        except urllib.error.HTTPError as e:
+            print(f"[ERROR] Image Gen HTTP Error: {e.code} - {e.reason}")
+            self._update(job, status=FAILED, error=f"Upstream Error: {e.reason}", error_code=e.code)
+            return
+        except Exception as e:
+            print(f"[ERROR] Image Gen Error: {e}")
+            self._update(job, status=FAILED, error=str(e), error_code=500)
+            return
+
+        now = time.monotonic()
+        self._update(job, status=PENDING, model=model, task_id=task_id,
+                     interval=self.min_interval, next_poll=now + self.min_interval,
+                     deadline=now + self.job_timeout)
+
+    def _schedule_loop(self):
+        """Dispatch due polls to the worker pool; sleep until the next one is due"""
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                due = []
+                next_wake = None
+                for job in self._jobs.values():
+                    if job.done or job.task_id is None or job.polling:
+                        continue
+                    if job.next_poll <= now:
+                        job.polling = True
+                        due.append(job)
+                    elif next_wake is None or job.next_poll < next_wake:
+                        next_wake = job.next_poll
+                self._evict(time.time())
+                if not due:
+                    # Woken early by _update whenever a new task is created
+                    self._cond.wait(None if next_wake is None else next_wake - now)
+                    continue
+            for job in due:
+                self._executor.submit(self._poll_task, job)
+
+    def _poll_task(self, job):
+        fields = {'polling': False}
+        try:
+            task_url = self.task_url.format(task_id=job.task_id)
+            task_data = self.client.request('GET', task_url,
+                                            headers={'Authorization': job.auth_header}).json()
+            self.polls += 1
+            output = task_data.get('output', {})
+            status = output.get('task_status')
+            fields['poll_errors'] = 0
+            if status == 'SUCCEEDED':
+                fields.update(status=SUCCEEDED, url=output['results'][0]['url'])
+            elif status in ('FAILED', 'CANCELED', 'UNKNOWN'):
+                fields.update(status=FAILED, error_code=500,
+                              error=f"Task failed: {output.get('message', 'Unknown error')}")
+            elif status in (PENDING, RUNNING) and status != job.status:
+                fields['status'] = status
+        except Exception as e:
+            print(f"[WARN] Image task poll failed ({job.task_id}): {e}")
+            fields['poll_errors'] = job.poll_errors + 1
+            if fields['poll_errors'] >= self.max_poll_errors:
+                fields.update(status=FAILED, error=str(e), error_code=502)
+
+        if 'status' not in fields or fields['status'] not in TERMINAL_STATES:
+            now = time.monotonic()
+            if now >= job.deadline:
+                fields.update(status=FAILED, error="Image generation timed out", error_code=504)
+            else:
+                # Adaptive backoff: renders take seconds to minutes, so poll less often as they age
+                interval = min(job.interval * self.backoff, self.max_interval)
+                fields.update(interval=interval, next_poll=now + interval)
+
+        if set(fields) <= {'polling', 'poll_errors', 'interval', 'next_poll'}:
+            # Nothing visible changed: reschedule without waking waiters
+            with self._cond:
+                for key, value in fields.items():
+                    setattr(job, key, value)
+                self._cond.notify_all()
+        else:
+            self._update(job, **fields)
+
+    def _evict(self, now):
+        """Drop finished jobs and batches past the retention window (lock held)"""
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and now - job.updated_at > self.retention]
+        for job_id in expired:
+            del self._jobs[job_id]
+        expired = [batch_id for batch_id, batch in self._batches.items()
+                   if all(job.done and now - job.updated_at > self.retention for job in batch.jobs)]
+        for batch_id in expired:
+            del self._batches[batch_id]
+
+
+# 全局图片任务管理器实例
+image_job_manager = ImageJobManager()
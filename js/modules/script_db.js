@@ -4,9 +4,18 @@ import { CONFIG } from '../config.js';
 const API_BASE = CONFIG.API_BASE_URL || window.location.origin;
 
 export const ScriptDB = {
-    async getHistory() {
+    /**
+     * 获取一页历史摘要（不含正文），before 传上一页最后一项以继续翻页
+     */
+    async getHistory({ limit = 50, favorites = false, before = null } = {}) {
         try {
-            const res = await fetch(`${API_BASE}/api/history`);
+            const params = new URLSearchParams({ limit });
+            if (favorites) params.set('favorites', '1');
+            if (before) {
+                params.set('before_created_at', before.date);
+                params.set('before_id', before.id);
+            }
+            const res = await fetch(`${API_BASE}/api/history?${params}`);
             if (!res.ok) throw new Error('Failed to fetch history');
             return await res.json();
         } catch (e) {
@@ -15,6 +24,34 @@ export const ScriptDB = {
         }
     },
 
+    /**
+     * 服务端全文检索，返回 {results, has_more}；snippet 为带 <mark> 高亮的HTML
+     */
+    async search(q, { type = 'all', limit = 20, offset = 0 } = {}) {
+        try {
+            const params = new URLSearchParams({ q, type, limit, offset });
+            const res = await fetch(`${API_BASE}/api/search?${params}`);
+            if (!res.ok) throw new Error('Search failed');
+            return await res.json();
+        } catch (e) {
+            console.error(e);
+            return { results: [], has_more: false };
+        }
+    },
+
+    async getScript(id) {
+        try {
+            const res = await fetch(`${API_BASE}/api/scripts/${id}`);
+            if (!res.ok) throw new Error('Failed to fetch script');
+            const body = await res.json();
+            // Flask 后端返回 {success, data} 包装
+            return body.success !== undefined ? body.data : body;
+        } catch (e) {
+            console.error(e);
+            return null;
+        }
+    },
+
     async saveScript(scriptData) {
         try {
             const res = await fetch(`${API_BASE}/api/scripts/save`, {
@@ -12,6 +12,8 @@ import { progressManager, BatchProgressManager } from '../utils/progress_utils.j
 import { performanceMonitor } from '../utils/performance_utils.js';
 import { ScriptGenView } from './script_gen_view.js';
 
+const HISTORY_PAGE_SIZE = 50;
+
 export class ScriptGeneratorManager {
     constructor() {
         this.category = Object.keys(SCRIPT_CATEGORIES)[0];
@@ -77,6 +79,18 @@ export class ScriptGeneratorManager {
             magicFillNew.addEventListener('click', () => this.magicFill());
         }
 
+        // History search (server-side full text, debounced)
+        const searchEl = document.getElementById('sg-history-search');
+        if (searchEl) {
+            const searchNew = searchEl.cloneNode(true);
+            searchEl.parentNode.replaceChild(searchNew, searchEl);
+            let searchTimer = null;
+            searchNew.addEventListener('input', () => {
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(() => this.searchHistory(searchNew.value.trim()), 300);
+            });
+        }
+
         // Export PDF
         if (exportPdfBtn) {
             const exportPdfNew = exportPdfBtn.cloneNode(true);
@@ -648,20 +662,62 @@ export class ScriptGeneratorManager {
         this.view.updateFavIcon(this.isFavorite);
     }
 
-    async loadHistory() {
+    async loadHistory(append = false) {
         const listEl = document.getElementById('sg-history-list');
-        if (listEl) listEl.innerHTML = '<div style="text-align:center; padding:20px; color:#666;">加载中...</div>';
+        if (!append) {
+            this.historyItems = [];
+            if (listEl) listEl.innerHTML = '<div style="text-align:center; padding:20px; color:#666;">加载中...</div>';
+        }
+
+        // Keyset pagination: continue after the last item already shown
+        const before = append ? this.historyItems[this.historyItems.length - 1] : null;
+        const page = await ScriptDB.getHistory({ limit: HISTORY_PAGE_SIZE, before });
+        this.historyItems.push(...page);
 
-        const history = await ScriptDB.getHistory();
         this.view.renderHistory(
-            history,
+            this.historyItems,
             this.currentScriptId,
             (id, el) => this.deleteHistoryItem(id, el),
-            (item) => this.loadScriptFromHistory(item)
+            (item) => this.loadScriptFromHistory(item),
+            page.length === HISTORY_PAGE_SIZE ? () => this.loadHistory(true) : null
+        );
+    }
+
+    async searchHistory(query, append = false) {
+        if (!query) {
+            this.searchQuery = '';
+            this.loadHistory();
+            return;
+        }
+        if (!append) {
+            this.searchQuery = query;
+            this.searchResults = [];
+        }
+
+        const page = await ScriptDB.search(query, {
+            type: 'scripts',
+            limit: HISTORY_PAGE_SIZE,
+            offset: this.searchResults.length
+        });
+        // Ignore responses for a query the user has already typed past
+        if (query !== this.searchQuery) return;
+        this.searchResults.push(...page.results);
+
+        this.view.renderSearchResults(
+            this.searchResults,
+            (item) => this.loadScriptFromHistory(item),
+            page.has_more ? () => this.searchHistory(query, true) : null
         );
     }
 
-    loadScriptFromHistory(item) {
+    async loadScriptFromHistory(summary) {
+        // The history list only carries summaries; fetch the full script on open
+        const item = await ScriptDB.getScript(summary.id);
+        if (!item) {
+            UI.showError('加载脚本失败');
+            return;
+        }
+
         this.currentScriptId = item.id;
         this.generatedScript = item.content;
         this.isFavorite = item.is_favorite;
@@ -956,61 +1012,113 @@ export class ScriptGeneratorManager {
             const container = document.getElementById('sg-visualize-output');
             const visualData = [];
 
-            const processImage = async (promptText, index) => {
-                // Create placeholder
+            // Placeholders first, in shot order
+            const slots = prompts.map((promptText, index) => {
                 const imgContainer = document.createElement('div');
                 imgContainer.className = 'sg-vis-item';
                 imgContainer.style.position = 'relative';
                 imgContainer.innerHTML = `<div class="loading-spinner"></div><p style="font-size:12px;color:#666;margin-top:5px;">正在绘制镜头 ${index + 1}...</p>`;
                 container.appendChild(imgContainer);
+                return imgContainer;
+            });
 
-                try {
-                    const imageStartTime = Date.now();
-
-                    // Simple fetch logic for image generation
-                    const apiBase = CONFIG.API_BASE_URL || '';
-                    const response = await fetch(`${apiBase}/api/proxy/image`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({
-                            prompt: promptText,
-                            model: "flux-merge",
-                            size: "1024*1024"
-                        })
-                    });
-
-                    if (!response.ok) throw new Error(`Image Gen Failed: ${response.status}`);
-
-                    const data = await response.json();
-                    const imgUrl = data.url;
+            const renderImage = (index, imgUrl) => {
+                const promptText = prompts[index];
+                slots[index].innerHTML = `
+                    <img src="${imgUrl}" style="width:100%; border-radius:8px; box-shadow:0 2px 8px rgba(0,0,0,0.2);">
+                    <div style="margin-top:5px; font-size:12px; color:#333; overflow:hidden; text-overflow:ellipsis; white-space:nowrap;">${promptText}</div>
+                `;
+                visualData[index] = { url: imgUrl, prompt: promptText };
+            };
 
-                    if (!imgUrl) throw new Error("No URL returned");
+            const renderFailure = (index) => {
+                slots[index].innerHTML = `
+                    <div style="color:#ff4757; font-size:12px; padding:10px; border:1px dashed #ff4757; border-radius:4px; text-align:center;">
+                        <i class="fas fa-exclamation-triangle"></i> 生成失败<br>
+                        <button class="sg-retry-vis-btn btn btn-secondary btn-small" style="margin-top:5px;" data-prompt="${prompts[index].replace(/"/g, '&quot;')}">🔄 重试</button>
+                    </div>
+                `;
+            };
 
-                    const imageDuration = Date.now() - imageStartTime;
-                    performanceMonitor.recordAPICall('image_generation', imageDuration, true);
+            const renderRunning = (index) => {
+                slots[index].innerHTML = `<div class="loading-spinner"></div><p style="font-size:12px;color:#666;margin-top:5px;">镜头 ${index + 1} 仍在生成...</p>`;
+            };
 
-                    // Update UI
-                    imgContainer.innerHTML = `
-                        <img src="${imgUrl}" style="width:100%; border-radius:8px; box-shadow:0 2px 8px rgba(0,0,0,0.2);">
-                        <div style="margin-top:5px; font-size:12px; color:#333; overflow:hidden; text-overflow:ellipsis; white-space:nowrap;">${promptText}</div>
-                    `;
+            // One batch request: the server bounds concurrency and streams each shot as it finishes
+            const batchStartTime = Date.now();
+            const pending = new Set(prompts.map((_, i) => i));
+            const apiBase = CONFIG.API_BASE_URL || '';
+            let batchId = null;
+            let stillRunning = false;
+
+            const handleResult = (item) => {
+                if (!pending.has(item.index)) return;
+                pending.delete(item.index);
+                if (item.status === 'SUCCEEDED' && item.url) {
+                    renderImage(item.index, item.url);
+                    performanceMonitor.recordAPICall('image_generation', Date.now() - batchStartTime, true);
+                } else {
+                    console.error("Image Gen Error", item.error);
+                    renderFailure(item.index);
+                    performanceMonitor.recordAPICall('image_generation', 0, false, new Error(item.error || 'failed'));
+                }
+            };
 
-                    visualData.push({ url: imgUrl, prompt: promptText });
+            try {
+                const response = await fetch(`${apiBase}/api/images/batch`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ prompts, size: "1024*1024" })
+                });
+                if (!response.ok) throw new Error(`Image Batch Failed: ${response.status}`);
+
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+                    for (const line of lines) {
+                        if (!line.trim()) continue;
+                        const item = JSON.parse(line);
+                        if (typeof item.index === 'number') {
+                            handleResult(item);
+                        } else if (item.jobs) {
+                            batchId = item.batch_id; // batch header
+                        } else if (item.done === false) {
+                            // The stream ended before the batch did: these shots are still being drawn
+                            stillRunning = true;
+                            item.pending.forEach(renderRunning);
+                        }
+                    }
+                }
+            } catch (e) {
+                console.error("Image Batch Error", e);
+                performanceMonitor.recordAPICall('image_generation', 0, false, e);
+            }
 
+            // Pick up the rest from the batch status endpoint until every job has finished
+            while (stillRunning && batchId && pending.size > 0) {
+                await new Promise(resolve => setTimeout(resolve, 5000));
+                try {
+                    const response = await fetch(`${apiBase}/api/images/batch/${batchId}`);
+                    if (!response.ok) break;
+                    const batch = await response.json();
+                    batch.jobs.filter(job => job.status === 'SUCCEEDED' || job.status === 'FAILED').forEach(handleResult);
                 } catch (e) {
-                    console.error("Image Gen Error", e);
-                    imgContainer.innerHTML = `
-                        <div style="color:#ff4757; font-size:12px; padding:10px; border:1px dashed #ff4757; border-radius:4px; text-align:center;">
-                            <i class="fas fa-exclamation-triangle"></i> 生成失败<br>
-                            <button class="sg-retry-vis-btn btn btn-secondary btn-small" style="margin-top:5px;" data-prompt="${promptText.replace(/"/g, '&quot;')}">🔄 重试</button>
-                        </div>
-                    `;
-                    performanceMonitor.recordAPICall('image_generation', 0, false, e);
+                    console.error("Image Batch Poll Error", e);
+                    break;
                 }
-            };
+            }
+            pending.forEach(renderFailure);
 
-            // Parallel generation
-            await Promise.all(prompts.map((p, i) => processImage(p, i)));
+            // Keep shot order, drop failures
+            const orderedVisualData = visualData.filter(Boolean);
+            visualData.length = 0;
+            visualData.push(...orderedVisualData);
 
             // Cache & Save
             if (visualData.length > 0) {
@@ -1060,6 +1168,7 @@ export class ScriptGeneratorManager {
 
                 setTimeout(() => {
                     element.remove();
+                    this.historyItems = (this.historyItems || []).filter(item => item.id !== id);
 
                     // 检查是否还有历史记录
                     const remainingItems = document.querySelectorAll('.sg-history-item');
@@ -22,6 +22,7 @@ export class ScriptGenView {
                         <h3 style="margin:0; font-size:1rem;">📂 历史记录</h3>
                         <button id="sg-new-btn" class="btn btn-primary btn-small"><i class="fas fa-plus"></i> 新建</button>
                     </div>
+                    <input type="search" id="sg-history-search" class="form-control" placeholder="搜索脚本..." style="margin-bottom:10px;">
                     <div id="sg-history-list"></div>
                 </div>
 
@@ -306,7 +307,7 @@ export class ScriptGenView {
         `;
     }
 
-    renderHistory(history, activeId, onDelete, onLoad) {
+    renderHistory(history, activeId, onDelete, onLoad, onLoadMore = null) {
         const listEl = document.getElementById('sg-history-list');
         if (!listEl) return;
 
@@ -346,6 +347,54 @@ export class ScriptGenView {
 
             listEl.appendChild(el);
         });
+
+        if (onLoadMore) {
+            const moreBtn = document.createElement('button');
+            moreBtn.className = 'btn btn-secondary btn-block sg-history-more';
+            moreBtn.textContent = '加载更多';
+            moreBtn.addEventListener('click', () => {
+                moreBtn.disabled = true;
+                moreBtn.textContent = '加载中...';
+                onLoadMore();
+            });
+            listEl.appendChild(moreBtn);
+        }
+    }
+
+    renderSearchResults(results, onLoad, onLoadMore = null) {
+        const listEl = document.getElementById('sg-history-list');
+        if (!listEl) return;
+
+        listEl.innerHTML = '';
+        if (results.length === 0) {
+            listEl.innerHTML = '<div style="text-align:center; padding:20px; color:#666;">无匹配结果</div>';
+            return;
+        }
+
+        results.forEach(item => {
+            const el = document.createElement('div');
+            el.className = 'sg-history-item sg-search-hit';
+
+            // snippet 已在服务端转义，仅包含 <mark> 标签
+            el.innerHTML = `
+                <div class="history-title"></div>
+                <div class="history-snippet" style="font-size:0.8rem; color:#888;">${item.snippet}</div>
+            `;
+            el.querySelector('.history-title').textContent = item.title || '未命名';
+            el.addEventListener('click', () => onLoad(item));
+            listEl.appendChild(el);
+        });
+
+        if (onLoadMore) {
+            const moreBtn = document.createElement('button');
+            moreBtn.className = 'btn btn-secondary btn-block sg-history-more';
+            moreBtn.textContent = '加载更多';
+            moreBtn.addEventListener('click', () => {
+                moreBtn.disabled = true;
+                onLoadMore();
+            });
+            listEl.appendChild(moreBtn);
+        }
     }
 
     renderOutput(content) {
@@ -0,0 +1,167 @@
+"""
+RFC 6902 JSON Patch for partial updates of JSON columns (novels.extra_data).
+
+``extra_data`` holds a novel's characters, world settings and outline and grows
+to hundreds of KB. Instead of re-sending it on every save, the editor sends the
+operations that turn the stored document into the new one::
+
+    [{"op": "replace", "path": "/characters/3/name", "value": "林默"},
+     {"op": "add", "path": "/events/-", "value": {...}},
+     {"op": "test", "path": "/chaptersCount", "value": 12}]
+
+All six operations (add, remove, replace, move, copy, test) and RFC 6901 JSON
+Pointers (``~0`` / ``~1`` escapes, ``-`` for the end of an array) are
+supported. A patch is all or nothing: ``apply_patch`` raises on the first
+failing operation and the caller discards the partially patched document.
+"""
+
+import copy
+
+__all__ = ['JsonPatchError', 'JsonPatchTestFailed', 'apply_patch', 'parse_pointer']
+
+
+class JsonPatchError(ValueError):
+    """Malformed patch, or an operation whose target does not exist"""
+
+
+class JsonPatchTestFailed(JsonPatchError):
+    """A ``test`` operation did not match: the document changed underneath the patch"""
+
+
+def parse_pointer(pointer):
+    """RFC 6901 pointer -> list of reference tokens ('' is the whole document)"""
+    if not isinstance(pointer, str):
+        raise JsonPatchError(f"path must be a string: {pointer!r}")
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise JsonPatchError(f"path must start with '/': {pointer!r}")
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _index(container, token, pointer, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise JsonPatchError(f"invalid array index in {pointer!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise JsonPatchError(f"array index out of range in {pointer!r}")
+    return index
+
+
+def _child(container, token, pointer):
+    if isinstance(container, dict):
+        if token not in container:
+            raise JsonPatchError(f"path does not exist: {pointer!r}")
+        return container[token]
+    if isinstance(container, list):
+        return container[_index(container, token, pointer)]
+    raise JsonPatchError(f"path does not exist: {pointer!r}")
+
+
+def _resolve(doc, pointer):
+    value = doc
+    for token in parse_pointer(pointer):
+        value = _child(value, token, pointer)
+    return value
+
+
+def _parent(doc, pointer):
+    tokens = parse_pointer(pointer)
+    container = doc
+    for token in tokens[:-1]:
+        container = _child(container, token, pointer)
+    if not isinstance(container, (dict, list)):
+        raise JsonPatchError(f"path does not exist: {pointer!r}")
+    return container, tokens[-1]
+
+
+def _add(doc, pointer, value):
+    if pointer == '':
+        return value
+    container, token = _parent(doc, pointer)
+    if isinstance(container, dict):
+        container[token] = value
+    else:
+        container.insert(_index(container, token, pointer, allow_end=True), value)
+    return doc
+
+
+def _remove(doc, pointer):
+    if pointer == '':
+        raise JsonPatchError("cannot remove the whole document")
+    container, token = _parent(doc, pointer)
+    if isinstance(container, dict):
+        if token not in container:
+            raise JsonPatchError(f"path does not exist: {pointer!r}")
+        return container.pop(token)
+    return container.pop(_index(container, token, pointer))
+
+
+def _replace(doc, pointer, value):
+    container, token = _parent(doc, pointer)
+    if isinstance(container, dict):
+        container[token] = value
+    else:
+        container[_index(container, token, pointer)] = value
+    return doc
+
+
+def _json_equal(a, b):
+    # JSON keeps booleans and numbers apart, Python's == does not (True == 1)
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_json_equal(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def _operand(op, name):
+    if name not in op:
+        raise JsonPatchError(f"'{op.get('op')}' operation needs '{name}'")
+    return op[name]
+
+
+def apply_patch(doc, patch):
+    """Apply ``patch`` (a list of operations) and return the resulting document
+
+    ``doc`` is modified in place where possible; pass a copy if the original
+    must survive a failed patch.
+    """
+    if not isinstance(patch, list):
+        raise JsonPatchError("patch must be a list of operations")
+    for op in patch:
+        if not isinstance(op, dict):
+            raise JsonPatchError("each operation must be an object")
+        name = op.get('op')
+        path = _operand(op, 'path')
+        if name == 'add':
+            doc = _add(doc, path, _operand(op, 'value'))
+        elif name == 'remove':
+            _remove(doc, path)
+        elif name == 'replace':
+            value = _operand(op, 'value')
+            _resolve(doc, path)
+            doc = _add(doc, path, value) if path == '' else _replace(doc, path, value)
+        elif name == 'move':
+            source = _operand(op, 'from')
+            if path != source:
+                if path.startswith(source + '/'):
+                    raise JsonPatchError(f"cannot move {source!r} into its own child {path!r}")
+                doc = _add(doc, path, _remove(doc, source))
+        elif name == 'copy':
+            doc = _add(doc, path, copy.deepcopy(_resolve(doc, _operand(op, 'from'))))
+        elif name == 'test':
+            if not _json_equal(_resolve(doc, path), _operand(op, 'value')):
+                raise JsonPatchTestFailed(f"test failed at {path!r}")
+        else:
+            raise JsonPatchError(f"unknown operation: {name!r}")
+    return doc
+
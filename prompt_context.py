@@ -0,0 +1,90 @@
+"""
+Token estimation and budget packing for generation prompts.
+
+``estimate_tokens`` is a fast local stand-in for the model's tokenizer:
+about one token per CJK character and one per four other characters, which
+is slightly pessimistic for Qwen-family models on Chinese prose, so a packed
+prompt errs on the side of fitting.
+
+``pack_sections`` fills a token budget from several sections (rolling
+summary, outline, entities, recent paragraphs...). Each section lists its
+items most important first and may claim at most ``share`` of the budget in
+a first pass; whatever is left over is handed out in a second pass in section
+order, so an empty section does not waste its share. Items that do not fit
+whole are skipped, except in sections marked ``truncate``, where the first
+item that does not fit is cut to the remaining room.
+"""
+
+import re
+
+__all__ = ['estimate_tokens', 'truncate_to_tokens', 'pack_sections']
+
+CJK_TOKENS_PER_CHAR = 1.0
+OTHER_CHARS_PER_TOKEN = 4
+
+_CJK = re.compile('[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')   # CJK and fullwidth punctuation
+_SPACE = re.compile(r'\s+')
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    other = len(_SPACE.sub('', text)) - cjk
+    return int(cjk * CJK_TOKENS_PER_CHAR + (other + OTHER_CHARS_PER_TOKEN - 1) // OTHER_CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, budget, keep='start'):
+    """Longest prefix (``keep='start'``) or suffix (``keep='end'``) of ``text`` within ``budget`` tokens"""
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        piece = text[:middle] if keep == 'start' else text[len(text) - middle:]
+        if estimate_tokens(piece) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] if keep == 'start' else text[len(text) - low:]
+
+
+def pack_sections(sections, budget):
+    """Choose items from ``sections`` to fit ``budget`` tokens
+
+    Each section is a dict with ``name``, ``items`` (``(text, tokens)`` pairs,
+    most important first), ``share`` (fraction of the budget it may take in
+    the first pass) and optionally ``truncate`` ('start' or 'end': which part
+    of an item to keep when cutting it). Returns ``({name: [(index, text,
+    tokens), ...]}, tokens used)``, items in their original order.
+    """
+    picked = {section['name']: {} for section in sections}
+    used = 0
+    for first_pass in (True, False):
+        for section in sections:
+            items = picked[section['name']]
+            room = budget - used
+            if first_pass:
+                room = min(room, int(budget * section.get('share', 1.0)))
+            for index, (text, tokens) in enumerate(section['items']):
+                if room <= 0:
+                    break
+                current, current_tokens = items.get(index, (None, 0))
+                if current is text:
+                    continue
+                if current is None and tokens <= room:
+                    cut, cut_tokens = text, tokens
+                elif section.get('truncate'):
+                    # The first item that does not fit is cut to the room left (or a cut one grown)
+                    cut = truncate_to_tokens(text, room + current_tokens, section['truncate'])
+                    cut_tokens = estimate_tokens(cut)
+                    if cut.strip() and cut_tokens > current_tokens:
+                        items[index] = (cut, cut_tokens)
+                        used += cut_tokens - current_tokens
+                    break
+                else:
+                    continue
+                items[index] = (cut, cut_tokens)
+                room -= cut_tokens
+                used += cut_tokens
+    return {name: [(index, *items[index]) for index in sorted(items)] for name, items in picked.items()}, used
@@ -0,0 +1,84 @@
+"""
+Passage splitting and CJK-aware tokenization for chapter retrieval.
+
+Chapters are cut into paragraph-sized passages that are ranked with BM25 by an
+FTS5 table (``passages_fts``). FTS5's unicode61 tokenizer treats a run of
+Chinese characters as one token, so ``index_text`` puts a space between CJK
+characters: every character becomes a token and its position is kept.
+``match_query`` then turns the query's CJK runs into two-character phrases
+("林默" -> ``"林 默"``), which FTS5 matches as adjacent tokens. That is
+character-bigram retrieval without storing the bigrams; Latin words and
+numbers are matched as whole (case-folded) words.
+"""
+
+import re
+
+__all__ = ['split_passages', 'index_text', 'query_terms', 'match_query']
+
+PASSAGE_MIN_CHARS = 80       # shorter paragraphs are merged with the next one
+PASSAGE_MAX_CHARS = 400      # longer ones are cut, preferably at the end of a sentence
+MAX_QUERY_TERMS = 64         # a whole paragraph used as a query keeps its first distinct terms
+
+_CJK = '\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'   # CJK unified ideographs (+ ext. A, compatibility)
+_CJK_CHAR = re.compile(f'([{_CJK}])')
+_TERM = re.compile(f'[{_CJK}]+|[^\\W_]+')
+_SENTENCE_END = re.compile(r'[。！？!?；;…]+[”"』」）)]*')
+
+
+def _cut(text, start, end):
+    """Split text[start:end] into pieces of at most PASSAGE_MAX_CHARS, at sentence ends if possible"""
+    while end - start > PASSAGE_MAX_CHARS:
+        cut = None
+        for match in _SENTENCE_END.finditer(text, start + PASSAGE_MIN_CHARS, start + PASSAGE_MAX_CHARS):
+            cut = match.end()
+        cut = cut or start + PASSAGE_MAX_CHARS
+        yield start, cut
+        start = cut
+    if end > start:
+        yield start, end
+
+
+def split_passages(text):
+    """``(start, length)`` of each passage of ``text``, in order; blank space is left out"""
+    passages = []
+    pending = None
+    for match in re.finditer(r'[^\n]+', text or ''):
+        if not match.group().strip():
+            continue
+        start = pending if pending is not None else match.start()
+        if match.end() - start < PASSAGE_MIN_CHARS:
+            pending = start
+            continue
+        pending = None
+        passages.extend((a, b - a) for a, b in _cut(text, start, match.end()))
+    if pending is not None:
+        end = len(text.rstrip())
+        if passages and passages[-1][0] + passages[-1][1] + PASSAGE_MIN_CHARS > end:
+            # A short tail joins the previous passage instead of standing alone
+            start = passages.pop()[0]
+        else:
+            start = pending
+        passages.append((start, end - start))
+    return passages
+
+
+def index_text(text):
+    """What goes into the FTS column: CJK characters spaced out into single-character tokens"""
+    return _CJK_CHAR.sub(r' \1 ', text)
+
+
+def query_terms(query):
+    """Distinct search terms of ``query``: CJK bigrams (or a lone character) and Latin words"""
+    terms = []
+    for run in _TERM.findall(query or ''):
+        if _CJK_CHAR.match(run):
+            terms.extend([run] if len(run) == 1 else (run[i:i + 2] for i in range(len(run) - 1)))
+        else:
+            terms.append(run.lower())
+    return list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+
+
+def match_query(query):
+    """FTS5 MATCH expression ORing the query's terms as phrases, or None if it has none"""
+    phrases = ['"' + (' '.join(term) if _CJK_CHAR.match(term) else term) + '"' for term in query_terms(query)]
+    return ' OR '.join(phrases) or None
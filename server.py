@@ -1,26 +1,32 @@
 import http.server
 import socketserver
 import json
-import urllib.request
 import urllib.error
+import urllib.parse
 import os
 import sys
 import webbrowser
 import threading
 import time
-import webview
 
 # Refactored Imports
-from db_manager import init_db, db_save_setting, db_get_setting, db_save_script, db_get_history, db_toggle_favorite, db_delete_script
+from db_manager import init_db, close_db, db_save_setting, db_get_setting, db_save_script, db_get_history, db_get_script, db_search, db_toggle_favorite, db_delete_script, get_blob_store
 from export_manager import convert_to_docx, convert_to_xlsx
+from blob_store import blob_url, is_blob_hash
+from upstream_client import upstream_client
+from image_job_manager import image_job_manager
+from summary_pipeline import ChatSummarizer, SummaryScheduler
+from generation_queue import generation_queue
 
 # Server Configuration
 PORT = int(os.getenv('PORT', 5173))
 VERSION = "v2.1.3"
 # Use the compatible-mode endpoint which supports both VL and Text models
 TARGET_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-# Image Gen Endpoint (Flux via DashScope)
-IMAGE_GEN_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis"
+# Image generation runs through image_job_manager; the legacy endpoint waits at most this long
+IMAGE_WAIT_TIMEOUT = 180
+# Seconds after the last chapter save before the novel's summary tree is refreshed (0 = only on request)
+SUMMARY_AUTO_DELAY = float(os.getenv('SUMMARY_AUTO_DELAY', '0'))
 
 def get_base_path():
     if getattr(sys, 'frozen', False):
@@ -32,6 +38,26 @@ def get_base_path():
 
 # --- Database & Export functions imported from db_manager.py and export_manager.py ---
 
+def refresh_novel_summary(novel_id):
+    """Background summary refresh after chapter saves, with the stored API key"""
+    from db_manager import db_refresh_summary
+    api_key = db_get_setting('api_key')
+    if not api_key:
+        # The key only lives in the browser; POST /api/novels/<id>/summary refreshes with it
+        return None
+    return db_refresh_summary(novel_id, ChatSummarizer(f'Bearer {api_key}'))
+
+summary_scheduler = SummaryScheduler(refresh_novel_summary, SUMMARY_AUTO_DELAY)
+
+def schedule_summary(novel_id=None, chapter_id=None):
+    if SUMMARY_AUTO_DELAY <= 0:
+        return
+    if novel_id is None and chapter_id is not None:
+        # Save payloads need not carry novel_id; the chapter row always does
+        from db_manager import db_get_chapter_novel_id
+        novel_id = db_get_chapter_novel_id(chapter_id)
+    summary_scheduler.schedule(novel_id)
+
 def open_browser():
     time.sleep(1) # Wait a bit for server to start
     webbrowser.open(f"http://localhost:{PORT}")
@@ -66,14 +92,75 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps({'version': VERSION, 'port': PORT, 'status': 'online'}).encode())
             return
             
+        if self.path == '/api/upstream/stats':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps(upstream_client.stats()).encode())
+            return
+
+        if self.path.startswith('/api/images/batch/'):
+            # Format: /api/images/batch/<id>
+            batch = image_job_manager.get_batch(self.path.split('?')[0].split('/')[-1])
+            if batch:
+                self._send_json(batch)
+            else:
+                self.send_error(404, "Batch not found")
+            return
+
+        if self.path.startswith('/api/images/jobs/'):
+            # Format: /api/images/jobs/<id> or /api/images/jobs/<id>/events (SSE)
+            parts = self.path.split('?')[0].split('/')
+            job_id = parts[4] if len(parts) > 4 else ''
+            if len(parts) == 6 and parts[5] == 'events':
+                self._stream_image_job(job_id)
+                return
+            job = image_job_manager.get(job_id)
+            if job:
+                self._send_json(job)
+            else:
+                self.send_error(404, "Job not found")
+            return
+
+        if urllib.parse.urlsplit(self.path).path.startswith('/api/generation/jobs'):
+            # Format: /api/generation/jobs[?novel_id=<id>][&status=<state>] -> jobs, newest first
+            #         /api/generation/jobs/<id> -> {status, next_index, done, total, generated, skipped, error, ...}
+            url = urllib.parse.urlsplit(self.path)
+            parts = url.path.split('/')
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                if len(parts) == 5 and parts[4]:
+                    job = generation_queue.get(int(parts[4]))
+                    if job is None:
+                        self.send_error(404, "Job not found")
+                    else:
+                        self._send_json(job)
+                    return
+                novel_id = query.get('novel_id', [None])[0]
+                self._send_json(generation_queue.list(None if novel_id is None else int(novel_id),
+                                                      query.get('status', [None])[0]))
+            except ValueError:
+                self.send_error(400, "Invalid job or novel ID")
+            return
+
         if self.path == '/health':
             self.send_response(200)
             self.end_headers()
             self.wfile.write(b"OK")
             return
             
+        if self.path.startswith('/api/blobs/'):
+            # Format: /api/blobs/<sha256>[?w=128|256|512]
+            url = urllib.parse.urlsplit(self.path)
+            self._send_blob(url.path.split('/')[-1], urllib.parse.parse_qs(url.query).get('w', [None])[0])
+            return
+
         # --- Novel Management Endpoints (GET) ---
-        from db_manager import db_get_novels, db_get_novel, db_get_chapters, db_get_chapter
+        from db_manager import (db_get_novels, db_get_novel, db_get_chapter_index, db_iter_chapters,
+                                db_get_chapter, db_get_chapter_range, db_list_revisions, db_get_revision,
+                                db_list_entities, db_find_entities, db_get_entity, db_get_mentions,
+                                db_retrieve_passages, db_get_summary_tree)
 
         if self.path == '/api/novels':
             self.send_response(200)
@@ -85,18 +172,92 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             return
 
         if self.path.startswith('/api/novels/') and '/chapters' in self.path:
-            # Format: /api/novels/<id>/chapters
+            # Format: /api/novels/<id>/chapters[/index]
+            # /index is the sidebar outline without bodies; the bare form keeps
+            # returning full chapters for existing clients, one row at a time
             try:
-                parts = self.path.split('/')
+                parts = urllib.parse.urlsplit(self.path).path.split('/')
                 novel_id = int(parts[3])
-                chapters = db_get_chapters(novel_id)
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps(chapters).encode())
+                outline = parts[5:6] == ['index']
+            except (IndexError, ValueError):
+                self.send_error(400, "Invalid novel ID")
+                return
+            chapters = db_get_chapter_index(novel_id) if outline else db_iter_chapters(novel_id)
+            self._stream_json_array(chapters)
+            return
+
+        if self.path.startswith('/api/novels/') and '/entities' in self.path:
+            # Format: /api/novels/<id>/entities[?kind=character|location|faction|...]
+            try:
+                url = urllib.parse.urlsplit(self.path)
+                novel_id = int(url.path.split('/')[3])
+            except (IndexError, ValueError):
+                self.send_error(400, "Invalid novel ID")
+                return
+            kind = urllib.parse.parse_qs(url.query).get('kind', [None])[0]
+            self._send_json(db_list_entities(novel_id, kind))
+            return
+
+        if self.path.startswith('/api/novels/') and '/mentions' in self.path:
+            # Format: /api/novels/<id>/mentions            -> per name: chapters, mentions, last_chapter_id
+            #         /api/novels/<id>/mentions?name=<name> -> per chapter: count and offsets
+            try:
+                url = urllib.parse.urlsplit(self.path)
+                novel_id = int(url.path.split('/')[3])
             except (IndexError, ValueError):
                 self.send_error(400, "Invalid novel ID")
+                return
+            name = urllib.parse.parse_qs(url.query).get('name', [None])[0]
+            self._send_json(db_get_mentions(novel_id, name))
+            return
+
+        if self.path.startswith('/api/novels/') and '/retrieve' in self.path:
+            # Format: /api/novels/<id>/retrieve?q=<text>&k=5 -> best matching passages (BM25), best first
+            try:
+                url = urllib.parse.urlsplit(self.path)
+                novel_id = int(url.path.split('/')[3])
+                query = urllib.parse.parse_qs(url.query)
+                k = int(query.get('k', ['5'])[0])
+            except (IndexError, ValueError):
+                self.send_error(400, "Invalid novel ID or k")
+                return
+            self._send_json(db_retrieve_passages(novel_id, query.get('q', [''])[0], k))
+            return
+
+        if self.path.startswith('/api/novels/') and urllib.parse.urlsplit(self.path).path.endswith('/summary'):
+            # Format: /api/novels/<id>/summary -> {"summary", "applied", "nodes": [{level, position,
+            #         first_chapter_id, last_chapter_id, chapters, key, summary}]}, root first
+            try:
+                novel_id = int(self.path.split('/')[3])
+            except (IndexError, ValueError):
+                self.send_error(400, "Invalid novel ID")
+                return
+            tree = db_get_summary_tree(novel_id)
+            if tree is None:
+                self.send_error(404, "Novel not found")
+            else:
+                self._send_json(tree)
+            return
+
+        if self.path.startswith('/api/entities'):
+            # Format: /api/entities?name=<name>[&kind=][&novel_id=]  or  /api/entities/<id> (with the full item)
+            url = urllib.parse.urlsplit(self.path)
+            parts = url.path.split('/')
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                if len(parts) == 4 and parts[3]:
+                    entity = db_get_entity(int(parts[3]))
+                    if entity is None:
+                        self.send_error(404, "Entity not found")
+                    else:
+                        self._send_json(entity)
+                    return
+                novel_id = query.get('novel_id', [None])[0]
+                name = query['name'][0]
+                self._send_json(db_find_entities(name, query.get('kind', [None])[0],
+                                                 None if novel_id is None else int(novel_id)))
+            except (KeyError, ValueError):
+                self.send_error(400, "Expected /api/entities/<id> or /api/entities?name=")
             return
 
         if self.path.startswith('/api/novels/'):
@@ -116,11 +277,43 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(400, "Invalid novel ID")
             return
 
+        if self.path.startswith('/api/chapters/') and '/revisions' in self.path:
+            # Format: /api/chapters/<id>/revisions[?limit=] (newest first, no text)
+            try:
+                url = urllib.parse.urlsplit(self.path)
+                chapter_id = int(url.path.split('/')[3])
+                limit = int(urllib.parse.parse_qs(url.query).get('limit', ['100'])[0])
+            except (IndexError, ValueError):
+                self.send_error(400, "Invalid chapter ID")
+                return
+            self._send_json(db_list_revisions(chapter_id, max(1, min(limit, 500))))
+            return
+
+        if self.path.startswith('/api/revisions/'):
+            # Format: /api/revisions/<id> (with reconstructed content)
+            try:
+                revision = db_get_revision(int(urllib.parse.urlsplit(self.path).path.split('/')[-1]))
+            except ValueError:
+                self.send_error(400, "Invalid revision ID")
+                return
+            if revision:
+                self._send_json(revision)
+            else:
+                self.send_error(404, "Revision not found")
+            return
+
         if self.path.startswith('/api/chapters/'):
-            # Format: /api/chapters/<id>
+            # Format: /api/chapters/<id>[?offset=&length=] (character range of content)
             try:
-                chapter_id = int(self.path.split('/')[-1])
-                chapter = db_get_chapter(chapter_id)
+                url = urllib.parse.urlsplit(self.path)
+                chapter_id = int(url.path.split('/')[-1])
+                query = urllib.parse.parse_qs(url.query)
+                if 'offset' in query or 'length' in query:
+                    length = query.get('length', [None])[0]
+                    chapter = db_get_chapter_range(chapter_id, int(query.get('offset', ['0'])[0]),
+                                                   None if length is None else int(length))
+                else:
+                    chapter = db_get_chapter(chapter_id)
                 if chapter:
                     self.send_response(200)
                     self.send_header('Content-Type', 'application/json')
@@ -134,15 +327,61 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             return
 
         if self.path.startswith('/api/history'):
+            # Query: limit, favorites=1, before_created_at + before_id (date/id of the last item already shown)
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            try:
+                limit = max(1, min(int(query.get('limit', ['50'])[0]), 200))
+                before_id = int(query['before_id'][0]) if 'before_id' in query else None
+            except ValueError:
+                self.send_error(400, "Invalid pagination parameters")
+                return
+            history = db_get_history(
+                limit=limit,
+                only_favorites=query.get('favorites', ['0'])[0] in ('1', 'true'),
+                before_created_at=query.get('before_created_at', [None])[0],
+                before_id=before_id
+            )
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
             self.end_headers()
-            history = db_get_history()
             self.wfile.write(json.dumps(history).encode())
             return
+
+        if self.path.startswith('/api/search'):
+            # Query: q, type=all|scripts|chapters, limit, offset
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            q = query.get('q', [''])[0].strip()
+            kind = query.get('type', ['all'])[0]
+            if not q or kind not in ('all', 'scripts', 'chapters'):
+                self.send_error(400, "Missing query or invalid type")
+                return
+            try:
+                limit = max(1, min(int(query.get('limit', ['20'])[0]), 100))
+                offset = max(0, int(query.get('offset', ['0'])[0]))
+            except ValueError:
+                self.send_error(400, "Invalid pagination parameters")
+                return
+            result = db_search(q, kind=kind, limit=limit, offset=offset)
+            result.update({'query': q, 'limit': limit, 'offset': offset})
+            self._send_json(result)
+            return
+
+        if self.path.startswith('/api/scripts/'):
+            # Format: /api/scripts/<id> (full content + metadata, loaded when a history item is opened)
+            try:
+                script_id = int(self.path.split('?')[0].split('/')[-1])
+            except ValueError:
+                self.send_error(400, "Invalid script ID")
+                return
+            script = db_get_script(script_id)
+            if script:
+                self._send_json(script)
+            else:
+                self.send_error(404, "Script not found")
+            return
             
         if self.path.lower().startswith('/91writing/'):
             try:
@@ -346,21 +585,87 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(500, str(e))
             return
             
+        if self.path.startswith('/api/novels/') and self.path.endswith('/context'):
+            # Format: /api/novels/<id>/context
+            # Body: {"budget": tokens, "system_prompt", "chapter_id", "query", "paragraphs", "k"}
+            # -> {"system", "context", "tokens", "budget", "sections": [{name, tokens, items, available}]}
+            from db_manager import db_build_context, CONTEXT_RECENT_PARAGRAPHS
+            try:
+                novel_id = int(self.path.split('/')[3])
+                data = self._read_json()
+                chapter_id = data.get('chapter_id')
+                result = db_build_context(
+                    novel_id, int(data['budget']), data.get('system_prompt') or '',
+                    None if chapter_id is None else int(chapter_id), data.get('query') or None,
+                    int(data.get('paragraphs', CONTEXT_RECENT_PARAGRAPHS)), int(data.get('k', 3)))
+            except (KeyError, ValueError, TypeError, AttributeError):
+                self._send_json({'error': 'expected {"budget": n, ...}'}, 400)
+                return
+            if result is None:
+                self.send_error(404, "Novel not found")
+            else:
+                self._send_json(result)
+            return
+
+        if self.path.startswith('/api/novels/') and self.path.endswith('/summary'):
+            # Format: /api/novels/<id>/summary -> refresh the summary tree now (only new nodes call the model)
+            # -> {"summary", "chapters", "levels", "computed", "applied"}
+            from db_manager import db_refresh_summary
+            try:
+                novel_id = int(self.path.split('/')[3])
+            except (IndexError, ValueError):
+                self.send_error(400, "Invalid novel ID")
+                return
+            try:
+                result = db_refresh_summary(novel_id, ChatSummarizer(self._auth_header()))
+            except urllib.error.HTTPError as e:
+                self._send_json({'error': f'upstream returned {e.code}'}, 502)
+                return
+            except Exception as e:
+                print(f"[ERROR] Summary Refresh Failed: {e}")
+                self._send_json({'error': str(e)}, 502)
+                return
+            if result is None:
+                self.send_error(404, "Novel not found")
+            else:
+                self._send_json(result)
+            return
+
+        if self.path == '/api/blobs':
+            # Body: {"data": "data:<type>;base64,..."} -> {"hash", "url"}
+            try:
+                blob_hash = get_blob_store().put_data_url(self._read_json().get('data'))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                blob_hash = None
+            if blob_hash:
+                self._send_json({'hash': blob_hash, 'url': blob_url(blob_hash)})
+            else:
+                self._send_json({'error': 'data must be a base64 data URL'}, 400)
+            return
+
         # --- Novel Management Endpoints ---
-        from db_manager import db_save_novel, db_delete_novel, db_save_chapter, db_delete_chapter
+        from db_manager import (db_queue_save_novel, db_delete_novel, db_queue_save_chapter, db_get_chapter_version,
+                                db_delete_chapter, db_restore_revision, db_flush_saves)
+
+        if self.path == '/api/saves/flush':
+            self._send_json({'written': db_flush_saves()})
+            return
 
-        if self.path == '/api/novels/save':
+        if urllib.parse.urlsplit(self.path).path == '/api/novels/save':
+            # Autosaves are coalesced; ?flush=true (or "flush": true) writes before replying
             try:
                 content_length = int(self.headers['Content-Length'])
                 post_data = self.rfile.read(content_length)
                 data = json.loads(post_data.decode())
                 
-                novel_id = db_save_novel(data)
+                novel_id = db_queue_save_novel(data, flush=self._wants_flush(data))
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
                 self.send_header('Access-Control-Allow-Origin', '*')
                 self.end_headers()
                 self.wfile.write(json.dumps({'id': novel_id}).encode())
+            except ValueError as e:
+                self.send_error(400, str(e))
             except Exception as e:
                 print(f"[ERROR] Save Novel Failed: {e}")
                 self.send_error(500, str(e))
@@ -383,23 +688,41 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(500, str(e))
             return
 
-        if self.path == '/api/chapters/save':
+        if urllib.parse.urlsplit(self.path).path == '/api/chapters/save':
             try:
                 content_length = int(self.headers['Content-Length'])
                 post_data = self.rfile.read(content_length)
                 data = json.loads(post_data.decode())
                 
-                chapter_id = db_save_chapter(data)
+                chapter_id = db_queue_save_chapter(data, flush=self._wants_flush(data))
+                schedule_summary(chapter_id=chapter_id)
+                # Counts a buffered save, so the client can base its next PATCH on it either way
+                result = {'id': chapter_id, 'version': db_get_chapter_version(chapter_id)}
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
                 self.send_header('Access-Control-Allow-Origin', '*')
                 self.end_headers()
-                self.wfile.write(json.dumps({'id': chapter_id}).encode())
+                self.wfile.write(json.dumps(result).encode())
+            except ValueError as e:
+                self.send_error(400, str(e))
             except Exception as e:
                 print(f"[ERROR] Save Chapter Failed: {e}")
                 self.send_error(500, str(e))
             return
 
+        if self.path == '/api/revisions/restore':
+            # Body: {"id": <revision id>} -> {"chapter_id"}
+            try:
+                chapter_id = db_restore_revision(int(self._read_json()['id']))
+            except (KeyError, TypeError, ValueError):
+                self._send_json({'error': 'id is required'}, 400)
+                return
+            if chapter_id is None:
+                self.send_error(404, "Revision not found")
+            else:
+                self._send_json({'chapter_id': chapter_id})
+            return
+
         if self.path == '/api/chapters/delete':
             try:
                 content_length = int(self.headers['Content-Length'])
@@ -417,89 +740,126 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(500, str(e))
             return
 
-        if self.path == '/api/proxy/image':
+        if self.path == '/api/images/jobs':
+            # Non-blocking: returns the job id immediately, poll or subscribe for the result
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode())
-                
-                # Get API Key
-                auth_header = self.headers.get('Authorization', '')
-                if not auth_header or 'Bearer null' in auth_header:
-                    stored_key = db_get_setting('api_key')
-                    if stored_key:
-                        auth_header = f'Bearer {stored_key}'
-                
-                # Helper function to try generation
-                def try_generate(model_name):
-                    print(f"Trying image generation with model: {model_name}")
-                    payload = {
-                        "model": model_name,
-                        "input": {
-                            "prompt": data.get('prompt')
-                        },
-                        "parameters": {
-                            "size": "1024*1024", # Wanx supports 1024*1024
-                            "n": 1
-                        }
-                    }
-                    
-                    req = urllib.request.Request(IMAGE_GEN_URL, data=json.dumps(payload).encode(), method='POST')
-                    req.add_header('Content-Type', 'application/json')
-                    req.add_header('Authorization', auth_header)
-                    req.add_header('X-DashScope-Async', 'enable')
-                    
-                    with urllib.request.urlopen(req) as response:
-                        task_res = json.loads(response.read())
-                        task_id = task_res.get('output', {}).get('task_id')
-                        return task_id
-
-                # Try Flux first, then fallback to Wanx
-                task_id = None
-                try:
-                    task_id = try_generate("flux-merge") # Try flux-merge instead of schnell
-                except urllib.error.HTTPError as e:
-                    print(f"Flux generation failed: {e}")
-                    if e.code == 403 or e.code == 400: # Forbidden or Bad Request (model not found)
-                        print("Falling back to wanx-v1...")
-                        task_id = try_generate("wanx-v1")
+                data = self._read_json()
+                if not data.get('prompt'):
+                    self.send_error(400, "Missing prompt")
+                    return
+                job = image_job_manager.submit(data['prompt'], self._auth_header(),
+                                               data.get('size') or '1024*1024')
+                self._send_json(job, 202)
+            except Exception as e:
+                print(f"[ERROR] Image Job Submit Failed: {e}")
+                self.send_error(500, str(e))
+            return
+
+        if self.path == '/api/generation/jobs':
+            # Body: {"novel_id", "first_index", "last_index" (chapters.order_index, inclusive), "prompt_template",
+            #        "system_prompt", "model", "context_budget", "overwrite"} -> the queued job
+            from db_manager import GENERATION_CONTEXT_BUDGET
+            try:
+                data = self._read_json()
+                job = generation_queue.submit(
+                    int(data['novel_id']), data['first_index'], data['last_index'], data['prompt_template'],
+                    self._auth_header(), data.get('system_prompt') or '', data.get('model'),
+                    data.get('context_budget') or GENERATION_CONTEXT_BUDGET, bool(data.get('overwrite')))
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                self._send_json({'error': str(e) or 'invalid job'}, 400)
+                return
+            if job is None:
+                self.send_error(404, "Novel not found")
+            else:
+                self._send_json(job, 202)
+            return
+
+        if self.path.startswith('/api/generation/jobs/'):
+            # Format: /api/generation/jobs/<id>/pause | resume | cancel -> the job, 409 if not in a state for it
+            parts = self.path.split('?')[0].split('/')
+            action = parts[5] if len(parts) == 6 else ''
+            if action not in ('pause', 'resume', 'cancel'):
+                self.send_error(404, "Endpoint not found")
+                return
+            try:
+                job_id = int(parts[4])
+            except ValueError:
+                self.send_error(400, "Invalid job ID")
+                return
+            if generation_queue.get(job_id) is None:
+                self.send_error(404, "Job not found")
+                return
+            if action == 'resume':
+                job = generation_queue.resume(job_id, self._auth_header())
+            else:
+                job = getattr(generation_queue, action)(job_id)
+            if job is None:
+                self._send_json({'error': f'job cannot {action} in its current state',
+                                 'job': generation_queue.get(job_id)}, 409)
+            else:
+                self._send_json(job)
+            return
+
+        if self.path == '/api/images/batch':
+            # Streams one NDJSON line per finished job, in completion order (use "index" to place it)
+            try:
+                data = self._read_json()
+                prompts = data.get('prompts')
+                if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+                    self.send_error(400, "prompts must be a non-empty list of strings")
+                    return
+                batch = image_job_manager.submit_batch(prompts, self._auth_header(),
+                                                       data.get('size') or '1024*1024',
+                                                       data.get('concurrency'))
+            except (ValueError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                print(f"[ERROR] Image Batch Submit Failed: {e}")
+                self.send_error(500, str(e))
+                return
+
+            self._start_chunked(200, 'application/x-ndjson; charset=utf-8')
+            try:
+                header = {'batch_id': batch['id'], 'total': batch['total'],
+                          'jobs': [job['id'] for job in batch['jobs']]}
+                self._write_chunk((json.dumps(header) + "\n").encode())
+                succeeded = failed = 0
+                reported = set()
+                # Jobs run ``concurrency`` at a time, so the last wave starts after the ones before it
+                waves = -(-batch['total'] // batch['concurrency'])
+                for job in image_job_manager.iter_batch_results(batch['id'], timeout=IMAGE_WAIT_TIMEOUT * waves):
+                    reported.add(job['id'])
+                    if job['status'] == 'SUCCEEDED':
+                        succeeded += 1
                     else:
-                        raise e
-                except Exception as e:
-                     print(f"Flux error: {e}")
-                     print("Falling back to wanx-v1...")
-                     task_id = try_generate("wanx-v1")
-
-                if not task_id:
-                    raise Exception("Failed to get task_id")
-                    
-                # Poll for result
-                import time
-                for _ in range(120): # Wait up to 120s (2 minutes)
-                    time.sleep(1)
-                    task_url = f"https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}"
-                    task_req = urllib.request.Request(task_url)
-                    task_req.add_header('Authorization', auth_header)
-                    
-                    with urllib.request.urlopen(task_req) as tr:
-                        task_data = json.loads(tr.read())
-                        status = task_data['output']['task_status']
-                        if status == 'SUCCEEDED':
-                            # Found image
-                            img_url = task_data['output']['results'][0]['url']
-                            self.send_response(200)
-                            self.send_header('Content-Type', 'application/json')
-                            self.end_headers()
-                            self.wfile.write(json.dumps({'url': img_url}).encode())
-                            return
-                        elif status in ['FAILED', 'CANCELED']:
-                            raise Exception(f"Task failed: {task_data['output'].get('message', 'Unknown error')}")
-                            
-                raise Exception("Image generation timed out")
+                        failed += 1
+                    self._write_chunk((json.dumps(job) + "\n").encode())
+                # Jobs not reported yet are still running: the client polls GET /api/images/batch/<id> for them
+                pending = [job['index'] for job in batch['jobs'] if job['id'] not in reported]
+                summary = {'done': not pending, 'succeeded': succeeded, 'failed': failed, 'pending': pending}
+                self._write_chunk((json.dumps(summary) + "\n").encode())
+                self._end_chunked()
+            except (BrokenPipeError, ConnectionResetError):
+                # Jobs keep running; the client can pick results up via GET /api/images/batch/<id>
+                print(f"⚠️ Batch client disconnected: {batch['id']}", flush=True)
+            return
 
-            except urllib.error.HTTPError as e:
-                print(f"[ERROR] Image Gen HTTP Error: {e.code} - {e.reason}")
-                self.send_error(e.code, f"Upstream Error: {e.reason}")
+        if self.path == '/api/proxy/image':
+            # Legacy synchronous endpoint: waits on the job engine instead of polling in this thread
+            try:
+                data = self._read_json()
+                submitted = image_job_manager.submit(data.get('prompt'), self._auth_header(),
+                                                     data.get('size') or '1024*1024')
+                job = image_job_manager.wait_for_result(submitted['id'], timeout=IMAGE_WAIT_TIMEOUT)
+                if job is None:
+                    raise Exception("Image job lost")
+                if job['status'] == 'SUCCEEDED':
+                    self._send_json({'url': job['url']})
+                elif job['status'] == 'FAILED':
+                    self.send_error(job['error_code'] or 500, job['error'])
+                else:
+                    self.send_error(504, "Image generation timed out")
             except Exception as e:
                 print(f"[ERROR] Image Gen Error: {e}")
                 self.send_error(500, str(e))
@@ -511,14 +871,7 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 post_data = self.rfile.read(content_length)
                 
                 # Handle API Key injection
-                auth_header = self.headers.get('Authorization', '')
-                if not auth_header or 'Bearer null' in auth_header or 'Bearer undefined' in auth_header or 'Bearer internal' in auth_header:
-                    # Try to get from DB
-                    stored_key = db_get_setting('api_key')
-                    if stored_key:
-                        auth_header = f'Bearer {stored_key}'
-                    else:
-                        print("Warning: No API Key found in header or DB", flush=True)
+                auth_header = self._auth_header()
 
                 # Forward headers
                 headers = {
@@ -534,10 +887,19 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 except:
                     print(f"📦 Request Body (binary, size: {len(post_data)})")
 
-                req = urllib.request.Request(TARGET_URL, data=post_data, headers=headers, method='POST')
-                
+                # Streaming mode: the client asked for SSE chunks ("stream": true)
+                try:
+                    wants_stream = json.loads(post_data.decode('utf-8')).get('stream') is True
+                except (ValueError, AttributeError):
+                    wants_stream = False
+                if wants_stream:
+                    headers['Accept'] = 'text/event-stream'
+
                 try:
-                    with urllib.request.urlopen(req, timeout=300) as response:
+                    if wants_stream:
+                        self._proxy_stream(post_data, headers)
+                        return
+                    with upstream_client.request('POST', TARGET_URL, body=post_data, headers=headers, timeout=300) as response:
                         res_data = response.read()
                         print(f"✅ API Response: {response.status}")
                         
@@ -577,10 +939,199 @@ class ProxyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         else:
             self.send_error(404, "Endpoint not found")
 
+    # --- Request / response helpers ---
+
+    def _read_json(self):
+        content_length = int(self.headers['Content-Length'])
+        return json.loads(self.rfile.read(content_length).decode())
+
+    def _wants_flush(self, data):
+        flag = data.pop('flush', False) if isinstance(data, dict) else False
+        flag = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('flush', [flag])[0]
+        return flag is True or str(flag).lower() in ('1', 'true', 'yes')
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_blob(self, blob_hash, width=None):
+        """Serve a stored blob; its URL names its content, so it may be cached forever"""
+        if not is_blob_hash(blob_hash):
+            self.send_error(400, "Invalid blob hash")
+            return
+        width = int(width) if width and width.isdigit() else None
+        etag = f'"{blob_hash}-{width}"' if width else f'"{blob_hash}"'
+        cache_control = 'public, max-age=31536000, immutable'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+        store = get_blob_store()
+        blob = store.read_thumbnail(blob_hash, width) if width else store.read(blob_hash)
+        if blob is None:
+            self.send_error(404, "Blob not found")
+            return
+        data, content_type = blob
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', etag)
+        # Uploaded bytes are untrusted: no sniffing, and no scripts if an SVG is opened directly
+        self.send_header('X-Content-Type-Options', 'nosniff')
+        self.send_header('Content-Security-Policy', "default-src 'none'; style-src 'unsafe-inline'; sandbox")
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _auth_header(self):
+        """Authorization header from the client, falling back to the stored API key"""
+        auth_header = self.headers.get('Authorization', '')
+        if not auth_header or 'Bearer null' in auth_header or 'Bearer undefined' in auth_header or 'Bearer internal' in auth_header:
+            stored_key = db_get_setting('api_key')
+            if stored_key:
+                auth_header = f'Bearer {stored_key}'
+            else:
+                print("Warning: No API Key found in header or DB", flush=True)
+        return auth_header
+
+    # --- Chunked / SSE helpers ---
+
+    def _start_chunked(self, status, content_type):
+        # Chunked framing needs an HTTP/1.1 status line; the connection is closed
+        # afterwards so the rest of the handler keeps its one-request semantics.
+        self.protocol_version = 'HTTP/1.1'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        if not data:
+            return
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _stream_json_array(self, items):
+        """Send an iterable of dicts as one JSON array, an element per chunk"""
+        self._start_chunked(200, 'application/json')
+        self._write_chunk(b'[')
+        for i, item in enumerate(items):
+            self._write_chunk((',' if i else '').encode() + json.dumps(item).encode())
+        self._write_chunk(b']')
+        self._end_chunked()
+
+    def _proxy_stream(self, post_data, headers):
+        """Forward upstream SSE events to the client one event at a time."""
+        with upstream_client.request('POST', TARGET_URL, body=post_data, headers=headers,
+                                     timeout=300, stream=True) as response:
+            print(f"✅ API Stream opened: {response.status}", flush=True)
+            self._start_chunked(response.status, 'text/event-stream; charset=utf-8')
+            event = b''
+            events = 0
+            try:
+                for line in response:
+                    event += line
+                    # A blank line terminates an SSE event: flush it immediately
+                    if line in (b'\n', b'\r\n'):
+                        self._write_chunk(event)
+                        events += 1
+                        event = b''
+                if event:
+                    self._write_chunk(event)
+                self._end_chunked()
+            except (BrokenPipeError, ConnectionResetError):
+                print(f"⚠️ Client disconnected after {events} events", flush=True)
+                return
+            except Exception as e:
+                # Headers are already sent, so report the failure in-band
+                print(f"❌ Stream Exception: {e}", flush=True)
+                error_event = json.dumps({'error': {'message': str(e)}})
+                self._write_chunk(f"data: {error_event}\n\n".encode())
+                self._end_chunked()
+                return
+            print(f"✅ API Stream finished: {events} events", flush=True)
+
+    def _stream_image_job(self, job_id):
+        """SSE feed of one image job: an event per state change, ends when the job finishes."""
+        job = image_job_manager.get(job_id)
+        if job is None:
+            self.send_error(404, "Job not found")
+            return
+        self._start_chunked(200, 'text/event-stream; charset=utf-8')
+        try:
+            version = -1
+            while True:
+                job = image_job_manager.wait(job_id, since_version=version, timeout=15)
+                if job is None:
+                    break
+                if job['version'] == version and job['status'] not in ('SUCCEEDED', 'FAILED'):
+                    self._write_chunk(b": keep-alive\n\n")
+                    continue
+                version = job['version']
+                self._write_chunk(f"event: status\ndata: {json.dumps(job)}\n\n".encode())
+                if job['status'] in ('SUCCEEDED', 'FAILED'):
+                    break
+            self._end_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"⚠️ Image job subscriber disconnected: {job_id}", flush=True)
+
+    def do_PATCH(self):
+        # Format: /api/chapters/<id>
+        # Body: {"base_version": n | "base_hash": sha1, "ops": [[offset, delete_count, insert], ...],
+        #        "fields": {title, description, word_count, status, order_index}, "hash": sha1 of the result}
+        # Format: /api/novels/<id>
+        # Body: {"extra_data": [RFC 6902 operations], "fields": {title, ..., rolling_summary, status}}
+        from db_manager import db_patch_chapter, db_patch_novel, ChapterConflict
+        from json_patch import JsonPatchTestFailed
+
+        parts = urllib.parse.urlsplit(self.path).path.split('/')
+        if len(parts) != 4 or parts[:3] not in (['', 'api', 'chapters'], ['', 'api', 'novels']):
+            self.send_error(404, "Not found")
+            return
+        try:
+            record_id = int(parts[3])
+            data = self._read_json()
+            if parts[2] == 'novels':
+                result = db_patch_novel(record_id, data.get('extra_data'), data.get('fields'))
+            else:
+                result = db_patch_chapter(record_id, data.get('ops', []), data.get('base_version'),
+                                          data.get('base_hash'), data.get('fields'), data.get('hash'))
+                if result is not None:
+                    schedule_summary(result['novel_id'])
+        except ChapterConflict as e:
+            self._send_json({'error': 'conflict', 'version': e.version, 'hash': e.content_hash}, 409)
+            return
+        except JsonPatchTestFailed as e:
+            self._send_json({'error': 'conflict', 'detail': str(e)}, 409)
+            return
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json({'error': str(e)}, 400)
+            return
+        if result is None:
+            self.send_error(404, "Chapter not found" if parts[2] == 'chapters' else "Novel not found")
+        else:
+            self._send_json(result)
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'POST, GET, PATCH, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
         self.end_headers()
 
@@ -602,8 +1153,14 @@ def start_server():
             print("\nServer stopped.")
 
 if __name__ == '__main__':
+    # The native window is only needed here; the handler itself runs headless (tests, plain browser)
+    import webview
+
     # Initialize DB on startup (ensure tables exist)
     init_db()
+    # Batch generation resumes jobs interrupted by the last exit; new chapters refresh the summary tree
+    generation_queue.on_chapter = lambda novel_id, chapter_id: schedule_summary(novel_id)
+    generation_queue.start()
 
     # Start server in a separate thread
     server_thread = threading.Thread(target=start_server, daemon=True)
@@ -622,4 +1179,8 @@ if __name__ == '__main__':
         min_size=(1024, 768)
     )
     
-    webview.start()
+    try:
+        webview.start()
+    finally:
+        # Flushes buffered autosaves before exit
+        close_db()
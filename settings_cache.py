@@ -0,0 +1,111 @@
+"""
+In-process cache of the ``settings`` table shared by server.py and the Flask app.
+
+The API key is read on every proxied call. Instead of a SQLite round trip per
+read, the whole (tiny) table is held in memory and only reloaded when
+``PRAGMA data_version`` reports that another connection - in this process or
+another one - has committed to the database since the last load.
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class SettingsCache:
+    """Thread-safe, versioned copy of the settings table for one database file
+
+    ``version`` increases every time the cached values are reloaded. Writers
+    call ``invalidate`` after committing rather than writing the value in:
+    two saves can finish in either order, and only the committed row is
+    sure to be the latest.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = None
+        self._values = {}
+        self._data_version = None
+        self.version = 0
+        self.reloads = 0
+        self.hits = 0
+
+    def _connection(self):
+        # Dedicated connection: data_version is only meaningful on the same
+        # connection, and only moves for commits made by *other* connections
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        return self._conn
+
+    def _refresh(self):
+        """Reload if the database changed since the last load (lock must be held)"""
+        conn = self._connection()
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            self.hits += 1
+            return
+        try:
+            rows = conn.execute('SELECT key, value FROM settings').fetchall()
+        except sqlite3.OperationalError:
+            # Table not created yet (init_db has not run)
+            rows = []
+        self._values = dict(rows)
+        self._data_version = data_version
+        self.version += 1
+        self.reloads += 1
+
+    def load(self):
+        """Warm the cache (called once at startup)"""
+        with self._lock:
+            self._data_version = None
+            self._refresh()
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._refresh()
+            return self._values.get(key, default)
+
+    def invalidate(self):
+        """Force a reload on the next read (call after committing a change to the table)"""
+        with self._lock:
+            self._data_version = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self.version,
+                'keys': len(self._values),
+                'reloads': self.reloads,
+                'hits': self.hits,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._data_version = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_settings_cache(db_file):
+    """Shared cache per database file, so every DatabaseManager/db_manager call sees one copy"""
+    key = os.path.abspath(db_file)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = SettingsCache(db_file)
+            _caches[key] = cache
+        return cache
+
+
+def close_settings_caches():
+    with _caches_lock:
+        caches = list(_caches.values())
+        _caches.clear()
+    for cache in caches:
+        cache.close()
@@ -0,0 +1,119 @@
+"""
+Bounded pool of long-lived SQLite connections, shared by db_manager (desktop
+server) and the Flask DatabaseManager.
+
+Connections are opened once with the pragmas below and handed out from a LIFO
+queue; the database itself is switched to WAL by the schema setup code.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from text_codec import register_functions
+
+# Connection pool settings (overridable through the environment)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))      # page cache per connection
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(128 * 1024 * 1024)))
+
+# Applied to every pooled connection when it is opened
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA foreign_keys=ON',
+    f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}',
+    f'PRAGMA mmap_size={DB_MMAP_SIZE}',
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections shared by all request threads
+
+    Both servers start a fresh thread per request, so connections are
+    handed out from a shared LIFO queue rather than kept thread-local (which
+    would reopen one per request and never reuse it).
+    """
+
+    def __init__(self, db_file, size=DB_POOL_SIZE, timeout=DB_BUSY_TIMEOUT):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.created = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        # Triggers and views over compressed columns call dz_decompress()
+        register_functions(conn)
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError(f"database connection pool exhausted ({self.size})")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken or self._closed:
+            conn.close()
+        else:
+            conn.row_factory = None
+            self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; uncommitted work is rolled back if the block raises"""
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+            raise
+        finally:
+            if not broken and conn.in_transaction:
+                conn.rollback()
+            self.release(conn, broken)
+
+    def stats(self):
+        # No file path here: ping() feeds the unauthenticated /health probe
+        return {
+            'size': self.size,
+            'created': self.created,
+            'idle': self._idle.qsize(),
+        }
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def ping(self):
+        """Cheap liveness probe: a read-only SELECT 1 on a pooled connection"""
+        with self.connection() as conn:
+            conn.execute('SELECT 1').fetchone()
+        return self.stats()
@@ -0,0 +1,111 @@
+"""
+Incremental rolling summary: chapter summaries merged up a fixed-fanout tree.
+
+Every chapter gets a summary of its own text, and every group of
+``SUMMARY_FANOUT`` consecutive summaries is merged into one, level by level,
+until a single summary covers the whole book. Each summary is cached under a
+key derived from its input (the chapter's content hash, or the keys of the
+summaries it merges), so after one chapter is edited only that chapter's
+summary and the ``log(chapters)`` merges above it have new keys; everything
+else is a cache hit. The tree walk itself lives in ``db_manager``
+(``db_refresh_summary``); this module talks to the model.
+
+``ChatSummarizer`` calls an OpenAI-compatible chat completions endpoint
+(DashScope's compatible mode by default; ``SUMMARY_API_URL`` points it at a
+local stand-in). ``SummaryScheduler`` batches the refreshes chapter saves ask
+for, so a burst of autosaves costs one pass.
+"""
+
+import logging
+import os
+
+from prompt_context import truncate_to_tokens
+from upstream_client import upstream_client
+from write_buffer import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ChatSummarizer', 'SummaryScheduler', 'build_prompt']
+
+SUMMARY_API_URL = os.getenv('SUMMARY_API_URL', "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions")
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'qwen-plus')
+SUMMARY_CHARS = 300                 # asked-for length of every summary
+SUMMARY_INPUT_TOKENS = 24000        # longer chapters are cut (their start is kept)
+SUMMARY_TIMEOUT = 120
+
+PROMPTS = {
+    'chapter': ("请用不超过{chars}字概括以下小说章节的主要情节、人物动向和埋下的伏笔，只输出摘要正文。\n\n"
+                "章节：{title}\n\n{text}"),
+    'merge': ("以下是小说连续若干章节（或章节段落）的摘要，按时间顺序排列。请把它们合并为一段不超过{chars}字的连贯摘要，"
+              "保留关键情节、人物关系的变化和尚未解决的伏笔，只输出摘要正文。\n\n{text}"),
+}
+
+
+def build_prompt(kind, title, text):
+    """User message asking for a ``kind`` ('chapter' or 'merge') summary of ``text``"""
+    text = truncate_to_tokens(text or '', SUMMARY_INPUT_TOKENS)
+    return PROMPTS[kind].format(chars=SUMMARY_CHARS, title=title or '', text=text)
+
+
+class ChatSummarizer:
+    """``summarize(kind, title, text) -> str`` through the upstream chat completions API"""
+
+    def __init__(self, auth_header, client=upstream_client, url=None, model=None, timeout=SUMMARY_TIMEOUT):
+        self.auth_header = auth_header
+        self.client = client
+        self.url = url or SUMMARY_API_URL
+        self.model = model or SUMMARY_MODEL
+        self.timeout = timeout
+        self.calls = 0
+
+    def __call__(self, kind, title, text):
+        payload = {
+            'model': self.model,
+            'messages': [{'role': 'user', 'content': build_prompt(kind, title, text)}],
+        }
+        self.calls += 1
+        response = self.client.request('POST', self.url, body=payload, headers={
+            'Content-Type': 'application/json',
+            'Authorization': self.auth_header,
+        }, timeout=self.timeout)
+        try:
+            content = response.json()['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise ValueError(f"unexpected chat completion response: {e}") from e
+        return (content or '').strip()
+
+
+class SummaryScheduler:
+    """Refreshes a novel's summary tree ``delay`` seconds after the first save that needs it
+
+    ``refresh_fn(novel_id)`` does the work; failures (no API key, upstream
+    down) are logged and not retried until the novel changes again. Pending
+    refreshes are dropped at exit: the cache makes the next one just as cheap.
+    """
+
+    def __init__(self, refresh_fn, delay=30.0):
+        self.refresh_fn = refresh_fn
+        self.delay = delay
+        self.failures = 0
+        self._buffer = WriteBehindBuffer(self._refresh, window=delay)
+
+    def schedule(self, novel_id):
+        if novel_id is not None:
+            self._buffer.put(int(novel_id), True)
+
+    def _refresh(self, items):
+        for novel_id, _ in items:
+            try:
+                self.refresh_fn(novel_id)
+            except Exception:
+                self.failures += 1
+                logger.exception("Summary refresh for novel %s failed", novel_id)
+
+    def flush(self):
+        """Run every scheduled refresh now; returns how many novels were refreshed"""
+        return self._buffer.flush()
+
+    def stats(self):
+        stats = self._buffer.stats()
+        return {'pending': stats['pending'], 'scheduled': stats['queued'], 'refreshed': stats['written'],
+                'failures': self.failures, 'delay': self.delay}
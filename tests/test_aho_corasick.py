@@ -0,0 +1,27 @@
+"""
+多模式匹配(Aho-Corasick)测试
+"""
+
+from aho_corasick import AhoCorasick
+
+
+class TestAhoCorasick:
+    """测试自动机匹配"""
+
+    def test_all_matches(self):
+        """测试找出全部（含重叠）匹配"""
+        matcher = AhoCorasick(['he', 'she', 'hers', 'his', ''])
+        assert sorted(matcher.iter_all('ushers')) == [(1, 'she'), (2, 'he'), (2, 'hers')]
+        assert list(matcher.iter_all('ahishers'))[0] == (1, 'his')
+
+    def test_longest_non_overlapping(self):
+        """测试较长人名优先，匹配不重叠"""
+        matcher = AhoCorasick(['林默', '林默然', '默然', '苏晴'])
+        assert matcher.find('林默然对苏晴说：林默来了') == [(0, '林默然'), (4, '苏晴'), (8, '林默')]
+        assert matcher.find('默然不语') == [(0, '默然')]
+
+    def test_empty(self):
+        """测试无模式时不匹配"""
+        matcher = AhoCorasick([])
+        assert not matcher
+        assert matcher.find('林默') == []
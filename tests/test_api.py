@@ -17,6 +17,7 @@ class TestAPIRoutes:
         data = json.loads(response.data)
         assert data['success'] == True
         assert 'status' in data['data']
+        assert 'pool' in data['data']
     
     def test_check_api_key_not_configured(self, client):
         """测试API密钥未配置"""
@@ -214,6 +215,36 @@ class TestAPIRoutes:
         assert data['success'] == True
         assert data['message'] == '收藏状态更新成功'
     
+    def test_history_pagination(self, client):
+        """测试历史记录只返回摘要并按游标翻页，正文按ID加载"""
+        for i in range(5):
+            client.post('/api/scripts', json={
+                'theme': f'历史测试{i}',
+                'script_type': '分镜分析',
+                'platform': '抖音',
+                'content': f'历史测试内容{i}，长度足够长以满足验证要求。'
+            })
+        
+        response = client.get('/api/history?limit=3')
+        assert response.status_code == 200
+        first_page = json.loads(response.data)
+        assert len(first_page) == 3
+        assert 'content' not in first_page[0]
+        
+        last = first_page[-1]
+        response = client.get(f"/api/history?limit=3&before_created_at={last['created_at']}&before_id={last['id']}")
+        second_page = json.loads(response.data)
+        assert len(second_page) == 2
+        ids = [item['id'] for item in first_page + second_page]
+        assert len(set(ids)) == 5
+        
+        response = client.get(f"/api/scripts/{ids[0]}")
+        data = json.loads(response.data)
+        assert data['data']['content'].startswith('历史测试内容')
+        
+        response = client.get('/api/scripts/99999')
+        assert response.status_code == 404
+    
     def test_get_stats(self, client):
         """测试获取统计信息"""
         # 创建一些测试数据
@@ -235,7 +266,7 @@ class TestAPIRoutes:
         assert 'type_distribution' in data['data']
         assert 'platform_distribution' in data['data']
     
-    @patch('requests.post')
+    @patch('upstream_client.upstream_client.request')
     def test_proxy_success(self, mock_post, client):
         """测试代理API成功"""
         # 先设置API密钥
@@ -245,8 +276,8 @@ class TestAPIRoutes:
         
         # 模拟成功的API响应
         mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = b'{"result": "success"}'
+        mock_response.status = 200
+        mock_response.read.return_value = b'{"result": "success"}'
         mock_response.headers = {'Content-Type': 'application/json'}
         mock_post.return_value = mock_response
         
@@ -311,4 +342,39 @@ class TestAPIRoutes:
         
         data = json.loads(response.data)
         assert data['success'] == False
-        assert 'limit参数必须在1-100之间' in data['message']
\ No newline at end of file
+        assert 'limit参数必须在1-100之间' in data['message']
+
+class TestExportRoutes:
+    """测试导出路由"""
+    
+    def test_export_old_script(self, app, client):
+        """测试按ID导出不在最近100条内的脚本"""
+        db = app.extensions['database']
+        first_id = db.create_script("最早的脚本", "类型", "平台", "最早的内容")
+        for i in range(105):
+            db.create_script(f"主题{i}", "类型", "平台", f"内容{i}")
+        
+        response = client.get(f'/api/export/script/{first_id}?format=txt')
+        assert response.status_code == 200
+        assert '最早的内容' in response.data.decode('utf-8')
+        
+        response = client.get('/api/export/script/99999')
+        assert response.status_code == 404
+    
+    def test_bulk_export_zip(self, app, client):
+        """测试批量导出为流式ZIP"""
+        import io
+        import zipfile
+        db = app.extensions['database']
+        ids = [db.create_script(f"主题{i}", "类型", "平台", f"内容{i}") for i in range(3)]
+        
+        response = client.get(f"/api/export/scripts?ids={ids[2]},{ids[0]},99999&format=json")
+        assert response.status_code == 200
+        assert response.mimetype == 'application/zip'
+        
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        assert archive.namelist() == [f"script_{ids[2]}.json", f"script_{ids[0]}.json"]
+        assert json.loads(archive.read(f"script_{ids[0]}.json"))['content'] == "内容0"
+        
+        response = client.get('/api/export/scripts?ids=abc')
+        assert response.status_code == 400
@@ -0,0 +1,40 @@
+"""
+内容寻址文件存储测试
+"""
+
+import base64
+import os
+from blob_store import BlobStore, blob_url, decode_data_url, hash_from_url, is_blob_hash
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32
+
+
+class TestBlobStore:
+    """测试封面文件存储"""
+
+    def test_put_is_content_addressed(self, tmp_path):
+        """测试相同内容只存一份"""
+        store = BlobStore(str(tmp_path))
+        first = store.put(PNG)
+        second = store.put(PNG)
+        assert first == second and is_blob_hash(first)
+        assert os.listdir(tmp_path / first[:2]) == [first]
+        assert store.read(first) == (PNG, 'image/png')
+        assert store.read('0' * 64) is None
+
+    def test_data_url(self, tmp_path):
+        """测试data URL解码与链接互转"""
+        store = BlobStore(str(tmp_path))
+        data_url = 'data:image/png;base64,' + base64.b64encode(PNG).decode()
+        blob_hash = store.put_data_url(data_url)
+        assert store.read(blob_hash)[0] == PNG
+        assert store.put_data_url('https://example.com/a.png') is None
+        assert decode_data_url('data:text/plain,hello') is None
+        assert hash_from_url(blob_url(blob_hash, 256)) == blob_hash
+
+    def test_thumbnail_falls_back_to_original(self, tmp_path):
+        """测试无法生成缩略图时返回原图"""
+        store = BlobStore(str(tmp_path))
+        blob_hash = store.put(b'plain bytes')
+        assert store.read_thumbnail(blob_hash, 256) == (b'plain bytes', 'application/octet-stream')
+        assert store.read_thumbnail(blob_hash, 77) == (b'plain bytes', 'application/octet-stream')
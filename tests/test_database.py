@@ -3,7 +3,7 @@
 """
 
 import pytest
-from app.models.database import DatabaseManager
+from app.models.database import DatabaseManager, get_database
 from app.config import Config
 
 class TestDatabaseManager:
@@ -135,6 +135,126 @@ class TestDatabaseManager:
         assert len(scripts_10) == 10
         assert len(scripts_all) == 10
     
+    def test_script_summaries_pagination(self, tmp_path):
+        """测试摘要列表按游标翻页且不含正文"""
+        db_file = tmp_path / "test.db"
+        db = DatabaseManager(str(db_file))
+        
+        for i in range(7):
+            db.create_script(f"主题{i}", "类型", "平台", f"内容{i}")
+        
+        seen = []
+        page = db.get_script_summaries(limit=3)
+        while page:
+            assert all('content' not in item for item in page)
+            seen.extend(item['id'] for item in page)
+            last = page[-1]
+            page = db.get_script_summaries(limit=3, before_created_at=last['created_at'], before_id=last['id'])
+        
+        # 同一秒内创建的脚本按ID倒序，不重复不遗漏
+        assert seen == sorted(seen, reverse=True)
+        assert len(seen) == 7
+        
+        script = db.get_script(seen[0])
+        assert script['content'] == "内容6"
+        assert db.get_script(999) is None
+    
+    def test_stats_counters(self, tmp_path):
+        """测试统计计数器随增删改同步更新"""
+        db_file = tmp_path / "test.db"
+        db = DatabaseManager(str(db_file))
+        
+        ids = [db.create_script(f"主题{i}", "分镜分析" if i % 2 else "剧本创作", "抖音", "内容") for i in range(4)]
+        db.toggle_favorite(ids[0])
+        db.toggle_favorite(ids[1])
+        db.update_script(ids[2], platform="小红书")
+        db.delete_script(ids[3])
+        
+        stats = db.get_stats()
+        assert stats['total_scripts'] == 3
+        assert stats['favorite_scripts'] == 2
+        assert stats['type_distribution'] == {'剧本创作': 2, '分镜分析': 1}
+        assert stats['platform_distribution'] == {'抖音': 2, '小红书': 1}
+        
+        # 与 GROUP BY 重新计算的结果一致
+        assert db.rebuild_stats()
+        assert db.get_stats() == stats
+    
+    def test_stats_backfill(self, tmp_path):
+        """测试已有数据库首次启用计数器时回填"""
+        import sqlite3
+        db_file = tmp_path / "legacy.db"
+        conn = sqlite3.connect(str(db_file))
+        conn.execute('''
+            CREATE TABLE scripts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, theme TEXT, script_type TEXT, platform TEXT,
+                content TEXT, is_favorite BOOLEAN DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP, metadata TEXT
+            )
+        ''')
+        conn.executemany('INSERT INTO scripts (theme, script_type, platform, is_favorite) VALUES (?, ?, ?, ?)',
+                         [('a', '类型', None, 1), ('b', '类型', '抖音', 0)])
+        conn.commit()
+        conn.close()
+        
+        db = DatabaseManager(str(db_file))
+        stats = db.get_stats()
+        assert stats['total_scripts'] == 2
+        assert stats['favorite_scripts'] == 1
+        assert stats['platform_distribution'] == {'unknown': 1, '抖音': 1}
+        
+        # 重复初始化不会重复回填
+        db = DatabaseManager(str(db_file))
+        assert db.get_stats()['total_scripts'] == 2
+    
+    def test_shared_instance_and_ping(self, tmp_path):
+        """测试同一数据库文件共享实例，健康探测走连接池且不写库"""
+        db_file = str(tmp_path / "test.db")
+        db = get_database(db_file)
+        assert get_database(db_file) is db
+        
+        db.create_script("主题", "类型", "平台", "内容")
+        import sqlite3
+        conn = sqlite3.connect(db_file)
+        before = conn.execute('PRAGMA data_version').fetchone()[0]
+        stats = db.ping()
+        assert stats['size'] >= 1
+        assert stats['created'] >= 1
+        assert 'db_file' not in stats
+        assert conn.execute('PRAGMA data_version').fetchone()[0] == before
+        conn.close()
+    
+    def test_health_hides_db_path(self, tmp_path):
+        """测试健康检查不暴露数据库文件路径"""
+        from app.utils.helpers import Utils
+        db_file = str(tmp_path / "test.db")
+        health = Utils.check_backend_health(DatabaseManager(db_file))
+        assert health['status'] == 'healthy'
+        assert str(tmp_path) not in str(health)
+    
+    def test_compressed_content(self, tmp_path, monkeypatch):
+        """测试正文压缩存储对读取透明，已有数据可分批压缩"""
+        import text_codec
+        db = DatabaseManager(str(tmp_path / "test.db"))
+        body = '| 序号 | 景别 | 时长 | 画面内容 |\n| 1 | 全景 | 3s | 城市夜景 |\n' * 100
+        old_id = db.create_script("旧脚本", "类型", "平台", body)
+        
+        monkeypatch.setattr(text_codec, 'DB_COMPRESSION', 'zlib')
+        new_id = db.create_script("新脚本", "类型", "平台", body)
+        assert db.get_script(new_id)['content'] == body
+        
+        summary = db.compress_content(batch_size=1)
+        assert summary['rows'] == 2 and summary['rewritten'] == 1
+        assert [s['content'] for s in db.iter_scripts([old_id, new_id])] == [body, body]
+        # 逐批借用连接：产出期间连接已归还连接池
+        scripts = db.iter_scripts([old_id, new_id], batch_size=1)
+        next(scripts)
+        assert db.pool.stats()['idle'] == db.pool.stats()['created']
+        scripts.close()
+        
+        db.update_script(old_id, content=body + '结尾')
+        assert db.get_script(old_id)['content'] == body + '结尾'
+    
     def test_error_handling(self, tmp_path):
         """测试错误处理"""
         db_file = tmp_path / "test.db"
@@ -0,0 +1,944 @@
+"""
+桌面版数据库模块(db_manager)测试
+"""
+
+import base64
+import json
+import sqlite3
+import threading
+import pytest
+import db_manager
+import text_codec
+from settings_cache import get_settings_cache
+from blob_store import is_blob_hash
+from json_patch import JsonPatchTestFailed
+
+
+@pytest.fixture
+def desktop_db(tmp_path, monkeypatch):
+    """将DB_FILE指向临时文件并初始化"""
+    monkeypatch.setattr(db_manager, 'DB_FILE', str(tmp_path / "scripts.db"))
+    db_manager.init_db()
+    yield db_manager
+    db_manager.close_db()
+
+
+class TestConnectionPool:
+    """测试连接池与WAL配置"""
+
+    def test_wal_and_pragmas(self, desktop_db):
+        """测试连接以WAL模式打开并应用PRAGMA"""
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+            assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+
+    def test_connections_are_reused(self, desktop_db):
+        """测试连续调用复用同一连接"""
+        for i in range(20):
+            desktop_db.db_save_setting(f"key{i}", str(i))
+            assert desktop_db.db_get_setting(f"key{i}") == str(i)
+        assert desktop_db.get_pool().stats()['created'] == 1
+
+    def test_parallel_threads(self, desktop_db):
+        """测试多线程并发读写（每个请求一个线程）"""
+        errors = []
+
+        def worker(n):
+            try:
+                script_id = desktop_db.db_save_script(f"主题{n}", "类型", "平台", "内容")
+                assert script_id > 0
+                desktop_db.db_get_history(limit=5)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert len(desktop_db.db_get_history(limit=100)) == 30
+        assert desktop_db.get_pool().stats()['created'] <= desktop_db.DB_POOL_SIZE
+
+    def test_failed_block_rolls_back(self, desktop_db):
+        """测试异常时回滚未提交的写入，连接归还后仍可用"""
+        with pytest.raises(sqlite3.IntegrityError):
+            with desktop_db.get_connection() as conn:
+                conn.execute("INSERT INTO settings (key, value) VALUES ('a', '1')")
+                conn.execute("INSERT INTO chapters (novel_id, title) VALUES (999, 'orphan')")
+
+        assert desktop_db.db_get_setting('a') is None
+        desktop_db.db_save_setting('a', '2')
+        assert desktop_db.db_get_setting('a') == '2'
+
+    def test_row_factory_reset(self, desktop_db):
+        """测试row_factory不会泄漏到下一次借用"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        assert desktop_db.db_get_novel(novel_id)['title'] == '小说'
+        desktop_db.db_save_setting('k', 'v')
+        assert desktop_db.db_get_setting('k') == 'v'
+        assert desktop_db.db_get_history() == []
+
+
+class TestHistory:
+    """测试历史摘要与游标分页"""
+
+    def test_keyset_pages(self, desktop_db):
+        """测试按 (created_at, id) 翻页，同一时间戳也不重复不遗漏"""
+        for i in range(12):
+            desktop_db.db_save_script(f"主题{i}", "类型", "平台", "内容" * 1000)
+
+        seen = []
+        page = desktop_db.db_get_history(limit=5)
+        while page:
+            assert all('content' not in item for item in page)
+            seen.extend(item['id'] for item in page)
+            last = page[-1]
+            page = desktop_db.db_get_history(limit=5, before_created_at=last['date'], before_id=last['id'])
+
+        assert seen == sorted(seen, reverse=True)
+        assert len(seen) == 12
+
+    def test_favorites_page(self, desktop_db):
+        """测试收藏过滤与分页组合"""
+        ids = [desktop_db.db_save_script(f"主题{i}", "类型", "平台", "内容") for i in range(6)]
+        for script_id in ids[::2]:
+            desktop_db.db_toggle_favorite(script_id)
+
+        page = desktop_db.db_get_history(limit=2, only_favorites=True)
+        assert [item['id'] for item in page] == [ids[4], ids[2]]
+        page = desktop_db.db_get_history(limit=2, only_favorites=True,
+                                         before_created_at=page[-1]['date'], before_id=page[-1]['id'])
+        assert [item['id'] for item in page] == [ids[0]]
+
+    def test_get_script(self, desktop_db):
+        """测试按ID加载完整脚本"""
+        script_id = desktop_db.db_save_script("主题", "类型", "平台", "正文", metadata='{"style": "电影感"}')
+        script = desktop_db.db_get_script(script_id)
+        assert script['content'] == "正文"
+        assert script['metadata'] == {'style': '电影感'}
+        assert desktop_db.db_get_script(script_id + 1) is None
+
+
+class TestMigrations:
+    """测试版本化迁移与查询计划检查"""
+
+    def test_indexes_created(self, desktop_db):
+        """测试迁移创建索引并记录版本号"""
+        with desktop_db.get_connection() as conn:
+            assert desktop_db.get_schema_version(conn) == desktop_db.MIGRATIONS[-1][0]
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {'idx_scripts_created_at', 'idx_scripts_favorite_created_at',
+                'idx_novels_updated_at', 'idx_chapters_novel_order'} <= indexes
+
+    def test_migrations_are_idempotent(self, desktop_db):
+        """测试重复初始化不会重跑迁移"""
+        desktop_db.db_save_script("主题", "类型", "平台", "内容")
+        desktop_db.init_db()
+        assert len(desktop_db.db_get_history()) == 1
+
+    def test_hot_queries_use_indexes(self, desktop_db):
+        """测试热点查询不做全表扫描或临时排序"""
+        with desktop_db.get_connection() as conn:
+            assert desktop_db.check_query_plans(conn) == []
+
+    def test_full_scan_reported(self, desktop_db):
+        """测试缺少索引时给出告警"""
+        with desktop_db.get_connection() as conn:
+            conn.execute('DROP INDEX idx_novels_updated_at')
+        with sqlite3.connect(desktop_db.DB_FILE) as conn:
+            problems = desktop_db.check_query_plans(conn)
+        assert [name for name, _ in problems if name == 'novels']
+
+
+class TestSearch:
+    """测试全文检索"""
+
+    def test_ranked_snippets(self, desktop_db):
+        """测试中文检索返回高亮片段，标题命中排在前面"""
+        desktop_db.db_save_script("霓虹城市", "类型", "平台", "清晨的菜市场")
+        desktop_db.db_save_script("乡村", "类型", "平台", "主角走进<霓虹城市>的雨夜街道")
+
+        result = desktop_db.db_search("霓虹城市")
+        titles = [hit['title'] for hit in result['results']]
+        assert titles == ["霓虹城市", "乡村"]
+        assert '<mark>霓虹城市</mark>' in result['results'][1]['snippet']
+        assert '&lt;' in result['results'][1]['snippet']
+
+    def test_short_terms(self, desktop_db):
+        """测试两个字的词（低于trigram长度）也能命中"""
+        desktop_db.db_save_script("主题", "类型", "平台", "镜头缓缓推进")
+        hits = desktop_db.db_search("镜头")['results']
+        assert len(hits) == 1
+        assert '<mark>镜头</mark>' in hits[0]['snippet']
+        assert desktop_db.db_search("100%")['results'] == []
+
+    def test_index_follows_writes(self, desktop_db):
+        """测试更新、删除后索引同步"""
+        script_id = desktop_db.db_save_script("主题", "类型", "平台", "原始的内容文本")
+        desktop_db.db_save_script("主题", "类型", "平台", "修改后的内容文本", script_id=script_id)
+        assert desktop_db.db_search("原始的")['results'] == []
+        assert len(desktop_db.db_search("修改后")['results']) == 1
+
+        desktop_db.db_delete_script(script_id)
+        assert desktop_db.db_search("修改后")['results'] == []
+
+    def test_chapters_and_paging(self, desktop_db):
+        """测试章节检索与分页"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        for i in range(5):
+            desktop_db.db_save_chapter({'novel_id': novel_id, 'title': f'第{i}章', 'content': '雨夜里的追逐戏'})
+
+        first = desktop_db.db_search("追逐戏", kind='chapters', limit=3)
+        assert len(first['results']) == 3 and first['has_more']
+        assert first['results'][0]['novel_id'] == novel_id
+        second = desktop_db.db_search("追逐戏", kind='chapters', limit=3, offset=3)
+        assert len(second['results']) == 2 and not second['has_more']
+        ids = {hit['id'] for hit in first['results'] + second['results']}
+        assert len(ids) == 5
+
+
+class TestChapters:
+    """测试章节目录与分段正文"""
+
+    def test_index_has_no_bodies(self, desktop_db):
+        """测试目录不含正文且按顺序返回"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        for i in (2, 0, 1):
+            desktop_db.db_save_chapter({'novel_id': novel_id, 'title': f'第{i}章', 'content': '正文' * 100,
+                                        'word_count': 200, 'order_index': i})
+
+        index = desktop_db.db_get_chapter_index(novel_id)
+        assert [c['title'] for c in index] == ['第0章', '第1章', '第2章']
+        assert set(index[0]) == set(desktop_db.CHAPTER_INDEX_COLUMNS)
+
+        full = list(desktop_db.db_iter_chapters(novel_id, batch_size=2))
+        assert [c['id'] for c in full] == [c['id'] for c in index]
+        assert full[2]['content'] == '正文' * 100
+
+    def test_character_range(self, desktop_db):
+        """测试按字符截取正文"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '长章节',
+                                                 'content': '一二三四五六七八九十'})
+
+        part = desktop_db.db_get_chapter_range(chapter_id, offset=3, length=4)
+        assert part['content'] == '四五六七'
+        assert part['total_length'] == 10 and part['offset'] == 3
+        assert desktop_db.db_get_chapter_range(chapter_id, offset=8)['content'] == '九十'
+        assert desktop_db.db_get_chapter_range(chapter_id, offset=20, length=5)['content'] == ''
+        assert desktop_db.db_get_chapter_range(999) is None
+        assert desktop_db.db_get_chapter_novel_id(chapter_id) == novel_id
+        assert desktop_db.db_get_chapter_novel_id(999) is None
+
+
+class TestNovelCovers:
+    """测试封面移出novels表"""
+
+    def test_cover_stored_by_hash(self, desktop_db):
+        """测试上传的封面只在表中保存哈希"""
+        cover = 'data:image/png;base64,' + base64.b64encode(b'\x89PNG\r\n\x1a\ncover').decode()
+        novel_id = desktop_db.db_save_novel({'title': '小说', 'cover_image': cover})
+
+        with desktop_db.get_connection() as conn:
+            stored = conn.execute('SELECT cover_image FROM novels WHERE id = ?', (novel_id,)).fetchone()[0]
+        assert is_blob_hash(stored)
+        assert desktop_db.get_blob_store().read(stored)[0].endswith(b'cover')
+        assert desktop_db.db_get_novels()[0]['cover_image'] == f'/api/blobs/{stored}?w=256'
+
+        # 前端回传链接时保持同一哈希
+        novel = desktop_db.db_get_novel(novel_id)
+        assert novel['cover_image'] == f'/api/blobs/{stored}'
+        desktop_db.db_save_novel(novel)
+        assert desktop_db.db_get_novel(novel_id)['cover_image'] == f'/api/blobs/{stored}'
+
+    def test_inline_covers_migrated(self, desktop_db):
+        """测试已有的内联封面在启动时迁移"""
+        cover = 'data:image/jpeg;base64,' + base64.b64encode(b'\xff\xd8\xffold').decode()
+        with desktop_db.get_connection() as conn:
+            conn.execute('INSERT INTO novels (title, cover_image) VALUES (?, ?)', ('旧小说', cover))
+            conn.commit()
+
+        desktop_db.init_db()
+        cover_url = desktop_db.db_get_novels()[0]['cover_image']
+        assert cover_url.startswith('/api/blobs/')
+        blob = desktop_db.get_blob_store().read(cover_url.split('/')[-1].split('?')[0])
+        assert blob == (b'\xff\xd8\xffold', 'image/jpeg')
+
+
+class TestCompression:
+    """测试正文压缩存储"""
+
+    BODY = '雨夜里的追逐戏，他深吸一口气，沉默了片刻。\n' * 300
+
+    def test_compressed_bodies_read_and_search(self, desktop_db, monkeypatch):
+        """测试压缩后的正文读取、分段与检索不受影响"""
+        monkeypatch.setattr(text_codec, 'DB_COMPRESSION', 'zlib')
+        script_id = desktop_db.db_save_script('追逐', 'short', 'douyin', self.BODY)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': self.BODY})
+
+        with desktop_db.get_connection() as conn:
+            kinds = conn.execute("SELECT typeof(content) FROM scripts UNION ALL "
+                                 "SELECT typeof(content) FROM chapters").fetchall()
+        assert kinds == [('blob',), ('blob',)]
+
+        assert desktop_db.db_get_script(script_id)['content'] == self.BODY
+        assert desktop_db.db_get_chapter(chapter_id)['content'] == self.BODY
+        part = desktop_db.db_get_chapter_range(chapter_id, offset=4, length=3)
+        assert part['content'] == '追逐戏' and part['total_length'] == len(self.BODY)
+
+        hits = desktop_db.db_search('追逐戏')['results']
+        assert {hit['kind'] for hit in hits} == {'script', 'chapter'}
+        assert '<mark>追逐戏</mark>' in hits[0]['snippet']
+        assert desktop_db.db_search('雨 追逐戏', kind='chapters')['results'][0]['id'] == chapter_id
+
+    def test_compress_existing_rows(self, desktop_db):
+        """测试已有数据分批压缩后检索结果不变"""
+        for i in range(5):
+            desktop_db.db_save_script(f'主题{i}', 'short', 'douyin', self.BODY)
+
+        summary = desktop_db.db_compress_content(codec=text_codec.CODEC_ZLIB, batch_size=2)
+        assert summary['scripts']['rewritten'] == 5
+        assert summary['scripts']['bytes_after'] < summary['scripts']['bytes_before'] / 5
+        assert len(desktop_db.db_search('追逐戏', kind='scripts')['results']) == 5
+        assert desktop_db.db_get_script(1)['content'] == self.BODY
+
+
+class TestRevisions:
+    """测试章节修订历史"""
+
+    @staticmethod
+    def _drafts(count):
+        lines = [f'第{i}段：雨夜里的追逐戏。\n' for i in range(40)]
+        drafts = []
+        for i in range(count):
+            lines[i % 40] = f'第{i % 40}段：第{i}次修改。\n'
+            drafts.append(''.join(lines))
+        return drafts
+
+    def test_snapshots_and_deltas(self, desktop_db, monkeypatch):
+        """测试定期快照加差量，每个版本都能还原"""
+        monkeypatch.setattr(desktop_db, 'REVISION_SNAPSHOT_EVERY', 4)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        drafts = self._drafts(9)
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': drafts[0]})
+        for draft in drafts[1:]:
+            desktop_db.db_save_chapter({'id': chapter_id, 'title': '第一章', 'content': draft})
+        # 内容未变的保存不产生新版本
+        desktop_db.db_save_chapter({'id': chapter_id, 'title': '改名', 'content': drafts[-1]})
+
+        revisions = desktop_db.db_list_revisions(chapter_id)
+        assert len(revisions) == 9
+        assert [r['kind'] for r in reversed(revisions)] == ['snapshot', 'delta', 'delta', 'delta'] * 2 + ['snapshot']
+        for revision, draft in zip(reversed(revisions), drafts):
+            assert desktop_db.db_get_revision(revision['id'])['content'] == draft
+
+        with desktop_db.get_connection() as conn:
+            sizes = conn.execute('SELECT kind, MAX(length(data)) FROM chapter_revisions GROUP BY kind').fetchall()
+        sizes = dict(sizes)
+        assert sizes['delta'] < sizes['snapshot'] / 5
+
+    def test_restore(self, desktop_db):
+        """测试恢复旧版本，恢复本身也可撤销"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        drafts = self._drafts(3)
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': drafts[0]})
+        for draft in drafts[1:]:
+            desktop_db.db_save_chapter({'id': chapter_id, 'title': '第一章', 'content': draft})
+
+        oldest = desktop_db.db_list_revisions(chapter_id)[-1]
+        assert desktop_db.db_restore_revision(oldest['id']) == chapter_id
+        assert desktop_db.db_get_chapter(chapter_id)['content'] == drafts[0]
+        revisions = desktop_db.db_list_revisions(chapter_id)
+        assert len(revisions) == 4
+        assert desktop_db.db_get_revision(revisions[1]['id'])['content'] == drafts[2]
+        assert desktop_db.db_restore_revision(999) is None
+
+        desktop_db.db_delete_chapter(chapter_id)
+        assert desktop_db.db_list_revisions(chapter_id) == []
+
+    def test_thinning(self, desktop_db, monkeypatch):
+        """测试保留策略：近期全留，之后每小时/每天一个，被引用的快照保留"""
+        monkeypatch.setattr(desktop_db, 'REVISION_SNAPSHOT_EVERY', 1000)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        drafts = [self._drafts(1)[0] + f'第{i}稿\n' for i in range(30)]
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': drafts[0]})
+        for draft in drafts[1:]:
+            desktop_db.db_save_chapter({'id': chapter_id, 'title': '第一章', 'content': draft})
+
+        # 前10个版本在30天前的同一天，之后15个在两天前的同一小时
+        with desktop_db.get_connection() as conn:
+            ids = [row[0] for row in conn.execute('SELECT id FROM chapter_revisions ORDER BY id')]
+            conn.executemany("UPDATE chapter_revisions SET created_at = datetime('now', '-30 days') WHERE id = ?",
+                             [(i,) for i in ids[:10]])
+            conn.executemany("UPDATE chapter_revisions SET created_at = datetime('now', '-2 days') WHERE id = ?",
+                             [(i,) for i in ids[10:25]])
+            conn.commit()
+
+        monkeypatch.setattr(desktop_db, 'REVISION_KEEP_RECENT', 5)
+        assert desktop_db.db_thin_revisions(chapter_id) == 30 - 5 - 1 - 1 - 1
+        kept = [r['id'] for r in desktop_db.db_list_revisions(chapter_id)]
+        assert kept == ids[25:][::-1] + [ids[24], ids[9], ids[0]]
+        # 首个快照被保留的差量引用
+        assert desktop_db.db_get_revision(ids[9])['content'] == drafts[9]
+
+
+class TestAutosaveBuffer:
+    """测试自动保存合并写入"""
+
+    def test_coalesced_saves_read_your_writes(self, desktop_db, monkeypatch):
+        """测试缓冲中的保存可立即读到，刷新后只产生一次写入"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_queue_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_queue_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': '开头'})
+        for i in range(5):
+            desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '第一章', 'content': f'第{i}稿', 'word_count': 3})
+        desktop_db.db_queue_save_novel({'id': novel_id, 'title': '新书名'})
+
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT content FROM chapters').fetchone()[0] == '开头'
+        assert desktop_db.db_get_chapter(chapter_id)['content'] == '第4稿'
+        assert desktop_db.db_get_chapter_index(novel_id)[0]['word_count'] == 3
+        assert desktop_db.db_get_chapter_range(chapter_id, offset=1, length=1)['content'] == '4'
+        assert desktop_db.db_get_novel(novel_id)['title'] == '新书名'
+        assert desktop_db.db_get_novels()[0]['title'] == '新书名'
+
+        assert desktop_db.db_flush_saves() == 2
+        assert desktop_db.get_save_buffer().get(('chapter', chapter_id)) is None
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT content FROM chapters').fetchone()[0] == '第4稿'
+        # 首次插入与合并后的一次更新
+        assert len(desktop_db.db_list_revisions(chapter_id)) == 2
+
+    def test_flush_flag_and_shutdown(self, desktop_db, monkeypatch):
+        """测试flush参数立即写入，关闭数据库时写入剩余保存"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': '开头'})
+
+        desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '第一章', 'content': '立即'}, flush=True)
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT content FROM chapters').fetchone()[0] == '立即'
+
+        desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '第一章', 'content': '退出前'})
+        desktop_db.close_db()
+        assert desktop_db.db_get_chapter(chapter_id)['content'] == '退出前'
+
+    def test_patch_flushes_only_its_record(self, desktop_db, monkeypatch):
+        """测试增量保存与上下文只写入相关的缓冲保存，其它小说的保存仍在缓冲中"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        other_novel = desktop_db.db_save_novel({'title': '另一本'})
+        first = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': '开头'})
+        second = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第二章', 'content': '开头'})
+        other = desktop_db.db_save_chapter({'novel_id': other_novel, 'title': '第一章', 'content': '开头'})
+        for chapter_id in (first, second, other):
+            desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '章', 'content': '缓冲'})
+
+        desktop_db.db_patch_chapter(first, [[2, 0, '！']], base_version=2)
+        buffer = desktop_db.get_save_buffer()
+        assert sorted(buffer.keys()) == [('chapter', second), ('chapter', other)]
+        assert desktop_db.db_get_chapter(first)['content'] == '缓冲！'
+
+        desktop_db.db_build_context(novel_id, 1000)
+        assert buffer.keys() == [('chapter', other)]
+
+    def test_malformed_save_rejected(self, desktop_db, monkeypatch):
+        """测试格式错误的保存在进入缓冲前被拒绝"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': '开头'})
+        with pytest.raises(ValueError):
+            desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '第一章', 'content': {'text': '错'}})
+        with pytest.raises(ValueError):
+            desktop_db.db_queue_save_novel({'id': novel_id, 'title': ['错']})
+        assert desktop_db.get_save_buffer().keys() == []
+
+    def test_delete_drops_pending_save(self, desktop_db, monkeypatch):
+        """测试删除章节时丢弃尚未写入的保存"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': '开头'})
+        desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '第一章', 'content': '修改'})
+        desktop_db.db_delete_chapter(chapter_id)
+        assert desktop_db.db_flush_saves() == 0
+        assert desktop_db.db_get_chapter(chapter_id) is None
+
+
+class TestChapterPatch:
+    """测试基于版本号的章节增量保存"""
+
+    def _chapter(self, db, content='第一段。\n第二段。'):
+        novel_id = db.db_save_novel({'title': '小说'})
+        return db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'content': content})
+
+    def test_patch_applies_and_bumps_version(self, desktop_db):
+        """测试补丁按码点偏移应用，版本号递增并记录修订"""
+        chapter_id = self._chapter(desktop_db, '开头😀结尾')
+        assert desktop_db.db_get_chapter(chapter_id)['version'] == 1
+
+        result = desktop_db.db_patch_chapter(chapter_id, [[2, 1, '🎉'], [5, 0, '！']], base_version=1,
+                                             fields={'title': '新标题', 'word_count': 6, 'content': '忽略'})
+        chapter = desktop_db.db_get_chapter(chapter_id)
+        assert chapter['content'] == '开头🎉结尾！'
+        assert chapter['title'] == '新标题'
+        assert chapter['version'] == result['version'] == 2
+        assert result['hash'] == desktop_db._content_hash('开头🎉结尾！')
+        assert len(desktop_db.db_list_revisions(chapter_id)) == 2
+
+        # 也可以用正文哈希作为基准
+        desktop_db.db_patch_chapter(chapter_id, [[0, 2, '']], base_hash=result['hash'])
+        assert desktop_db.db_get_chapter(chapter_id)['content'] == '🎉结尾！'
+
+    def test_stale_base_conflicts(self, desktop_db):
+        """测试基准版本或哈希过期时返回冲突，正文不变"""
+        chapter_id = self._chapter(desktop_db)
+        desktop_db.db_save_chapter({'id': chapter_id, 'title': '第一章', 'content': '别处的修改'})
+
+        with pytest.raises(desktop_db.ChapterConflict) as excinfo:
+            desktop_db.db_patch_chapter(chapter_id, [[0, 0, '插入']], base_version=1)
+        assert excinfo.value.version == 2
+        assert excinfo.value.content_hash == desktop_db._content_hash('别处的修改')
+        with pytest.raises(desktop_db.ChapterConflict):
+            desktop_db.db_patch_chapter(chapter_id, [[0, 0, '插入']], base_hash=desktop_db._content_hash('旧'))
+        assert desktop_db.db_get_chapter(chapter_id)['content'] == '别处的修改'
+
+    def test_invalid_patches(self, desktop_db):
+        """测试格式错误、越界或结果哈希不符的补丁被拒绝"""
+        chapter_id = self._chapter(desktop_db, 'abc')
+        assert desktop_db.db_patch_chapter(chapter_id + 1, [], base_version=1) is None
+        for ops in ([[0, 5, 'x']], [[2, 0, 'x'], [1, 0, 'y']], [[0, 0]], [['0', 0, 'x']]):
+            with pytest.raises(ValueError):
+                desktop_db.db_patch_chapter(chapter_id, ops, base_version=1)
+        with pytest.raises(ValueError):
+            desktop_db.db_patch_chapter(chapter_id, [[0, 0, 'x']])
+        with pytest.raises(ValueError):
+            desktop_db.db_patch_chapter(chapter_id, [[0, 0, 'x']], base_version=1,
+                                        result_hash=desktop_db._content_hash('abc'))
+        chapter = desktop_db.db_get_chapter(chapter_id)
+        assert (chapter['content'], chapter['version']) == ('abc', 1)
+
+    def test_buffered_save_is_flushed_first(self, desktop_db, monkeypatch):
+        """测试缓冲中的整章保存计入版本号，并在应用补丁前写入"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        chapter_id = self._chapter(desktop_db, '旧稿')
+        desktop_db.db_queue_save_chapter({'id': chapter_id, 'title': '第一章', 'content': '新稿'})
+        assert desktop_db.db_get_chapter(chapter_id)['version'] == 2
+        assert desktop_db.db_get_chapter_version(chapter_id) == 2
+
+        desktop_db.db_patch_chapter(chapter_id, [[2, 0, '补充']], base_version=2)
+        chapter = desktop_db.db_get_chapter(chapter_id)
+        assert (chapter['content'], chapter['version']) == ('新稿补充', 3)
+        assert desktop_db.get_save_buffer().get(('chapter', chapter_id)) is None
+
+
+class TestNovelPatch:
+    """测试小说 extra_data 的部分更新"""
+
+    def test_patch_extra_data_and_fields(self, desktop_db):
+        """测试补丁只修改指定子树，并可同时更新滚动摘要"""
+        novel_id = desktop_db.db_save_novel({
+            'title': '小说', 'rolling_summary': '旧摘要',
+            'extra_data': {'characters': [{'name': '林默'}], 'events': []}})
+        result = desktop_db.db_patch_novel(novel_id, [
+            {'op': 'add', 'path': '/characters/-', 'value': {'name': '苏晴'}},
+            {'op': 'replace', 'path': '/events', 'value': ['相遇']},
+        ], {'rolling_summary': '新摘要', 'extra_data': '忽略'})
+
+        novel = desktop_db.db_get_novel(novel_id)
+        assert json.loads(novel['extra_data']) == {
+            'characters': [{'name': '林默'}, {'name': '苏晴'}], 'events': ['相遇']}
+        assert novel['rolling_summary'] == '新摘要'
+        assert novel['title'] == '小说'
+        assert result == {'id': novel_id, 'extra_data_length': len(novel['extra_data'])}
+
+        # 只改字段时不动 extra_data
+        desktop_db.db_patch_novel(novel_id, fields={'title': '新书名'})
+        novel = desktop_db.db_get_novel(novel_id)
+        assert novel['title'] == '新书名'
+        assert json.loads(novel['extra_data'])['events'] == ['相遇']
+        assert desktop_db.db_patch_novel(novel_id + 1, []) is None
+
+    def test_failed_patch_changes_nothing(self, desktop_db):
+        """测试任一操作失败时整个补丁不生效"""
+        novel_id = desktop_db.db_save_novel({'title': '小说', 'extra_data': {'count': 1}})
+        with pytest.raises(JsonPatchTestFailed):
+            desktop_db.db_patch_novel(novel_id, [
+                {'op': 'replace', 'path': '/count', 'value': 2},
+                {'op': 'test', 'path': '/count', 'value': 1},
+            ], {'title': '不应写入'})
+        with pytest.raises(ValueError):
+            desktop_db.db_patch_novel(novel_id, [{'op': 'remove', 'path': '/missing'}])
+        novel = desktop_db.db_get_novel(novel_id)
+        assert (novel['title'], json.loads(novel['extra_data'])) == ('小说', {'count': 1})
+
+    def test_buffered_save_is_flushed_first(self, desktop_db, monkeypatch):
+        """测试补丁基于缓冲中的整本保存"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_save_novel({'title': '小说', 'extra_data': {'count': 1}})
+        desktop_db.db_queue_save_novel({'id': novel_id, 'title': '小说', 'extra_data': {'count': 2}})
+        desktop_db.db_patch_novel(novel_id, [{'op': 'test', 'path': '/count', 'value': 2},
+                                             {'op': 'replace', 'path': '/count', 'value': 3}])
+        assert json.loads(desktop_db.db_get_novel(novel_id)['extra_data']) == {'count': 3}
+
+
+class TestEntities:
+    """测试从 extra_data 同步的人物/地点/势力表"""
+
+    EXTRA = {
+        'characters': [{'id': 1, 'name': '林默', 'role': 'protagonist'}, {'id': 2, 'name': '苏晴', 'role': 'supporting'},
+                       {'id': 3, 'name': ''}],
+        'worldSettings': [{'id': 10, 'title': '青云城', 'category': 'geography', 'description': '边陲小城'},
+                          {'id': 11, 'title': '天机阁', 'category': 'politics'},
+                          {'id': 12, 'title': '灵气复苏', 'category': 'magic'}],
+        'events': [{'id': 20, 'title': '初遇'}],
+    }
+
+    def test_sync_on_save(self, desktop_db):
+        """测试保存小说时生成实体行，未变化的行不被重写"""
+        novel_id = desktop_db.db_save_novel({'title': '小说', 'extra_data': self.EXTRA})
+        entities = desktop_db.db_list_entities(novel_id)
+        assert [(e['kind'], e['name']) for e in entities] == [
+            ('character', '林默'), ('character', '苏晴'), ('event', '初遇'),
+            ('faction', '天机阁'), ('location', '青云城'), ('magic', '灵气复苏')]
+        assert [e['name'] for e in desktop_db.db_list_entities(novel_id, 'location')] == ['青云城']
+        lin = entities[0]
+        assert (lin['source_id'], lin['summary']) == ('1', 'protagonist')
+        assert desktop_db.db_get_entity(lin['id'])['data'] == self.EXTRA['characters'][0]
+
+        extra = json.loads(json.dumps(self.EXTRA))
+        extra['characters'][1]['role'] = 'antagonist'
+        del extra['events']
+        desktop_db.db_save_novel({'id': novel_id, 'title': '小说', 'extra_data': extra})
+        entities = {e['name']: e for e in desktop_db.db_list_entities(novel_id)}
+        assert '初遇' not in entities
+        assert entities['林默']['id'] == lin['id']
+        assert entities['苏晴']['summary'] == 'antagonist'
+
+        desktop_db.db_save_novel({'id': novel_id, 'title': '小说'})
+        assert desktop_db.db_list_entities(novel_id) == []
+
+    def test_patch_buffered_save_and_delete(self, desktop_db, monkeypatch):
+        """测试补丁与合并写入同样同步实体，删除小说时一并删除"""
+        monkeypatch.setattr(desktop_db, 'SAVE_COALESCE_WINDOW', 60)
+        novel_id = desktop_db.db_save_novel({'title': '小说', 'extra_data': self.EXTRA})
+        desktop_db.db_patch_novel(novel_id, [{'op': 'replace', 'path': '/characters/0/name', 'value': '林沉'}])
+        assert desktop_db.db_find_entities('林默') == []
+        assert [e['novel_title'] for e in desktop_db.db_find_entities('林沉', 'character')] == ['小说']
+
+        desktop_db.db_queue_save_novel({'id': novel_id, 'title': '小说', 'extra_data': {'characters': [{'name': '老周'}]}})
+        desktop_db.db_flush_saves()
+        assert [e['name'] for e in desktop_db.db_list_entities(novel_id)] == ['老周']
+
+        desktop_db.db_delete_novel(novel_id)
+        assert desktop_db.db_find_entities('老周') == []
+
+    def test_find_across_novels(self, desktop_db):
+        """测试按名字跨小说查找"""
+        first = desktop_db.db_save_novel({'title': '第一部', 'extra_data': self.EXTRA})
+        second = desktop_db.db_save_novel({'title': '第二部', 'extra_data': {'characters': [{'name': '林默'}]}})
+        assert [e['novel_id'] for e in desktop_db.db_find_entities('林默')] == [first, second]
+        assert [e['novel_id'] for e in desktop_db.db_find_entities('林默', novel_id=second)] == [second]
+        assert desktop_db.db_find_entities('林默', kind='location') == []
+
+    def test_backfill_on_upgrade(self, desktop_db):
+        """测试升级到实体表时为已有小说建立索引"""
+        novel_id = desktop_db.db_save_novel({'title': '小说', 'extra_data': self.EXTRA})
+        desktop_db.close_db()
+        with sqlite3.connect(desktop_db.DB_FILE) as conn:
+            # 回退到迁移 4 之后的结构
+            conn.execute('DROP TABLE generation_jobs')
+            conn.execute('DROP TABLE summary_nodes')
+            conn.execute('DROP TABLE summary_cache')
+            conn.execute('ALTER TABLE novels DROP COLUMN summary_key')
+            conn.execute('ALTER TABLE chapters DROP COLUMN content_hash')
+            conn.execute('DROP TABLE passages_fts')
+            conn.execute('DROP TABLE passages')
+            conn.execute('ALTER TABLE chapters DROP COLUMN passages_version')
+            conn.execute('DROP TABLE chapter_mentions')
+            conn.execute('ALTER TABLE chapters DROP COLUMN mentions_key')
+            conn.execute('DROP TABLE entities')
+            conn.execute('PRAGMA user_version = 4')
+        desktop_db.init_db()
+        assert len(desktop_db.db_list_entities(novel_id)) == 6
+
+
+class TestMentions:
+    """测试章节中的人物提及索引"""
+
+    def _novel(self, db, names=('林默', '苏晴')):
+        return db.db_save_novel({'title': '小说', 'extra_data': {
+            'characters': [{'name': name} for name in names],
+            'worldSettings': [{'title': '青云城', 'category': 'geography'}, {'title': '灵气', 'category': 'magic'}]}})
+
+    def test_indexed_on_save(self, desktop_db):
+        """测试保存章节时更新该章的提及位置"""
+        novel_id = self._novel(desktop_db)
+        first = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '一', 'order_index': 0,
+                                            'content': '林默走进青云城，灵气逼人。'})
+        second = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '二', 'order_index': 1,
+                                             'content': '苏晴看着林默，林默笑了。'})
+
+        summary = {row['name']: row for row in desktop_db.db_get_mentions(novel_id)}
+        assert set(summary) == {'林默', '苏晴', '青云城'}
+        assert (summary['林默']['chapters'], summary['林默']['mentions']) == (2, 3)
+        assert summary['林默']['last_chapter_id'] == second
+        assert [(row['chapter_id'], row['positions']) for row in desktop_db.db_get_mentions(novel_id, '林默')] == [
+            (first, [0]), (second, [4, 7])]
+
+        desktop_db.db_patch_chapter(second, [[0, 2, '老周']], base_version=1)
+        assert [row['chapter_id'] for row in desktop_db.db_get_mentions(novel_id, '苏晴')] == []
+        desktop_db.db_delete_chapter(first)
+        assert [row['chapter_id'] for row in desktop_db.db_get_mentions(novel_id, '林默')] == [second]
+
+    def test_new_names_reindex_stale_chapters(self, desktop_db):
+        """测试新增人物后查询时只重建过期章节"""
+        novel_id = self._novel(desktop_db, ['林默'])
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '一', 'content': '林默然与老周'})
+        assert desktop_db.db_get_mentions(novel_id, '林默')[0]['count'] == 1
+
+        self._novel(desktop_db)  # 另一部小说不影响
+        desktop_db.db_save_novel({'id': novel_id, 'title': '小说', 'extra_data': {
+            'characters': [{'name': '林默'}, {'name': '林默然'}, {'name': '老周'}]}})
+        assert desktop_db.db_get_mentions(novel_id, '林默') == []
+        assert {row['name'] for row in desktop_db.db_get_mentions(novel_id)} == {'林默然', '老周'}
+        assert desktop_db._refresh_mentions(novel_id) == 0
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT mentions_key FROM chapters WHERE id = ?', (chapter_id,)).fetchone()[0]
+
+
+class TestRetrieval:
+    """测试章节段落的 BM25 检索"""
+
+    # 两段都超过 PASSAGE_MIN_CHARS，各自成为一个段落
+    JADE = ('城门口站着一位老者，他自称天机阁长老，手里拿着一块玉佩。玉佩上刻着古老的符文，隐隐散发着灵气。'
+            '林默心中一动，想起了父亲临终前说过的话：若见此玉，便是故人来寻，切记不可声张。')
+    HERB = ('苏晴在药铺里配药，忽然听到外面一阵喧哗。她走出门去，只见一群人围着一个受伤的少年，'
+            '少年脸色苍白，嘴唇干裂，显然已经赶了很久的路。苏晴皱了皱眉，让人把他抬进屋里。')
+
+    def test_ranked_passages(self, desktop_db):
+        """测试返回最相关的段落及其在章节中的位置"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        other = desktop_db.db_save_novel({'title': '另一部'})
+        first = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '一',
+                                            'content': f'{self.HERB}\n\n{self.JADE}'})
+        desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '二', 'content': '玉佩丢了。' * 20})
+        desktop_db.db_save_chapter({'novel_id': other, 'title': '别的', 'content': self.JADE})
+
+        results = desktop_db.db_retrieve_passages(novel_id, '天机阁的玉佩符文', k=2)
+        assert [(row['chapter_id'], row['text']) for row in results][0] == (first, self.JADE)
+        assert results[0]['start_offset'] == len(self.HERB) + 2
+        assert results[0]['score'] > results[1]['score']
+        assert {row['chapter_id'] for row in desktop_db.db_retrieve_passages(novel_id, '玉佩', k=10)} <= {first, first + 1}
+        assert desktop_db.db_retrieve_passages(novel_id, '，') == []
+
+    def test_incremental_updates(self, desktop_db):
+        """测试保存、补丁与删除章节时只更新该章的索引"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        chapter_id = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '一', 'content': self.HERB})
+        assert desktop_db.db_retrieve_passages(novel_id, '药铺')
+
+        desktop_db.db_save_chapter({'id': chapter_id, 'title': '一', 'content': self.JADE})
+        assert desktop_db.db_retrieve_passages(novel_id, '药铺') == []
+        desktop_db.db_patch_chapter(chapter_id, [[0, 0, '药铺掌柜说：']], base_version=2)
+        assert desktop_db.db_retrieve_passages(novel_id, '药铺')[0]['text'].startswith('药铺掌柜说')
+
+        desktop_db.db_delete_chapter(chapter_id)
+        assert desktop_db.db_retrieve_passages(novel_id, '药铺') == []
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM passages_fts').fetchone()[0] == 0
+
+    def test_old_chapters_indexed_on_first_query(self, desktop_db):
+        """测试检索表建立前保存的章节在首次查询时补建索引"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '一', 'content': self.HERB})
+        with desktop_db.get_connection() as conn:
+            conn.execute('DELETE FROM passages')
+            conn.execute('UPDATE chapters SET passages_version = NULL')
+            conn.commit()
+        assert desktop_db.db_retrieve_passages(novel_id, '药铺')[0]['text'] == self.HERB
+        assert desktop_db._refresh_passages(novel_id) == 0
+
+
+class TestGenerationContext:
+    """测试按 token 预算组装生成上下文"""
+
+    def _novel(self, db):
+        novel_id = db.db_save_novel({'title': '小说', 'rolling_summary': '林默来到青云城，结识了医女苏晴。', 'extra_data': {
+            'characters': [{'name': '林默', 'role': '主角', 'personality': '沉稳'}, {'name': '苏晴', 'role': '医女'},
+                           {'name': '老周', 'role': '掌柜'}]}})
+        chapters = [
+            db.db_save_chapter({'novel_id': novel_id, 'title': '第一章', 'order_index': 0, 'description': '初入青云城',
+                                'content': '林默走进青云城。\n城门口站着一位老者。\n老者递给他一块玉佩。'}),
+            db.db_save_chapter({'novel_id': novel_id, 'title': '第二章', 'order_index': 1, 'description': '药铺相遇',
+                                'content': '苏晴在药铺配药。\n\n林默推门而入。'}),
+            db.db_save_chapter({'novel_id': novel_id, 'title': '第三章', 'order_index': 2, 'description': '老周登场',
+                                'content': ''}),
+        ]
+        return novel_id, chapters
+
+    def test_sections_in_reading_order(self, desktop_db):
+        """测试上下文包含摘要、大纲、相关人物与前文，且前文按阅读顺序"""
+        novel_id, chapters = self._novel(desktop_db)
+        result = desktop_db.db_build_context(novel_id, 1000, '你是小说家。', chapters[2], paragraphs=3)
+        assert result['system'] == '你是小说家。'
+        context = result['context']
+        assert context.index('【故事梗概】') < context.index('【章节大纲】') < context.index('【前文】')
+        assert context.endswith('老者递给他一块玉佩。\n苏晴在药铺配药。\n林默推门而入。')
+        assert '第三章：老周登场' in context and '林默：主角；沉稳' in context and '苏晴：医女' in context
+        sections = {section['name']: section for section in result['sections']}
+        assert sections['recent']['items'] == 3
+        assert result['tokens'] == desktop_db.estimate_tokens('你是小说家。') + sum(
+            section['tokens'] for section in result['sections'])
+
+    def test_budget_respected(self, desktop_db):
+        """测试总 token 数不超过预算，前文优先保留最近的段落"""
+        novel_id, chapters = self._novel(desktop_db)
+        for budget in (0, 12, 30, 60):
+            result = desktop_db.db_build_context(novel_id, budget, '你是小说家。')
+            assert result['tokens'] <= budget
+        assert desktop_db.db_build_context(novel_id, 30)['context'].endswith('林默推门而入。')
+        assert desktop_db.db_build_context(novel_id + 10, 100) is None
+
+    def test_retrieved_passages_and_cache(self, desktop_db):
+        """测试按查询检索更早的片段，段落估算按章节版本缓存"""
+        novel_id, chapters = self._novel(desktop_db)
+        result = desktop_db.db_build_context(novel_id, 1000, query='玉佩', paragraphs=1)
+        assert '【相关前文片段】\n林默走进青云城。\n城门口站着一位老者。\n老者递给他一块玉佩。' in result['context']
+
+        key = (desktop_db.DB_FILE, chapters[1], 1)
+        assert key in desktop_db._paragraph_cache
+        desktop_db.db_save_chapter({'id': chapters[1], 'title': '第二章', 'order_index': 1, 'content': '新的结尾。'})
+        assert desktop_db.db_build_context(novel_id, 1000, paragraphs=1)['context'].endswith('【前文】\n新的结尾。')
+
+
+class TestSummaryTree:
+    """测试按内容哈希缓存的分层滚动摘要"""
+
+    class Summarizer:
+        """记录调用的假摘要器：章节摘要取标题，合并摘要串联子摘要"""
+
+        def __init__(self):
+            self.calls = []
+
+        def __call__(self, kind, title, text):
+            self.calls.append((kind, title))
+            return f'[{title}]' if kind == 'chapter' else '+'.join(part for part in text.split('\n\n'))
+
+    def _novel(self, db, count, **novel):
+        novel_id = db.db_save_novel({'title': '小说', **novel})
+        ids = [db.db_save_chapter({'novel_id': novel_id, 'title': str(i), 'order_index': i, 'content': f'正文{i}'})
+               for i in range(count)]
+        return novel_id, ids
+
+    def test_tree_and_cache(self, desktop_db):
+        """测试九章得到三层树（末尾单节点直接上提），再次刷新不调用摘要器"""
+        novel_id, ids = self._novel(desktop_db, 9)
+        summarize = self.Summarizer()
+        result = desktop_db.db_refresh_summary(novel_id, summarize, concurrency=1)
+        assert (result['chapters'], result['levels'], result['computed'], result['applied']) == (9, 3, 12, True)
+        assert result['summary'] == '[0]+[1]+[2]+[3]+[4]+[5]+[6]+[7]+[8]'
+        assert desktop_db.db_get_novel(novel_id)['rolling_summary'] == result['summary']
+
+        tree = desktop_db.db_get_summary_tree(novel_id)
+        assert tree['applied'] and tree['summary'] == result['summary']
+        assert [(n['level'], n['first_chapter_id'], n['last_chapter_id'], n['chapters']) for n in tree['nodes'][:4]] == [
+            (2, ids[0], ids[8], 9), (1, ids[0], ids[3], 4), (1, ids[4], ids[7], 4), (1, ids[8], ids[8], 1)]
+        assert len(tree['nodes']) == 13
+
+        summarize.calls.clear()
+        assert desktop_db.db_refresh_summary(novel_id, summarize)['computed'] == 0
+        assert summarize.calls == []
+
+    def test_edit_recomputes_ancestors_only(self, desktop_db):
+        """测试修改一章只重算该章与祖先节点，空章节不参与"""
+        novel_id, ids = self._novel(desktop_db, 9)
+        summarize = self.Summarizer()
+        desktop_db.db_refresh_summary(novel_id, summarize)
+        summarize.calls.clear()
+
+        desktop_db.db_save_chapter({'id': ids[5], 'title': '五改', 'order_index': 5, 'content': '新正文'})
+        desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '空', 'order_index': 20, 'content': ''})
+        result = desktop_db.db_refresh_summary(novel_id, summarize)
+        assert sorted(summarize.calls, key=str) == [('chapter', '五改'), ('merge', None), ('merge', None)]
+        assert result['summary'] == '[0]+[1]+[2]+[3]+[4]+[五改]+[6]+[7]+[8]'
+
+    def test_user_summary_kept(self, desktop_db):
+        """测试用户改过的滚动摘要不被覆盖，清空后恢复自动更新"""
+        novel_id, ids = self._novel(desktop_db, 2, rolling_summary='我写的梗概')
+        summarize = self.Summarizer()
+        result = desktop_db.db_refresh_summary(novel_id, summarize)
+        assert result['applied'] is False
+        assert desktop_db.db_get_novel(novel_id)['rolling_summary'] == '我写的梗概'
+        assert desktop_db.db_get_summary_tree(novel_id)['applied'] is False
+
+        desktop_db.db_patch_novel(novel_id, fields={'rolling_summary': ''})
+        assert desktop_db.db_refresh_summary(novel_id, summarize)['applied'] is True
+        desktop_db.db_save_chapter({'id': ids[1], 'title': '1', 'order_index': 1, 'content': '续写'})
+        assert desktop_db.db_refresh_summary(novel_id, summarize)['applied'] is True
+        assert desktop_db.db_get_novel(novel_id)['rolling_summary'] == '[0]+[1]'
+
+    def test_missing_and_empty_novel(self, desktop_db):
+        """测试不存在的小说返回 None，没有正文时没有摘要"""
+        assert desktop_db.db_refresh_summary(12345, self.Summarizer()) is None
+        assert desktop_db.db_get_summary_tree(12345) is None
+        novel_id, _ = self._novel(desktop_db, 0)
+        result = desktop_db.db_refresh_summary(novel_id, self.Summarizer())
+        assert (result['summary'], result['levels'], result['applied']) == (None, 0, False)
+        assert desktop_db.db_get_summary_tree(novel_id) == {'summary': None, 'applied': False, 'nodes': []}
+
+    def test_hash_backfilled(self, desktop_db):
+        """测试升级前保存的章节在刷新时补算内容哈希"""
+        novel_id, ids = self._novel(desktop_db, 2)
+        with desktop_db.get_connection() as conn:
+            conn.execute('UPDATE chapters SET content_hash = NULL')
+            conn.commit()
+        result = desktop_db.db_refresh_summary(novel_id, self.Summarizer())
+        assert result['summary'] == '[0]+[1]'
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM chapters WHERE content_hash IS NULL').fetchone()[0] == 0
+
+
+class TestSettingsCache:
+    """测试设置缓存"""
+
+    def test_reads_served_from_memory(self, desktop_db):
+        """测试无变更时重复读取不重新加载"""
+        desktop_db.db_save_setting('api_key', 'sk-1')
+        cache = get_settings_cache(desktop_db.DB_FILE)
+        assert desktop_db.db_get_setting('api_key') == 'sk-1'
+        reloads = cache.stats()['reloads']
+        for _ in range(50):
+            assert desktop_db.db_get_setting('api_key') == 'sk-1'
+        assert cache.stats()['reloads'] == reloads
+
+    def test_save_visible_immediately(self, desktop_db):
+        """测试保存后立即可见且版本号递增"""
+        cache = get_settings_cache(desktop_db.DB_FILE)
+        version = cache.version
+        desktop_db.db_save_setting('default_model', 'qwen-max')
+        assert desktop_db.db_get_setting('default_model') == 'qwen-max'
+        assert cache.version > version
+
+    def test_late_save_does_not_go_stale(self, desktop_db):
+        """测试先提交的保存较晚通知缓存时，不会覆盖之后已提交的值"""
+        cache = get_settings_cache(desktop_db.DB_FILE)
+        desktop_db.db_save_setting('api_key', 'A')
+        with sqlite3.connect(desktop_db.DB_FILE) as conn:
+            conn.execute("UPDATE settings SET value = 'B' WHERE key = 'api_key'")
+        assert desktop_db.db_get_setting('api_key') == 'B'
+        # A 的保存在 B 之后才通知缓存
+        cache.invalidate()
+        assert desktop_db.db_get_setting('api_key') == 'B'
+
+    def test_external_write_detected(self, desktop_db):
+        """测试其他进程/连接的写入通过 data_version 被发现"""
+        desktop_db.db_save_setting('api_key', 'old')
+        assert desktop_db.db_get_setting('api_key') == 'old'
+
+        with sqlite3.connect(desktop_db.DB_FILE) as conn:
+            conn.execute("UPDATE settings SET value = 'new' WHERE key = 'api_key'")
+        assert desktop_db.db_get_setting('api_key') == 'new'
@@ -0,0 +1,253 @@
+"""
+批量章节生成队列测试
+"""
+
+import io
+import threading
+import time
+import urllib.error
+import pytest
+import db_manager
+from generation_queue import GenerationQueue, fill_template, key_id
+
+
+class _Response:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeChat:
+    """模拟 chat/completions：记录每个密钥的并发数，可按顺序注入错误"""
+
+    def __init__(self, delay=0.05, errors=()):
+        self.delay = delay
+        self.errors = list(errors)
+        self.prompts = []
+        self.active = {}
+        self.peak = {}
+        self.peak_total = 0
+        self.lock = threading.Lock()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        key = headers['Authorization']
+        with self.lock:
+            self.prompts.append(body['messages'][-1]['content'])
+            self.active[key] = self.active.get(key, 0) + 1
+            self.peak[key] = max(self.peak.get(key, 0), self.active[key])
+            self.peak_total = max(self.peak_total, sum(self.active.values()))
+            error = self.errors.pop(0) if self.errors else None
+        try:
+            self.gate.wait(5)
+            time.sleep(self.delay)
+            if error is not None:
+                raise urllib.error.HTTPError(url, error, 'error', {}, io.BytesIO(b'{}'))
+            title = body['messages'][-1]['content'].split('标题：')[-1].splitlines()[0]
+            return _Response({'choices': [{'message': {'content': f'{title}的正文。'}}]})
+        finally:
+            with self.lock:
+                self.active[key] -= 1
+
+
+@pytest.fixture
+def desktop_db(tmp_path, monkeypatch):
+    """将DB_FILE指向临时文件并初始化"""
+    monkeypatch.setattr(db_manager, 'DB_FILE', str(tmp_path / "scripts.db"))
+    db_manager.init_db()
+    yield db_manager
+    db_manager.close_db()
+
+
+TEMPLATE = '{context}\n请写《{novel_title}》第{chapter_number}章。大纲：{outline}\n标题：{title}\n格式 {"json": true}'
+
+
+def _wait(queue, job_id, states=('succeeded', 'failed', 'cancelled', 'paused'), timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job['status'] in states:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} stuck in {queue.get(job_id)['status']}")
+
+
+def _queue(fake, **kwargs):
+    options = {'workers': 4, 'per_key': 2, 'retry_delay': 0.01, 'poll_interval': 0.05}
+    options.update(kwargs)
+    queue = GenerationQueue(client=fake, url='http://upstream.test/chat', **options)
+    queue.start()
+    return queue
+
+
+class TestGenerationQueue:
+    """测试持久化生成任务"""
+
+    def test_range_generated_in_order(self, desktop_db):
+        """测试按顺序生成区间内章节：补全空章、创建缺失章、跳过已有正文"""
+        novel_id = desktop_db.db_save_novel({'title': '青云志'})
+        desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '序章', 'order_index': 0, 'content': '已经写好的序章。'})
+        outlined = desktop_db.db_save_chapter({'novel_id': novel_id, 'title': '初入青云', 'order_index': 1,
+                                               'description': '林默进城', 'content': ''})
+        fake = FakeChat()
+        queue = _queue(fake)
+        try:
+            job = queue.submit(novel_id, 0, 2, TEMPLATE, 'Bearer a')
+            assert (job['status'], job['total'], job['done']) == ('queued', 3, 0)
+            assert 'auth_header' not in job and 'prompt_template' not in job
+            job = _wait(queue, job['id'])
+        finally:
+            queue.shutdown()
+        assert (job['status'], job['generated'], job['skipped'], job['done']) == ('succeeded', 2, 1, 3)
+
+        chapters = desktop_db.db_get_chapters(novel_id)
+        assert [(c['order_index'], c['title'], c['content']) for c in chapters] == [
+            (0, '序章', '已经写好的序章。'), (1, '初入青云', '初入青云的正文。'), (2, '第3章', '第3章的正文。')]
+        assert chapters[1]['id'] == outlined and chapters[1]['word_count'] == len('初入青云的正文。')
+        # 第二章的提示词带上前文与大纲，第三章的上下文包含刚生成的第二章
+        assert '请写《青云志》第2章。大纲：林默进城' in fake.prompts[0] and '已经写好的序章。' in fake.prompts[0]
+        assert '初入青云的正文。' in fake.prompts[1]
+        assert fake.prompts[0].endswith('格式 {"json": true}')
+        with desktop_db.get_connection() as conn:
+            assert conn.execute('SELECT auth_header FROM generation_jobs').fetchone()[0] is None
+
+    def test_concurrency_limits(self, desktop_db):
+        """测试全局并发与单密钥并发上限，同一小说的任务不并行"""
+        fake = FakeChat(delay=0.1)
+        novels = [desktop_db.db_save_novel({'title': f'小说{i}'}) for i in range(5)]
+        queue = _queue(fake, workers=3, per_key=2)
+        try:
+            jobs = [queue.submit(novel_id, 0, 1, TEMPLATE, 'Bearer a') for novel_id in novels[:4]]
+            jobs.append(queue.submit(novels[4], 0, 1, TEMPLATE, 'Bearer b'))
+            jobs.append(queue.submit(novels[4], 2, 3, TEMPLATE, 'Bearer b'))
+            results = [_wait(queue, job['id']) for job in jobs]
+        finally:
+            queue.shutdown()
+        assert all(job['status'] == 'succeeded' for job in results)
+        assert fake.peak['Bearer a'] == 2 and fake.peak['Bearer b'] == 1
+        assert fake.peak_total == 3
+        assert [c['order_index'] for c in desktop_db.db_get_chapters(novels[4])] == [0, 1, 2, 3]
+
+    def test_resume_after_restart(self, desktop_db):
+        """测试进程中断后重启从第一个未写入的章节继续"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        fake = FakeChat(delay=0.01)
+        queue = _queue(fake, workers=1)
+        job = queue.submit(novel_id, 0, 4, TEMPLATE, 'Bearer a')
+        deadline = time.time() + 5
+        while queue.get(job['id'])['done'] < 2 and time.time() < deadline:
+            time.sleep(0.005)
+        fake.gate.clear()
+        queue.shutdown(wait=False)
+        fake.gate.set()
+        time.sleep(0.1)
+        # 模拟异常退出：任务仍标记为运行中
+        with desktop_db.get_connection() as conn:
+            conn.execute("UPDATE generation_jobs SET status = 'running'")
+            conn.commit()
+        done = queue.get(job['id'])['done']
+        assert 2 <= done < 5
+
+        calls = len(fake.prompts)
+        restarted = _queue(fake, workers=1)
+        try:
+            result = _wait(restarted, job['id'])
+        finally:
+            restarted.shutdown()
+        assert (result['status'], result['done'], result['generated']) == ('succeeded', 5, 5)
+        assert len(fake.prompts) - calls == 5 - done
+        assert len(desktop_db.db_get_chapters(novel_id)) == 5
+
+    def test_retry_then_fail_and_resume(self, desktop_db):
+        """测试限流重试；鉴权失败使任务失败，可换密钥继续"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        fake = FakeChat(delay=0, errors=[429, 503, 401])
+        queue = _queue(fake, workers=1)
+        try:
+            job = queue.submit(novel_id, 0, 1, TEMPLATE, 'Bearer a')
+            failed = _wait(queue, job['id'])
+            assert failed['status'] == 'failed' and '401' in failed['error'] and failed['done'] == 0
+            assert queue.stats()['retries'] == 2
+            # 失败后不再保存密钥，继续时须重新提供
+            assert desktop_db.db_get_generation_job(job['id'], with_prompt=True)['auth_header'] is None
+            assert queue.resume(job['id']) is None
+
+            assert queue.cancel(job['id']) is not None and queue.resume(job['id']) is None
+            job = queue.submit(novel_id, 0, 1, TEMPLATE, 'Bearer a')
+            fake.errors = [401]
+            assert _wait(queue, job['id'])['status'] == 'failed'
+            resumed = queue.resume(job['id'], 'Bearer b')
+            assert resumed['status'] == 'queued' and resumed['key_id'] == key_id('Bearer b')
+            done = _wait(queue, job['id'])
+        finally:
+            queue.shutdown()
+        assert (done['status'], done['generated'], done['attempts'], done['error']) == ('succeeded', 2, 0, None)
+
+    def test_pause_and_cancel(self, desktop_db):
+        """测试暂停时丢弃进行中的章节，恢复后重做；不存在的小说返回 None"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        fake = FakeChat(delay=0)
+        fake.gate.clear()
+        queue = _queue(fake, workers=1)
+        try:
+            job = queue.submit(novel_id, 0, 1, TEMPLATE, 'Bearer a')
+            _wait(queue, job['id'], ('running',))
+            deadline = time.time() + 5
+            while not fake.prompts and time.time() < deadline:
+                time.sleep(0.005)
+            assert queue.pause(job['id'])['status'] == 'paused'
+            fake.gate.set()
+            time.sleep(0.1)
+            assert queue.get(job['id'])['done'] == 0
+            assert queue.pause(job['id']) is None
+            queue.resume(job['id'])
+            assert _wait(queue, job['id'])['status'] == 'succeeded'
+            assert len(fake.prompts) == 3
+
+            assert queue.submit(novel_id + 100, 0, 1, TEMPLATE, 'Bearer a') is None
+            with pytest.raises(ValueError):
+                queue.submit(novel_id, 3, 1, TEMPLATE, 'Bearer a')
+            with pytest.raises(ValueError):
+                queue.submit(novel_id, 0, 1, ' ', 'Bearer a')
+            assert [j['id'] for j in queue.list(novel_id)] == [job['id']]
+        finally:
+            queue.shutdown()
+
+    def test_cancel_removes_placeholder(self, desktop_db):
+        """测试取消任务时删除为正在生成的章节预建的空章节，保留用户写过的章节"""
+        novel_id = desktop_db.db_save_novel({'title': '小说'})
+        fake = FakeChat(delay=0)
+        fake.gate.clear()
+        queue = _queue(fake, workers=1)
+        try:
+            job = queue.submit(novel_id, 0, 1, TEMPLATE, 'Bearer a')
+            deadline = time.time() + 5
+            while not fake.prompts and time.time() < deadline:
+                time.sleep(0.005)
+            assert [c['title'] for c in desktop_db.db_get_chapters(novel_id)] == ['第1章']
+            assert queue.cancel(job['id'])['status'] == 'cancelled'
+            fake.gate.set()
+            time.sleep(0.1)
+            assert desktop_db.db_get_chapters(novel_id) == []
+
+            fake.gate.clear()
+            job = queue.submit(novel_id, 0, 0, TEMPLATE, 'Bearer a')
+            deadline = time.time() + 5
+            while len(fake.prompts) < 2 and time.time() < deadline:
+                time.sleep(0.005)
+            chapter_id = desktop_db.db_get_chapters(novel_id)[0]['id']
+            desktop_db.db_save_chapter({'id': chapter_id, 'title': '第1章', 'content': '用户先写了开头'})
+            queue.cancel(job['id'])
+            fake.gate.set()
+            time.sleep(0.1)
+        finally:
+            queue.shutdown()
+        assert [c['content'] for c in desktop_db.db_get_chapters(novel_id)] == ['用户先写了开头']
+        assert desktop_db.db_get_generation_job(job['id'], with_prompt=True)['auth_header'] is None
+
+    def test_fill_template(self):
+        """测试只替换已知变量，其它花括号保留"""
+        assert fill_template('{title}:{unknown}{chapter_number}', {'title': '一', 'chapter_number': 2}) == '一:{unknown}2'
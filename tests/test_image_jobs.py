@@ -0,0 +1,142 @@
+"""
+图片生成任务引擎测试
+"""
+
+import io
+import time
+import threading
+import urllib.error
+from image_job_manager import ImageJobManager
+
+
+class _Response:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeDashScope:
+    """模拟DashScope：flux无权限，任务轮询若干次后完成"""
+
+    def __init__(self, polls_until_done=2, fail_tasks=False):
+        self.polls_until_done = polls_until_done
+        self.fail_tasks = fail_tasks
+        self.submitted_models = []
+        self.polls = {}
+        self.lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        with self.lock:
+            if method == 'POST':
+                model = body['model']
+                self.submitted_models.append(model)
+                if model == 'flux-merge':
+                    raise urllib.error.HTTPError(url, 403, 'Forbidden', {}, io.BytesIO(b'{}'))
+                task_id = f"task-{len(self.submitted_models)}"
+                self.polls[task_id] = 0
+                return _Response({'output': {'task_id': task_id, 'task_status': 'PENDING'}})
+
+            task_id = url.rsplit('/', 1)[1]
+            self.polls[task_id] += 1
+            if self.fail_tasks:
+                return _Response({'output': {'task_status': 'FAILED', 'message': '内容违规'}})
+            if self.polls[task_id] <= self.polls_until_done:
+                return _Response({'output': {'task_status': 'RUNNING'}})
+            return _Response({'output': {'task_status': 'SUCCEEDED',
+                                         'results': [{'url': f"https://img.example/{task_id}.png"}]}})
+
+
+class TestImageJobManager:
+    """测试图片任务引擎"""
+
+    def test_job_succeeds_with_fallback(self):
+        """测试提交立即返回，轮询完成后得到图片地址"""
+        fake = FakeDashScope()
+        manager = ImageJobManager(client=fake, min_interval=0.01, max_interval=0.05,
+                                  task_url='https://upstream/tasks/{task_id}')
+
+        job = manager.submit('一只猫', 'Bearer test')
+        assert job['status'] == 'QUEUED'
+
+        result = manager.wait_for_result(job['id'], timeout=5)
+        assert result['status'] == 'SUCCEEDED'
+        assert result['model'] == 'wanx-v1'
+        assert result['url'].endswith('.png')
+        assert fake.submitted_models == ['flux-merge', 'wanx-v1']
+        manager.shutdown()
+
+    def test_wait_reports_each_change(self):
+        """测试按版本号等待状态变化"""
+        fake = FakeDashScope(polls_until_done=3)
+        manager = ImageJobManager(client=fake, min_interval=0.01, max_interval=0.05,
+                                  task_url='https://upstream/tasks/{task_id}')
+
+        job = manager.submit('分镜', 'Bearer test')
+        seen = []
+        version = job['version']
+        while True:
+            snapshot = manager.wait(job['id'], since_version=version, timeout=5)
+            version = snapshot['version']
+            seen.append(snapshot['status'])
+            if snapshot['status'] in ('SUCCEEDED', 'FAILED'):
+                break
+
+        assert seen[-1] == 'SUCCEEDED'
+        assert 'RUNNING' in seen
+        manager.shutdown()
+
+    def test_failed_task(self):
+        """测试上游任务失败"""
+        manager = ImageJobManager(client=FakeDashScope(fail_tasks=True), min_interval=0.01,
+                                  task_url='https://upstream/tasks/{task_id}')
+
+        job = manager.submit('违规内容', 'Bearer test')
+        result = manager.wait_for_result(job['id'], timeout=5)
+        assert result['status'] == 'FAILED'
+        assert '内容违规' in result['error']
+        manager.shutdown()
+
+    def test_unknown_job(self):
+        """测试不存在的任务"""
+        manager = ImageJobManager(client=FakeDashScope())
+        assert manager.get('missing') is None
+        assert manager.wait('missing', timeout=0.01) is None
+        manager.shutdown()
+
+    def test_batch_learns_model_once(self):
+        """测试批量生成只探测一次flux，之后直接使用回退模型"""
+        fake = FakeDashScope(polls_until_done=1)
+        manager = ImageJobManager(client=fake, min_interval=0.01, max_interval=0.05,
+                                  task_url='https://upstream/tasks/{task_id}')
+
+        batch = manager.submit_batch([f"分镜{i}" for i in range(6)], 'Bearer test', concurrency=3)
+        assert batch['total'] == 6
+
+        results = list(manager.iter_batch_results(batch['id'], timeout=10))
+        assert len(results) == 6
+        assert sorted(r['index'] for r in results) == list(range(6))
+        assert all(r['status'] == 'SUCCEEDED' for r in results)
+        assert fake.submitted_models.count('flux-merge') == 1
+        assert manager.get_batch(batch['id'])['finished'] == 6
+        manager.shutdown()
+
+    def test_batch_concurrency_limit(self):
+        """测试批量任务同时在上游运行的数量不超过并发上限"""
+        fake = FakeDashScope(polls_until_done=2)
+        manager = ImageJobManager(client=fake, min_interval=0.01, max_interval=0.05,
+                                  task_url='https://upstream/tasks/{task_id}')
+
+        batch = manager.submit_batch([f"分镜{i}" for i in range(5)], 'Bearer test', concurrency=2)
+        peak = 0
+        while True:
+            snapshot = manager.get_batch(batch['id'])
+            active = sum(1 for job in snapshot['jobs'] if job['status'] not in ('QUEUED', 'SUCCEEDED', 'FAILED'))
+            peak = max(peak, active)
+            if snapshot['finished'] == snapshot['total']:
+                break
+            time.sleep(0.005)
+
+        assert 0 < peak <= 2
+        manager.shutdown()
@@ -0,0 +1,65 @@
+"""
+JSON Patch（RFC 6902）测试
+"""
+
+import pytest
+from json_patch import JsonPatchError, JsonPatchTestFailed, apply_patch, parse_pointer
+
+
+def novel_data():
+    return {
+        'characters': [{'name': '林默', 'role': '主角'}, {'name': '苏晴', 'role': '配角'}],
+        'worldSettings': [],
+        'a/b': {'~k': 1},
+        'chaptersCount': 2,
+    }
+
+
+class TestJsonPatch:
+    """测试补丁操作"""
+
+    def test_operations(self):
+        """测试六种操作与数组末尾追加"""
+        doc = apply_patch(novel_data(), [
+            {'op': 'replace', 'path': '/characters/0/role', 'value': '反派'},
+            {'op': 'add', 'path': '/characters/-', 'value': {'name': '老周'}},
+            {'op': 'add', 'path': '/characters/0', 'value': {'name': '旁白'}},
+            {'op': 'remove', 'path': '/characters/2'},
+            {'op': 'copy', 'from': '/characters/1', 'path': '/worldSettings/0'},
+            {'op': 'move', 'from': '/chaptersCount', 'path': '/totalChapters'},
+            {'op': 'test', 'path': '/totalChapters', 'value': 2},
+        ])
+        assert [c['name'] for c in doc['characters']] == ['旁白', '林默', '老周']
+        assert doc['worldSettings'] == [{'name': '林默', 'role': '反派'}]
+        assert doc['worldSettings'][0] is not doc['characters'][1]
+        assert 'chaptersCount' not in doc and doc['totalChapters'] == 2
+
+    def test_pointer_escapes_and_root(self):
+        """测试 ~0/~1 转义与整文档替换"""
+        assert parse_pointer('/a~1b/~0k') == ['a/b', '~k']
+        doc = apply_patch(novel_data(), [{'op': 'replace', 'path': '/a~1b/~0k', 'value': 2}])
+        assert doc['a/b'] == {'~k': 2}
+        assert apply_patch(novel_data(), [{'op': 'replace', 'path': '', 'value': []}]) == []
+
+    @pytest.mark.parametrize('ops', [
+        [{'op': 'replace', 'path': '/missing', 'value': 1}],
+        [{'op': 'remove', 'path': '/characters/5'}],
+        [{'op': 'add', 'path': '/characters/01', 'value': 1}],
+        [{'op': 'add', 'path': '/missing/x', 'value': 1}],
+        [{'op': 'move', 'from': '/characters', 'path': '/characters/0'}],
+        [{'op': 'add', 'path': 'characters', 'value': 1}],
+        [{'op': 'add', 'path': '/x'}],
+        [{'op': 'rename', 'path': '/x'}],
+        {'op': 'add', 'path': '/x', 'value': 1},
+    ])
+    def test_invalid(self, ops):
+        """测试非法补丁报错"""
+        with pytest.raises(JsonPatchError):
+            apply_patch(novel_data(), ops)
+
+    def test_test_operation(self):
+        """测试 test 操作严格比较类型"""
+        apply_patch(novel_data(), [{'op': 'test', 'path': '/chaptersCount', 'value': 2.0}])
+        for value in (True, '2', 3):
+            with pytest.raises(JsonPatchTestFailed):
+                apply_patch(novel_data(), [{'op': 'test', 'path': '/chaptersCount', 'value': value}])
@@ -0,0 +1,55 @@
+"""
+提示词上下文的 token 估算与预算分配测试
+"""
+
+from prompt_context import estimate_tokens, pack_sections, truncate_to_tokens
+
+
+class TestEstimateTokens:
+    """测试 token 估算"""
+
+    def test_estimate(self):
+        """测试中文按字、其他字符按四个一计"""
+        assert estimate_tokens('') == estimate_tokens(None) == 0
+        assert estimate_tokens('林默说：') == 4
+        assert estimate_tokens('Hello world') == 3
+        assert estimate_tokens('林默 said hi') == 4
+
+    def test_truncate(self):
+        """测试按预算保留开头或结尾"""
+        assert truncate_to_tokens('一二三四五', 3) == '一二三'
+        assert truncate_to_tokens('一二三四五', 3, keep='end') == '三四五'
+        assert truncate_to_tokens('一二', 3) == '一二'
+
+
+class TestPackSections:
+    """测试按预算挑选内容"""
+
+    @staticmethod
+    def items(*lengths):
+        return [('字' * n, n) for n in lengths]
+
+    def test_shares_then_leftover(self):
+        """测试先按份额分配，剩余预算按顺序补给各部分"""
+        sections = [
+            {'name': 'recent', 'items': self.items(30, 30, 30), 'share': 0.5},
+            {'name': 'summary', 'items': self.items(200), 'share': 0.3, 'truncate': 'end'},
+            {'name': 'outline', 'items': [], 'share': 0.2},
+        ]
+        picked, used = pack_sections(sections, 100)
+        # 第一轮：前文 30、摘要截断到 30；大纲为空，剩余的 40 在第二轮先给前文、再给摘要
+        assert [index for index, _, _ in picked['recent']] == [0, 1]
+        assert picked['summary'][0][2] == 40
+        assert picked['outline'] == []
+        assert used == 100
+
+    def test_skip_items_that_do_not_fit(self):
+        """测试放不下的条目被跳过，较小的后续条目仍可加入"""
+        picked, used = pack_sections([{'name': 'entities', 'items': self.items(8, 20, 5), 'share': 1.0}], 15)
+        assert [index for index, _, _ in picked['entities']] == [0, 2]
+        assert used == 13
+
+    def test_zero_budget(self):
+        """测试预算为零时不选任何内容"""
+        picked, used = pack_sections([{'name': 'recent', 'items': self.items(1), 'share': 1.0}], 0)
+        assert (picked, used) == ({'recent': []}, 0)
@@ -0,0 +1,46 @@
+"""
+检索分段与分词测试
+"""
+
+from retrieval import PASSAGE_MAX_CHARS, PASSAGE_MIN_CHARS, index_text, match_query, query_terms, split_passages
+
+
+class TestSplitPassages:
+    """测试按段落切分"""
+
+    def test_short_paragraphs_merged(self):
+        """测试短段落与下一段合并，结尾的短段并入上一段"""
+        long_paragraph = '长' * PASSAGE_MIN_CHARS
+        text = f'短段。\n\n{long_paragraph}\n{long_paragraph}\n尾巴\n'
+        passages = split_passages(text)
+        assert [text[start:start + length] for start, length in passages] == [
+            f'短段。\n\n{long_paragraph}', f'{long_paragraph}\n尾巴']
+
+    def test_long_paragraph_cut_at_sentence_end(self):
+        """测试超长段落优先在句末切开"""
+        sentence = '他' * 99 + '。'
+        text = sentence * 10
+        passages = split_passages(text)
+        assert all(length <= PASSAGE_MAX_CHARS for _, length in passages)
+        assert all(text[start + length - 1] == '。' for start, length in passages)
+        assert sum(length for _, length in passages) == len(text)
+
+    def test_empty(self):
+        """测试空文本没有段落"""
+        assert split_passages('') == split_passages('\n \n') == []
+        assert split_passages('一句话') == [(0, 3)]
+
+
+class TestTokenize:
+    """测试中文二元组与英文单词"""
+
+    def test_query_terms(self):
+        """测试中文按二元组、英文按单词拆分并去重"""
+        assert query_terms('林默见到Alice，林默！好') == ['林默', '默见', '见到', 'alice', '好']
+        assert query_terms('，。!') == []
+
+    def test_match_query(self):
+        """测试二元组作为相邻字的短语查询"""
+        assert index_text('林默说OK') == ' 林  默  说 OK'
+        assert match_query('林默 OK') == '"林 默" OR "ok"'
+        assert match_query('……') is None
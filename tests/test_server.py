@@ -0,0 +1,194 @@
+"""
+桌面端代理服务器流式转发测试（本地模拟上游 SSE 接口）
+"""
+
+import json
+import socket
+import threading
+import http.server
+import socketserver
+import pytest
+import db_manager
+import server
+
+
+class _UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """模拟上游 SSE：逐个事件分块发送，第一个事件后等待放行，可在中途断开"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(self.headers.get('Authorization'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, event in enumerate(self.server.events):
+            if i and not self.server.release.wait(5):
+                break
+            self.wfile.write(f"{len(event):X}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+        if self.server.fail:
+            # 不发送结束块直接断开，模拟上游中途出错
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _serve(handler):
+    httpd = _Server(('127.0.0.1', 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    httpd = _serve(_UpstreamHandler)
+    httpd.requests = []
+    httpd.events = []
+    httpd.fail = False
+    httpd.release = threading.Event()
+    monkeypatch.setattr(server, 'TARGET_URL', f"http://127.0.0.1:{httpd.server_address[1]}/chat")
+    yield httpd
+    httpd.release.set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def proxy(tmp_path, monkeypatch):
+    """临时数据库上的代理服务器，返回端口"""
+    monkeypatch.setattr(db_manager, 'DB_FILE', str(tmp_path / "scripts.db"))
+    db_manager.init_db()
+    monkeypatch.setattr(server.ProxyHTTPRequestHandler, 'log_message', lambda *args: None)
+    httpd = _serve(server.ProxyHTTPRequestHandler)
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+    db_manager.close_db()
+
+
+def _post_stream(port):
+    body = json.dumps({'model': 'qwen-plus', 'stream': True, 'messages': []}).encode()
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    sock.sendall(b'POST /api/proxy HTTP/1.1\r\nHost: localhost\r\nAuthorization: Bearer sk-test\r\n'
+                 b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+    return sock
+
+
+def _read_until(sock, data, marker):
+    while marker not in data:
+        received = sock.recv(65536)
+        if not received:
+            break
+        data += received
+    return data
+
+
+def _read_all(sock, data=b''):
+    while True:
+        received = sock.recv(65536)
+        if not received:
+            return data
+        data += received
+
+
+def _chunks(raw):
+    """按分块编码拆开响应体；断言以零长度块结束"""
+    head, body = raw.split(b'\r\n\r\n', 1)
+    assert b'Transfer-Encoding: chunked' in head
+    chunks = []
+    while True:
+        size_line, body = body.split(b'\r\n', 1)
+        size = int(size_line, 16)
+        if size == 0:
+            assert body == b'\r\n'
+            return chunks
+        chunks.append(body[:size])
+        assert body[size:size + 2] == b'\r\n'
+        body = body[size + 2:]
+
+
+EVENTS = [b'data: {"choices":[{"delta":{"content":"\xe6\x9e\x97"}}]}\n\n',
+          b'data: {"choices":[{"delta":{"content":"\xe9\xbb\x98"}}]}\n\n',
+          b'data: [DONE]\n\n']
+
+
+class TestProxyStream:
+    """测试 /api/proxy 的 SSE 流式转发"""
+
+    def test_events_forwarded_as_they_arrive(self, upstream, proxy):
+        """测试每个事件到达即转发为一个分块，结束时发送零长度块"""
+        upstream.events = EVENTS
+        sock = _post_stream(proxy)
+        try:
+            # 上游仍在等待放行时，第一个事件已经到达客户端
+            first = _read_until(sock, b'', EVENTS[0])
+            assert EVENTS[0] in first and not upstream.release.is_set()
+            upstream.release.set()
+            raw = _read_all(sock, first)
+        finally:
+            sock.close()
+        assert raw.startswith(b'HTTP/1.1 200')
+        assert b'Content-Type: text/event-stream' in raw.split(b'\r\n\r\n', 1)[0]
+        assert _chunks(raw) == EVENTS
+        assert upstream.requests == ['Bearer sk-test']
+
+    def test_upstream_failure_sends_error_event(self, upstream, proxy):
+        """测试上游中途断开时发送错误事件并正常结束，而不是截断响应"""
+        upstream.events = EVENTS[:1]
+        upstream.fail = True
+        sock = _post_stream(proxy)
+        try:
+            raw = _read_all(sock)
+        finally:
+            sock.close()
+        chunks = _chunks(raw)
+        assert chunks[0] == EVENTS[0]
+        assert len(chunks) == 2 and chunks[1].startswith(b'data: ') and chunks[1].endswith(b'\n\n')
+        assert 'message' in json.loads(chunks[1][len(b'data: '):])['error']
+
+
+class _FakeImageJobs:
+    """模拟批量生图：只有第一张在流结束前完成"""
+
+    def __init__(self):
+        self.timeout = None
+
+    def submit_batch(self, prompts, auth_header, size, concurrency):
+        jobs = [{'id': f'job{i}', 'index': i} for i in range(len(prompts))]
+        return {'id': 'batch1', 'total': len(prompts), 'concurrency': 4, 'jobs': jobs}
+
+    def iter_batch_results(self, batch_id, timeout=None):
+        self.timeout = timeout
+        yield {'id': 'job0', 'index': 0, 'status': 'SUCCEEDED', 'url': 'http://img/0.png'}
+
+
+class TestImageBatchStream:
+    """测试 /api/images/batch 的 NDJSON 流"""
+
+    def test_unfinished_jobs_reported_pending(self, proxy, monkeypatch):
+        """测试等待时长按批次轮数计算，流结束时未完成的镜头报告为仍在运行"""
+        fake = _FakeImageJobs()
+        monkeypatch.setattr(server, 'image_job_manager', fake)
+        body = json.dumps({'prompts': [f'镜头{i}' for i in range(10)]}).encode()
+        sock = socket.create_connection(('127.0.0.1', proxy), timeout=5)
+        try:
+            sock.sendall(b'POST /api/images/batch HTTP/1.1\r\nHost: localhost\r\nAuthorization: Bearer sk-test\r\n'
+                         b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            raw = _read_all(sock)
+        finally:
+            sock.close()
+        lines = [json.loads(line) for line in b''.join(_chunks(raw)).decode().splitlines()]
+        assert lines[0]['batch_id'] == 'batch1' and lines[1]['index'] == 0
+        assert lines[-1] == {'done': False, 'succeeded': 1, 'failed': 0, 'pending': list(range(1, 10))}
+        # 10 张、每轮 4 张：三轮
+        assert fake.timeout == server.IMAGE_WAIT_TIMEOUT * 3
+
@@ -0,0 +1,168 @@
+"""
+滚动摘要流水线测试（本地模拟 DashScope 兼容接口）
+"""
+
+import hashlib
+import json
+import threading
+import http.server
+import socketserver
+import urllib.error
+import pytest
+import db_manager
+from upstream_client import UpstreamClient
+from summary_pipeline import ChatSummarizer, SummaryScheduler, build_prompt, SUMMARY_INPUT_TOKENS
+from prompt_context import estimate_tokens
+
+
+class _ChatHandler(http.server.BaseHTTPRequestHandler):
+    """模拟 chat/completions：摘要由提示词内容决定，记录每次请求"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = json.loads(self.rfile.read(length))
+        self.server.requests.append((self.headers.get('Authorization'), data))
+        if self.server.fail:
+            status, payload = 429, {'error': {'message': 'Throttling'}}
+        else:
+            prompt = data['messages'][0]['content']
+            summary = '摘要' + hashlib.sha1(prompt.encode()).hexdigest()[:8]
+            status, payload = 200, {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': summary}}]}
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def dashscope():
+    server = _Server(('127.0.0.1', 0), _ChatHandler)
+    server.requests = []
+    server.fail = False
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/compatible-mode/v1/chat/completions"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client():
+    client = UpstreamClient()
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def desktop_db(tmp_path, monkeypatch):
+    """将DB_FILE指向临时文件并初始化"""
+    monkeypatch.setattr(db_manager, 'DB_FILE', str(tmp_path / "scripts.db"))
+    db_manager.init_db()
+    yield db_manager
+    db_manager.close_db()
+
+
+class TestChatSummarizer:
+    """测试调用上游生成摘要"""
+
+    def test_request_and_response(self, dashscope, client):
+        """测试请求体为 OpenAI 兼容格式并带上鉴权头"""
+        summarize = ChatSummarizer('Bearer sk-test', client=client, url=dashscope.url, model='qwen-turbo')
+        summary = summarize('chapter', '第一章', '林默走进青云城。')
+        auth, data = dashscope.requests[0]
+        assert auth == 'Bearer sk-test'
+        assert data['model'] == 'qwen-turbo'
+        assert '第一章' in data['messages'][0]['content'] and '林默走进青云城。' in data['messages'][0]['content']
+        assert summary.startswith('摘要') and summarize.calls == 1
+
+    def test_upstream_error(self, dashscope, client):
+        """测试上游错误原样抛出"""
+        dashscope.fail = True
+        with pytest.raises(urllib.error.HTTPError):
+            ChatSummarizer('Bearer sk-test', client=client, url=dashscope.url)('merge', None, '甲\n\n乙')
+
+    def test_long_chapter_truncated(self):
+        """测试超长章节截断到输入预算"""
+        prompt = build_prompt('chapter', '长章', '字' * (SUMMARY_INPUT_TOKENS * 2))
+        assert estimate_tokens(prompt) < SUMMARY_INPUT_TOKENS + 200
+
+
+class TestIncrementalSummary:
+    """测试经模拟上游的增量摘要"""
+
+    def _novel(self, db, chapters):
+        novel_id = db.db_save_novel({'title': '小说'})
+        ids = [db.db_save_chapter({'novel_id': novel_id, 'title': f'第{i + 1}章', 'order_index': i,
+                                   'content': f'第{i + 1}章的正文，林默在青云城的第{i + 1}天。'})
+               for i in range(chapters)]
+        return novel_id, ids
+
+    def test_only_changed_path_recomputed(self, desktop_db, dashscope, client):
+        """测试修改一章只重算该章及其上层合并摘要"""
+        novel_id, ids = self._novel(desktop_db, 16)
+        summarize = ChatSummarizer('Bearer sk-test', client=client, url=dashscope.url)
+
+        result = desktop_db.db_refresh_summary(novel_id, summarize)
+        # 16 个章节摘要 + 4 个四章合并 + 1 个根
+        assert (result['computed'], result['levels'], result['chapters']) == (21, 3, 16)
+        assert len(dashscope.requests) == 21
+        assert desktop_db.db_get_novel(novel_id)['rolling_summary'] == result['summary']
+
+        desktop_db.db_save_chapter({'id': ids[9], 'novel_id': novel_id, 'title': '第10章', 'order_index': 9,
+                                    'content': '改写后的第十章。'})
+        again = desktop_db.db_refresh_summary(novel_id, summarize)
+        assert again['computed'] == 3
+        assert len(dashscope.requests) == 24
+        assert again['summary'] != result['summary']
+        assert desktop_db.db_get_novel(novel_id)['rolling_summary'] == again['summary']
+
+    def test_failed_refresh_resumes(self, desktop_db, dashscope, client):
+        """测试上游失败后重试不重复已完成的摘要"""
+        novel_id, _ = self._novel(desktop_db, 5)
+        summarize = ChatSummarizer('Bearer sk-test', client=client, url=dashscope.url)
+        calls = []
+
+        def flaky(kind, title, text):
+            calls.append(kind)
+            if kind == 'merge':
+                raise urllib.error.HTTPError(dashscope.url, 429, 'Throttling', {}, None)
+            return summarize(kind, title, text)
+
+        with pytest.raises(urllib.error.HTTPError):
+            desktop_db.db_refresh_summary(novel_id, flaky, concurrency=1)
+        assert calls.count('chapter') == 5
+        result = desktop_db.db_refresh_summary(novel_id, summarize)
+        # 章节摘要已缓存，只剩两层合并
+        assert result['computed'] == 2
+
+
+class TestSummaryScheduler:
+    """测试保存后的摘要刷新调度"""
+
+    def test_coalesced_and_failures_counted(self):
+        """测试同一小说多次保存只刷新一次，失败只计数"""
+        refreshed = []
+
+        def refresh(novel_id):
+            refreshed.append(novel_id)
+            if novel_id == 2:
+                raise RuntimeError('no key')
+
+        scheduler = SummaryScheduler(refresh, delay=60)
+        for novel_id in (1, 1, 2, 1, None):
+            scheduler.schedule(novel_id)
+        assert scheduler.flush() == 2
+        assert sorted(refreshed) == [1, 2]
+        stats = scheduler.stats()
+        assert (stats['scheduled'], stats['refreshed'], stats['failures'], stats['pending']) == (4, 2, 1, 0)
@@ -0,0 +1,60 @@
+"""
+正文压缩编码测试
+"""
+
+import sqlite3
+import text_codec
+from text_codec import CODEC_ZLIB, decode, encode, is_compressed, recompress_table
+
+CHAPTER = '他深吸一口气，沉默了片刻，低声道：“我知道了。”\n\n' * 200
+
+
+class TestTextCodec:
+    """测试正文编解码"""
+
+    def test_roundtrip(self):
+        """测试超过阈值的正文压缩后可还原"""
+        stored = encode(CHAPTER, CODEC_ZLIB)
+        assert is_compressed(stored)
+        assert len(stored) < len(CHAPTER.encode('utf-8')) / 5
+        assert decode(stored) == CHAPTER
+
+    def test_small_or_disabled_stays_text(self):
+        """测试短文本与关闭压缩时保持原样"""
+        assert encode('短文本', CODEC_ZLIB) == '短文本'
+        assert encode(CHAPTER, False) == CHAPTER
+        assert encode(None, CODEC_ZLIB) is None
+        assert decode('旧数据') == '旧数据'
+
+    def test_default_is_off(self, monkeypatch):
+        """测试默认不压缩"""
+        monkeypatch.setattr(text_codec, 'DB_COMPRESSION', 'off')
+        assert encode(CHAPTER) == CHAPTER
+
+    def test_sql_function_and_recompress(self):
+        """测试SQL解压函数与分批转换"""
+        conn = text_codec.register_functions(sqlite3.connect(':memory:'))
+        conn.execute('CREATE TABLE chapters (id INTEGER PRIMARY KEY, content TEXT)')
+        conn.executemany('INSERT INTO chapters (content) VALUES (?)', [(CHAPTER,), ('短',), (None,)])
+        conn.commit()
+
+        class _Factory:
+            def __call__(self):
+                return self
+
+            def __enter__(self):
+                return conn
+
+            def __exit__(self, *exc):
+                return False
+
+        summary = recompress_table(_Factory(), 'chapters', codec=CODEC_ZLIB, batch_size=2)
+        assert summary['rows'] == 3 and summary['rewritten'] == 1
+        assert summary['bytes_after'] < summary['bytes_before']
+        assert conn.execute('SELECT typeof(content) FROM chapters WHERE id = 1').fetchone()[0] == 'blob'
+        assert conn.execute('SELECT dz_decompress(content) FROM chapters WHERE id = 1').fetchone()[0] == CHAPTER
+
+        # 再次执行不会重复改写；False 解压回文本
+        assert recompress_table(_Factory(), 'chapters', codec=CODEC_ZLIB)['rewritten'] == 0
+        assert recompress_table(_Factory(), 'chapters', codec=False)['rewritten'] == 1
+        assert conn.execute('SELECT content FROM chapters WHERE id = 1').fetchone()[0] == CHAPTER
@@ -0,0 +1,147 @@
+"""
+上游连接池客户端测试
+"""
+
+import json
+import threading
+import urllib.error
+import http.server
+import socketserver
+import pytest
+from upstream_client import UpstreamClient, UpstreamError
+
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """本地模拟上游：HTTP/1.1 keep-alive，记录客户端端口"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.client_ports.append(self.client_address[1])
+        if self.path == '/missing':
+            self._reply(404, {'message': 'not found'})
+        elif self.path == '/truncated':
+            # 声明的长度比实际发送的多，随后断开
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write(b'data: partial\n')
+            self.close_connection = True
+        else:
+            self._reply(200, {'path': self.path})
+        if self.path == '/drop':
+            # 不发送Connection: close直接断开，模拟上游回收空闲连接
+            self.close_connection = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = json.loads(self.rfile.read(length))
+        self.server.client_ports.append(self.client_address[1])
+        self._reply(200, {'echo': data})
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def upstream():
+    server = _Server(('127.0.0.1', 0), _KeepAliveHandler)
+    server.client_ports = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestUpstreamClient:
+    """测试上游连接池"""
+
+    def test_connection_reuse(self, upstream):
+        """测试连续请求复用同一连接"""
+        client = UpstreamClient(pool_size=2)
+        base = f"http://127.0.0.1:{upstream.server_address[1]}"
+
+        for i in range(5):
+            response = client.request('GET', f"{base}/task/{i}")
+            assert response.status == 200
+            assert response.json()['path'] == f"/task/{i}"
+
+        # 所有请求走同一条TCP连接
+        assert len(set(upstream.client_ports)) == 1
+
+        stats = client.stats()['hosts'][f"http://127.0.0.1:{upstream.server_address[1]}"]
+        assert stats['created'] == 1
+        assert stats['reused'] == 4
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 1
+        client.close()
+
+    def test_json_body(self, upstream):
+        """测试字典请求体按JSON发送"""
+        client = UpstreamClient()
+        base = f"http://127.0.0.1:{upstream.server_address[1]}"
+
+        response = client.request('POST', f"{base}/generate", body={'prompt': '测试'})
+        assert response.json() == {'echo': {'prompt': '测试'}}
+        client.close()
+
+    def test_http_error(self, upstream):
+        """测试错误状态码抛出HTTPError且连接仍可复用"""
+        client = UpstreamClient()
+        base = f"http://127.0.0.1:{upstream.server_address[1]}"
+
+        with pytest.raises(urllib.error.HTTPError) as exc_info:
+            client.request('GET', f"{base}/missing")
+        assert exc_info.value.code == 404
+        assert json.loads(exc_info.value.read())['message'] == 'not found'
+
+        response = client.request('GET', f"{base}/missing", raise_for_status=False)
+        assert response.status == 404
+        assert len(set(upstream.client_ports)) == 1
+        client.close()
+
+    def test_stale_connection_retry(self, upstream):
+        """测试服务端关闭空闲连接后自动重连"""
+        client = UpstreamClient()
+        base = f"http://127.0.0.1:{upstream.server_address[1]}"
+        client.request('GET', f"{base}/drop")
+
+        response = client.request('GET', f"{base}/second")
+        assert response.json()['path'] == '/second'
+        assert len(set(upstream.client_ports)) == 2
+        client.close()
+
+    def test_truncated_body(self, upstream):
+        """测试读取正文时连接中断抛出UpstreamError并丢弃该连接"""
+        client = UpstreamClient()
+        base = f"http://127.0.0.1:{upstream.server_address[1]}"
+        with pytest.raises(UpstreamError):
+            client.request('GET', f"{base}/truncated").read()
+        with pytest.raises(UpstreamError):
+            list(client.request('GET', f"{base}/truncated", stream=True))
+
+        assert client.request('GET', f"{base}/after").json()['path'] == '/after'
+        stats = client.stats()['hosts'][base]
+        assert stats['created'] == 3 and stats['in_use'] == 0
+        client.close()
+
+    def test_connection_refused(self):
+        """测试连接失败"""
+        client = UpstreamClient(connect_timeout=1)
+        with pytest.raises(UpstreamError):
+            client.request('GET', 'http://127.0.0.1:1/unreachable')
+        stats = client.stats()['hosts']['http://127.0.0.1:1']
+        assert stats['errors'] == 1
+        assert stats['in_use'] == 0
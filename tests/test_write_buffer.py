@@ -0,0 +1,90 @@
+"""
+自动保存合并写入测试
+"""
+
+import threading
+import time
+import pytest
+from write_buffer import WriteBehindBuffer
+
+
+class _Recorder:
+    def __init__(self, fail=0):
+        self.batches = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def __call__(self, items):
+        with self.lock:
+            if self.fail:
+                self.fail -= 1
+                raise RuntimeError("database is locked")
+            self.batches.append(dict(items))
+
+
+class TestWriteBehindBuffer:
+    """测试写回缓冲"""
+
+    def test_coalesces_within_window(self):
+        """测试窗口内同一记录的多次保存合并为一次写入"""
+        recorder = _Recorder()
+        buffer = WriteBehindBuffer(recorder, window=0.1)
+        for i in range(10):
+            buffer.put(('chapter', 1), {'content': f'草稿{i}'})
+        buffer.put(('chapter', 2), {'content': '另一章'})
+        assert buffer.get(('chapter', 1)) == {'content': '草稿9'}
+
+        deadline = time.monotonic() + 5
+        while not recorder.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert recorder.batches == [{('chapter', 1): {'content': '草稿9'}, ('chapter', 2): {'content': '另一章'}}]
+        assert buffer.get(('chapter', 1)) is None
+        stats = buffer.stats()
+        assert stats['queued'] == 11 and stats['coalesced'] == 9 and stats['written'] == 2
+        buffer.close()
+
+    def test_close_flushes(self):
+        """测试关闭时写入尚未到期的保存"""
+        recorder = _Recorder()
+        buffer = WriteBehindBuffer(recorder, window=60)
+        buffer.put(('novel', 1), {'title': '书名'})
+        buffer.close()
+        assert recorder.batches == [{('novel', 1): {'title': '书名'}}]
+        with pytest.raises(RuntimeError):
+            buffer.put(('novel', 1), {'title': '关闭后'})
+
+    def test_failed_flush_requeues(self):
+        """测试写入失败后保留数据，较新的保存优先"""
+        # 整批失败后逐条重试仍失败
+        recorder = _Recorder(fail=3)
+        buffer = WriteBehindBuffer(recorder, window=60)
+        buffer.put(('chapter', 1), {'content': '旧'})
+        buffer.put(('chapter', 2), {'content': '保留'})
+        with pytest.raises(RuntimeError):
+            buffer.flush()
+        buffer.put(('chapter', 1), {'content': '新'})
+        assert buffer.flush() == 2
+        assert recorder.batches == [{('chapter', 1): {'content': '新'}, ('chapter', 2): {'content': '保留'}}]
+        buffer.close()
+
+    def test_poisoned_record_dropped(self):
+        """测试一条坏记录不拖累同批其它记录，多次失败后丢弃，关闭不抛错"""
+        batches = []
+
+        def flush_fn(items):
+            if ('chapter', 2) in dict(items):
+                raise ValueError("bad record")
+            batches.append(dict(items))
+
+        buffer = WriteBehindBuffer(flush_fn, window=60, max_attempts=2)
+        buffer.put(('chapter', 1), {'content': '好'})
+        buffer.put(('chapter', 2), {'content': '坏'})
+        buffer.put(('chapter', 3), {'content': '也好'})
+        with pytest.raises(ValueError):
+            buffer.flush()
+        assert batches == [{('chapter', 1): {'content': '好'}}, {('chapter', 3): {'content': '也好'}}]
+        assert buffer.keys() == [('chapter', 2)]
+
+        buffer.close()
+        stats = buffer.stats()
+        assert (stats['written'], stats['dropped'], stats['pending']) == (2, 1, 0)
@@ -0,0 +1,170 @@
+"""
+Opt-in compression codec for large text columns (scripts.content, chapters.content).
+
+Values at or above ``DB_COMPRESS_MIN_BYTES`` are stored as a BLOB::
+
+    b'DZ' + codec id (1 byte) + compressed UTF-8
+
+Anything else, including every row written before compression was enabled,
+stays plain TEXT, so readers must pass stored values through ``decode`` (or the
+``dz_decompress()`` SQL function registered on pooled connections) and writers
+through ``encode``. Listing queries never select these columns, so bodies are
+only inflated when one is actually requested.
+
+``DB_COMPRESSION`` selects the codec for new writes: ``off`` (default),
+``zlib``, or ``zstd`` (needs the optional ``zstandard`` package, falls back to
+zlib without it). Both use the preset dictionary below, which primes the
+compressor with phrases common in our Chinese prose and markdown storyboard
+tables; short chapters gain the most from it. Codec ids are permanent: add a new
+id (and dictionary) rather than changing an existing one.
+"""
+
+import logging
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DB_COMPRESSION = os.getenv('DB_COMPRESSION', 'off').lower()
+DB_COMPRESS_MIN_BYTES = int(os.getenv('DB_COMPRESS_MIN_BYTES', '2048'))
+
+MAGIC = b'DZ'
+CODEC_ZLIB = 1          # zlib, preset dictionary v1
+CODEC_ZSTD = 2          # zstandard, raw-content dictionary v1
+
+# Preset dictionary v1. zlib favours matches near the end of the window, so the
+# most frequent fragments come last. Never edit: stored rows depend on it.
+PRESET_DICTIONARY_V1 = '\n'.join((
+    '第一章 第二章 第三章 第四章 第五章 第六章 第七章 第八章 第九章 第十章',
+    '画面/B-roll建议 情绪/语速 核心金句(逐字稿) 预计时长 运镜建议 (焦段/光圈) 幕次',
+    '| 模块 | 预计时长 | 核心金句(逐字稿) | 画面/B-roll建议 | 情绪/语速 |',
+    '| 幕次 | 序号 | 画面内容 | 运镜建议 (焦段/光圈) | 音效/台词 |',
+    '全景 中景 近景 特写 远景 推镜头 拉镜头 摇镜头 移镜头 跟镜头 固定镜头 慢动作',
+    '# 1. 脚本概述\n# 2. 详细分镜表\n## 场景 ### 镜头',
+    '忽然 突然 仿佛 似乎 已经 终于 然而 于是 因为 所以 但是 可是 只是 还是 就是 不是',
+    '微微一笑 点了点头 摇了摇头 深吸一口气 沉默了片刻 皱了皱眉 看了一眼 转过身 低声道',
+    '“你说什么？” “我知道了。” 他说道：“ 她说道：“ 他们 她们 我们 你们 自己 什么 怎么 这个 那个 一个',
+    '| 序号 | 景别 | 时长 | 画面内容 | 运镜/摄影参数 | 音效/台词 |',
+    '|------|------|------|----------|---------------|-----------|',
+    '| --- | --- | --- | --- | --- | --- |\n| ',
+    '的时候，他的她的了一下。说道：“”\n\n',
+)).encode('utf-8')
+
+_zstd_dict = None
+
+
+def _zstd_dictionary():
+    global _zstd_dict
+    if _zstd_dict is None:
+        _zstd_dict = zstandard.ZstdCompressionDict(
+            PRESET_DICTIONARY_V1, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    return _zstd_dict
+
+
+def _compress(data, codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=9, dict_data=_zstd_dictionary()).compress(data)
+    compressor = zlib.compressobj(9, zdict=PRESET_DICTIONARY_V1)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(codec, payload):
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY_V1)
+        return decompressor.decompress(payload) + decompressor.flush()
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("row compressed with zstd but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor(dict_data=_zstd_dictionary()).decompress(payload)
+    raise ValueError(f"unknown text codec id {codec}")
+
+
+def active_codec(setting=None):
+    """Codec id for new writes, or None when compression is off"""
+    setting = (setting or DB_COMPRESSION).lower()
+    if setting == 'zstd':
+        if zstandard is not None:
+            return CODEC_ZSTD
+        logger.warning("DB_COMPRESSION=zstd but zstandard is not installed; using zlib")
+        return CODEC_ZLIB
+    if setting == 'zlib':
+        return CODEC_ZLIB
+    return None
+
+
+def is_compressed(value):
+    return isinstance(value, bytes) and value[:2] == MAGIC
+
+
+def encode(text, codec=None, min_bytes=None):
+    """Stored form of ``text``: a compressed BLOB if it is large enough and compression pays off
+
+    ``codec`` defaults to the DB_COMPRESSION setting; pass ``False`` to force plain text.
+    """
+    if codec is None:
+        codec = active_codec()
+    if not codec or not isinstance(text, str):
+        return text
+    data = text.encode('utf-8')
+    if len(data) < (DB_COMPRESS_MIN_BYTES if min_bytes is None else min_bytes):
+        return text
+    packed = MAGIC + bytes((codec,)) + _compress(data, codec)
+    # Not worth a decode on every read unless it saves at least a tenth
+    return packed if len(packed) < len(data) * 0.9 else text
+
+
+def decode(value):
+    """Text of a stored value, whatever form it was written in"""
+    if isinstance(value, bytes):
+        if value[:2] == MAGIC:
+            return _decompress(value[2], value[3:]).decode('utf-8')
+        return value.decode('utf-8')
+    return value
+
+
+def register_functions(conn):
+    """Expose ``dz_decompress(x)`` to SQL (FTS triggers and views, substr/length on bodies)"""
+    conn.create_function('dz_decompress', 1, decode, deterministic=True)
+    return conn
+
+
+def recompress_table(connection, table, column='content', codec=None, batch_size=200, min_bytes=None):
+    """Rewrite ``table.column`` in the stored form for ``codec`` (``False`` = plain text)
+
+    Walks the table by id in batches, one short transaction per batch, so a
+    multi-GB database can be converted while the app keeps running.
+    ``connection`` is a context manager factory such as ``ConnectionPool.connection``.
+    Returns counts of rows seen/rewritten and stored bytes before/after.
+    """
+    if codec is None:
+        codec = active_codec()
+    summary = {'rows': 0, 'rewritten': 0, 'bytes_before': 0, 'bytes_after': 0}
+    last_id = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(
+                f'SELECT id, {column} FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row_id, value in rows:
+                stored = encode(decode(value), codec, min_bytes)
+                before = len(value.encode('utf-8')) if isinstance(value, str) else len(value or b'')
+                after = len(stored.encode('utf-8')) if isinstance(stored, str) else len(stored or b'')
+                summary['bytes_before'] += before
+                summary['bytes_after'] += after
+                if stored != value:
+                    updates.append((stored, row_id))
+            if updates:
+                conn.executemany(f'UPDATE {table} SET {column} = ? WHERE id = ?', updates)
+            conn.commit()
+        summary['rows'] += len(rows)
+        summary['rewritten'] += len(updates)
+        last_id = rows[-1][0]
+    return summary
@@ -0,0 +1,324 @@
+"""
+Pooled keep-alive HTTP client shared by every upstream (DashScope) call.
+
+server.py and the Flask routes both go through the module-level
+``upstream_client`` so that task polling and back-to-back generations reuse a
+warm TCP+TLS connection instead of paying a handshake per request.
+"""
+
+import hashlib
+import http.client
+import io
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+# Pool configuration (overridable through the environment)
+POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '10'))              # max connections per host
+CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '10'))
+READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '300'))
+IDLE_TIMEOUT = float(os.getenv('UPSTREAM_IDLE_TIMEOUT', '60'))      # drop idle connections older than this
+POOL_TIMEOUT = float(os.getenv('UPSTREAM_POOL_TIMEOUT', '30'))      # wait for a free slot at most this long
+
+# Failures that mean the server silently closed an idle keep-alive connection
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class UpstreamError(Exception):
+    """Network-level failure talking to the upstream (connect, reset, pool exhausted)"""
+    pass
+
+
+class UpstreamTimeout(UpstreamError):
+    """Upstream did not answer within the configured timeout"""
+    pass
+
+
+def key_id(auth_header):
+    """Stable id of an API key that does not reveal it"""
+    return hashlib.sha256((auth_header or '').encode()).hexdigest()[:16]
+
+
+class _HostPool:
+    """Bounded LIFO pool of keep-alive connections to one scheme://host:port"""
+
+    def __init__(self, scheme, host, port, maxsize, ssl_context):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.ssl_context = ssl_context
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.lock = threading.Lock()
+        self.idle = []  # [(conn, last_used)], most recently used last
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.requests = 0
+        self.errors = 0
+        self.in_use = 0
+
+    def new_connection(self, connect_timeout):
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=connect_timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=connect_timeout)
+        with self.lock:
+            self.created += 1
+        return conn
+
+    def acquire(self, pool_timeout, connect_timeout):
+        """Take a slot and return (conn, reused)"""
+        if not self.slots.acquire(timeout=pool_timeout):
+            with self.lock:
+                self.errors += 1
+            raise UpstreamError(f"连接池已满: {self.scheme}://{self.host}:{self.port}")
+
+        now = time.monotonic()
+        conn = None
+        with self.lock:
+            self.in_use += 1
+            self.requests += 1
+            while self.idle:
+                candidate, last_used = self.idle.pop()
+                if now - last_used <= IDLE_TIMEOUT and candidate.sock is not None:
+                    conn = candidate
+                    self.reused += 1
+                    break
+                candidate.close()
+                self.discarded += 1
+        if conn is not None:
+            return conn, True
+        return self.new_connection(connect_timeout), False
+
+    def release(self, conn):
+        with self.lock:
+            self.in_use -= 1
+            self.idle.append((conn, time.monotonic()))
+        self.slots.release()
+
+    def discard(self, conn, error=False):
+        conn.close()
+        with self.lock:
+            self.in_use -= 1
+            self.discarded += 1
+            if error:
+                self.errors += 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_size': self.maxsize,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'requests': self.requests,
+                'errors': self.errors,
+            }
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+class UpstreamResponse:
+    """Response bound to a pooled connection
+
+    The connection goes back to the pool once the body has been read in full
+    (``read``/``json``/iteration); ``close`` before that discards it.
+    """
+
+    def __init__(self, pool, conn, raw, url):
+        self._pool = pool
+        self._conn = conn
+        self._raw = raw
+        self._body = None
+        self._released = False
+        self.url = url
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.msg
+
+    def getheader(self, name, default=None):
+        return self._raw.getheader(name, default)
+
+    def read(self):
+        if self._body is None:
+            try:
+                self._body = self._raw.read()
+            except (http.client.HTTPException, OSError) as e:
+                raise self._read_failed(e) from e
+            finally:
+                self._release()
+        return self._body
+
+    def json(self):
+        return json.loads(self.read())
+
+    def __iter__(self):
+        """Yield the body line by line as it arrives (SSE streams)"""
+        try:
+            while True:
+                try:
+                    line = self._raw.readline()
+                except (http.client.HTTPException, OSError) as e:
+                    raise self._read_failed(e) from e
+                if not line:
+                    # http.client reports a chunked or sized body cut short as a plain end of stream
+                    if (self._raw.chunked and self._raw.chunk_left is not None) or self._raw.length:
+                        raise self._read_failed(http.client.IncompleteRead(b''))
+                    break
+                yield line
+        finally:
+            self._release()
+
+    def _read_failed(self, error):
+        """Discard the connection and turn an http.client/socket error into the client's own"""
+        self.close()
+        if isinstance(error, socket.timeout):
+            return UpstreamTimeout(f"读取上游响应超时: {error}")
+        return UpstreamError(f"读取上游响应失败: {error!r}")
+
+    def _release(self):
+        if self._released:
+            return
+        self._released = True
+        # Only a fully drained response leaves the connection reusable
+        if self._raw.isclosed() and not self._raw.will_close:
+            self._pool.release(self._conn)
+        else:
+            self._raw.close()
+            self._pool.discard(self._conn)
+
+    def close(self):
+        if not self._released:
+            self._raw.close()
+            self._released = True
+            self._pool.discard(self._conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client with a bounded connection pool per host"""
+
+    def __init__(self, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_timeout=POOL_TIMEOUT):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_timeout = pool_timeout
+        self._ssl_context = ssl.create_default_context()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool_for(self, parts):
+        scheme = parts.scheme or 'https'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = _HostPool(scheme, parts.hostname, port, self.pool_size, self._ssl_context)
+                self._pools[key] = pool
+            return pool
+
+    def _send(self, conn, method, path, body, headers, timeout):
+        if conn.sock is None:
+            conn.connect()
+        conn.sock.settimeout(timeout)
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def request(self, method, url, body=None, headers=None, timeout=None,
+                stream=False, raise_for_status=True):
+        """Send a request through the pool
+
+        Args:
+            body: bytes/str, or a dict/list which is sent as JSON
+            timeout: read timeout in seconds (defaults to UPSTREAM_READ_TIMEOUT)
+            stream: leave the body unread so the caller can iterate it
+            raise_for_status: raise urllib.error.HTTPError for 4xx/5xx, like urlopen
+
+        Returns:
+            UpstreamResponse
+        """
+        parts = urllib.parse.urlsplit(url)
+        pool = self._pool_for(parts)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        timeout = timeout or self.read_timeout
+
+        conn, reused = pool.acquire(self.pool_timeout, self.connect_timeout)
+        try:
+            try:
+                raw = self._send(conn, method, path, body, headers, timeout)
+            except _STALE_ERRORS:
+                if not reused:
+                    raise
+                # The server dropped an idle keep-alive connection: retry once on a fresh one
+                conn.close()
+                conn = pool.new_connection(self.connect_timeout)
+                raw = self._send(conn, method, path, body, headers, timeout)
+        except socket.timeout as e:
+            pool.discard(conn, error=True)
+            raise UpstreamTimeout(f"上游请求超时: {url}") from e
+        except (OSError, http.client.HTTPException) as e:
+            pool.discard(conn, error=True)
+            raise UpstreamError(f"上游连接失败: {e}") from e
+
+        response = UpstreamResponse(pool, conn, raw, url)
+        if raise_for_status and response.status >= 400:
+            error_body = response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, io.BytesIO(error_body))
+        if not stream:
+            response.read()
+        return response
+
+    def stats(self):
+        """Pool metrics, keyed by upstream origin"""
+        with self._lock:
+            pools = list(self._pools.values())
+        return {
+            'pool_size': self.pool_size,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'idle_timeout': IDLE_TIMEOUT,
+            'hosts': {f"{p.scheme}://{p.host}:{p.port}": p.stats() for p in pools},
+        }
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+
+# 全局上游客户端实例
+upstream_client = UpstreamClient()
@@ -0,0 +1,194 @@
+"""
+Write-behind buffer that coalesces rapid saves of the same record.
+
+The editor autosaves while the user types. Instead of one UPDATE (and one
+fsync) per keystroke burst, saves are parked here keyed by record, later saves
+replace earlier ones, and a background thread writes everything that is
+pending in a single call to ``flush_fn`` once the oldest save has waited
+``window`` seconds.
+
+Readers call ``get`` to see writes that are queued or being flushed, so a save
+followed by a load never returns stale data. ``flush`` forces the write, of
+everything or of just the keys a caller is about to read from the database,
+and ``close`` flushes before shutdown; anything still buffered when the
+process is killed outright (at most ``window`` seconds of edits) is lost.
+
+A record the database keeps refusing must not hold the others back: when a
+batch fails its records are retried one at a time, and a record that still
+fails is re-queued until it has failed ``max_attempts`` times, then logged
+and dropped.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Latest pending value per key, written in batches by ``flush_fn(items)``
+
+    ``flush_fn`` receives a list of ``(key, value)`` pairs and must write them
+    all or raise. If it raises, each record is written on its own; the ones
+    that fail again are re-queued (unless newer values arrived meanwhile) and
+    retried on the next cycle.
+    """
+
+    def __init__(self, flush_fn, window=2.0, max_pending=500, max_attempts=3):
+        self.flush_fn = flush_fn
+        self.window = window
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._pending = {}          # key -> (value, first queued at)
+        self._inflight = {}         # key -> value, while a flush is writing it
+        self._failures = {}         # key -> failed writes of its current value
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.queued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def put(self, key, value):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("write buffer is closed")
+            self.queued += 1
+            self._failures.pop(key, None)
+            if key in self._pending:
+                # Keep the first timestamp: a steady stream of saves still flushes every window
+                self._pending[key] = (value, self._pending[key][1])
+                self.coalesced += 1
+            else:
+                self._pending[key] = (value, time.monotonic())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def discard(self, key):
+        """Drop a queued value (e.g. the record was deleted)"""
+        with self._cond:
+            self._pending.pop(key, None)
+            self._failures.pop(key, None)
+
+    def get(self, key):
+        """Value queued or being written for ``key``, or None"""
+        with self._cond:
+            if key in self._pending:
+                return self._pending[key][0]
+            return self._inflight.get(key)
+
+    def keys(self):
+        """Keys with a queued value"""
+        with self._cond:
+            return list(self._pending)
+
+    def flush(self, keys=None):
+        """Write everything pending now, or only ``keys``; returns how many records were written"""
+        with self._flush_lock:
+            with self._cond:
+                selected = list(self._pending) if keys is None else [key for key in keys if key in self._pending]
+                batch = {key: self._pending[key][0] for key in selected}
+                queued_at = {key: self._pending.pop(key)[1] for key in selected}
+                self._inflight = batch
+            if not batch:
+                return 0
+            failed = {}
+            try:
+                self.flush_fn(list(batch.items()))
+            except Exception as e:
+                failed = {key: e for key in batch} if len(batch) == 1 else self._write_each(batch)
+            with self._cond:
+                self._inflight = {}
+                written = len(batch) - len(failed)
+                if written:
+                    self.flushes += 1
+                    self.written += written
+                for key in batch:
+                    if key not in failed:
+                        self._failures.pop(key, None)
+                for key, error in failed.items():
+                    self.errors += 1
+                    if key in self._pending:
+                        continue            # a newer value replaces the one that failed
+                    attempts = self._failures.get(key, 0) + 1
+                    if attempts >= self.max_attempts:
+                        self._failures.pop(key, None)
+                        self.dropped += 1
+                        logger.error("Dropping write of %r after %d failed attempts: %s", key, attempts, error)
+                    else:
+                        self._failures[key] = attempts
+                        self._pending[key] = (batch[key], queued_at[key])
+            if failed:
+                raise next(iter(failed.values()))
+            return written
+
+    def _write_each(self, batch):
+        """Write a failed batch record by record; returns {key: error} for the ones that fail"""
+        failed = {}
+        for key, value in batch.items():
+            try:
+                self.flush_fn([(key, value)])
+            except Exception as e:
+                failed[key] = e
+        return failed
+
+    def _next_deadline(self):
+        if len(self._pending) >= self.max_pending:
+            return 0
+        oldest = min((since for _, since in self._pending.values()), default=None)
+        return None if oldest is None else oldest + self.window - time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    remaining = self._next_deadline()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed; will retry")
+                time.sleep(min(self.window, 1.0))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'flushes': self.flushes,
+                'written': self.written,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'window': self.window,
+            }
+
+    def close(self):
+        """Stop the background thread and write whatever is still pending
+
+        Records that keep failing are dropped after ``max_attempts``, so this
+        returns (and the caller can release the database) rather than raise.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        while True:
+            try:
+                self.flush()
+                return
+            except Exception:
+                logger.exception("Write-behind flush at close failed")